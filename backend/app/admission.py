@@ -0,0 +1,259 @@
+"""Controllo di ammissione adattivo per le prenotazioni.
+
+Sostituisce il semaforo fisso a 5 slot. Il limite di prenotazioni contemporanee
+varia tra ADMISSION_MIN_CONCURRENCY e ADMISSION_MAX_CONCURRENCY con uno schema
+AIMD: sale di uno quando tutti gli slot sono occupati e le cose vanno bene, cala
+del 25% quando la latenza media del portale supera il target, quando la quota
+di errori cresce o quando la RAM libera dell'host scende sotto la soglia.
+
+Ogni utente ha al massimo ADMISSION_PER_USER_LIMIT prenotazioni attive (in coda
+o in corso) e altrettanti slot, così chi ritenta a raffica non blocca gli altri.
+All'ingresso (POST /book) si stima l'attesa in coda: se supera
+ADMISSION_MAX_WAIT_SECONDS la richiesta viene rifiutata subito con 503 e
+Retry-After invece di accodarsi senza limiti.
+
+Il limite è di ogni processo, la coda Redis invece la svuotano tutti: ogni
+processo pubblica il proprio limite in LIMITS_KEY (share_limit) e la stima
+dell'attesa usa la somma dei limiti dei processi vivi.
+"""
+import asyncio
+import math
+import os
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import AsyncIterator, Dict, Optional
+
+from app.metrics import BOOKING_CONCURRENCY_LIMIT, BOOKING_SLOT_WAIT_SECONDS, BOOKINGS_IN_PROGRESS
+from app.redis_client import redis_client
+from app.settings import settings
+
+# Esiti recenti usati per la quota di errori
+OUTCOME_WINDOW = 20
+LATENCY_SMOOTHING = 0.2
+
+# processo -> "limite scadenza": un processo che smette di pubblicare esce dalla somma
+LIMITS_KEY = "admission:limits"
+LIMIT_TTL_SECONDS = 15
+
+
+class AdmissionRejected(Exception):
+    """Sistema saturo: il client deve riprovare dopo retry_after secondi."""
+
+    def __init__(self, reason: str, retry_after: int, scope: str = "queue"):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+        self.scope = scope  # "queue" (sistema saturo) o "user" (troppi job dello stesso utente)
+
+
+def available_memory_mb() -> Optional[int]:
+    """MemAvailable dell'host da /proc/meminfo (None dove non disponibile)."""
+    try:
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        target_latency: float,
+        max_error_rate: float,
+        min_free_memory_mb: int,
+        per_user_limit: int,
+        max_wait: float,
+        shared_key: Optional[str] = None,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = max(min_limit, min(initial, max_limit))
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.min_free_memory_mb = min_free_memory_mb
+        self.per_user_limit = per_user_limit
+        self.max_wait = max_wait
+        self.shared_key = shared_key
+        self.process_id = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+
+        self.in_flight = 0
+        self.waiting = 0
+        self._per_user: Dict[str, int] = {}
+        self._cond = asyncio.Condition()
+        self._outcomes: deque = deque(maxlen=OUTCOME_WINDOW)
+        self._latency: Optional[float] = None
+        self._last_decrease = 0.0
+
+        # Statistiche
+        self.increases = 0
+        self.decreases = 0
+        self.rejected = 0
+        BOOKING_CONCURRENCY_LIMIT.set(self.limit)
+
+    # --- INGRESSO ---
+
+    def _retry_after(self, queued: int, limit: int) -> int:
+        per_booking = self._latency or self.target_latency
+        return max(1, min(300, math.ceil(per_booking * (queued + 1) / limit)))
+
+    async def cluster_limit(self) -> int:
+        """Prenotazioni contemporanee di tutti i processi che svuotano la coda:
+        il nostro limite più quelli pubblicati dagli altri e non scaduti."""
+        if not self.shared_key:
+            return self.limit
+        try:
+            shared = await redis_client.hgetall(self.shared_key)
+        except Exception as e:
+            print(f"Ammissione: limiti degli altri processi non disponibili ({e})")
+            return self.limit
+        now = time.time()
+        total = self.limit
+        for process, value in shared.items():
+            limit, expires_at = value.split()
+            if process != self.process_id and float(expires_at) > now:
+                total += int(limit)
+        return total
+
+    async def check_queue(self, queued: int):
+        """Rifiuta subito se i job già in coda farebbero aspettare troppo il nuovo arrivato."""
+        limit = await self.cluster_limit()
+        per_booking = self._latency or self.target_latency
+        expected_wait = per_booking * queued / limit
+        if expected_wait > self.max_wait:
+            self.rejected += 1
+            raise AdmissionRejected(
+                f"Troppe prenotazioni in coda (attesa stimata {expected_wait:.0f}s)",
+                self._retry_after(queued, limit),
+            )
+
+    async def share_limit(self):
+        """Pubblica il limite di questo processo finché il task non viene cancellato
+        (e allora lo toglie). Ripulisce le voci dei processi scaduti."""
+        if not self.shared_key:
+            return
+        try:
+            while True:
+                try:
+                    now = time.time()
+                    shared = await redis_client.hgetall(self.shared_key)
+                    expired = [p for p, value in shared.items() if float(value.split()[1]) <= now]
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        pipe.hset(self.shared_key, self.process_id, f"{self.limit} {now + LIMIT_TTL_SECONDS}")
+                        if expired:
+                            pipe.hdel(self.shared_key, *expired)
+                        await pipe.execute()
+                except Exception as e:
+                    print(f"Ammissione: limite non pubblicato ({e})")
+                await asyncio.sleep(LIMIT_TTL_SECONDS / 3)
+        finally:
+            try:
+                await redis_client.hdel(self.shared_key, self.process_id)
+            except Exception:
+                pass
+
+    # --- SLOT ---
+
+    def _can_enter(self, user: str) -> bool:
+        return self.in_flight < self.limit and self._per_user.get(user, 0) < self.per_user_limit
+
+    @asynccontextmanager
+    async def slot(self, user: str) -> AsyncIterator[None]:
+        """Occupa uno slot di prenotazione per l'utente, aspettando se necessario."""
+        wait_start = time.perf_counter()
+        async with self._cond:
+            self.waiting += 1
+            try:
+                await self._cond.wait_for(lambda: self._can_enter(user))
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+            self._per_user[user] = self._per_user.get(user, 0) + 1
+        BOOKING_SLOT_WAIT_SECONDS.observe(time.perf_counter() - wait_start)
+        BOOKINGS_IN_PROGRESS.set(self.in_flight)
+
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                remaining = self._per_user[user] - 1
+                if remaining:
+                    self._per_user[user] = remaining
+                else:
+                    del self._per_user[user]
+                self._cond.notify_all()
+            BOOKINGS_IN_PROGRESS.set(self.in_flight)
+
+    # --- ADATTAMENTO ---
+
+    def record(self, duration: float, upstream_ok: bool):
+        """Esito di una prenotazione conclusa, da chiamare prima di liberare lo slot:
+        aggiorna le stime e il limite (chi aspetta viene svegliato al rilascio).
+        upstream_ok è False per errori del portale/browser, non per credenziali errate."""
+        self._outcomes.append(upstream_ok)
+        if self._latency is None:
+            self._latency = duration
+        else:
+            self._latency += LATENCY_SMOOTHING * (duration - self._latency)
+
+        error_rate = self._outcomes.count(False) / len(self._outcomes)
+        free_mb = available_memory_mb()
+        low_memory = free_mb is not None and free_mb < self.min_free_memory_mb
+        overloaded = (
+            low_memory
+            or self._latency > self.target_latency
+            or (len(self._outcomes) >= 5 and error_rate > self.max_error_rate)
+        )
+
+        now = time.monotonic()
+        if overloaded:
+            # Al massimo una riduzione per "tempo di prenotazione": le prenotazioni
+            # già in volo riflettono ancora il limite vecchio
+            if now - self._last_decrease > self._latency and self.limit > self.min_limit:
+                self.limit = max(self.min_limit, math.floor(self.limit * 0.75))
+                self._last_decrease = now
+                self.decreases += 1
+                print(f"Ammissione: limite ridotto a {self.limit} "
+                      f"(latenza {self._latency:.1f}s, errori {error_rate:.0%}, RAM libera {free_mb} MB)")
+        elif self.in_flight >= self.limit and self.limit < self.max_limit:
+            # Gli slot erano tutti pieni e il portale risponde bene: un posto in più
+            self.limit += 1
+            self.increases += 1
+        BOOKING_CONCURRENCY_LIMIT.set(self.limit)
+
+    def stats(self) -> Dict:
+        return {
+            "limit": self.limit,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "latency_avg_s": round(self._latency, 2) if self._latency is not None else None,
+            "error_rate": round(self._outcomes.count(False) / len(self._outcomes), 2) if self._outcomes else 0.0,
+            "available_memory_mb": available_memory_mb(),
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "rejected": self.rejected,
+        }
+
+
+def from_settings() -> AdmissionController:
+    return AdmissionController(
+        initial=settings.ADMISSION_INITIAL_CONCURRENCY,
+        min_limit=settings.ADMISSION_MIN_CONCURRENCY,
+        max_limit=settings.ADMISSION_MAX_CONCURRENCY,
+        target_latency=settings.ADMISSION_TARGET_LATENCY_SECONDS,
+        max_error_rate=settings.ADMISSION_MAX_ERROR_RATE,
+        min_free_memory_mb=settings.ADMISSION_MIN_FREE_MEMORY_MB,
+        per_user_limit=settings.ADMISSION_PER_USER_LIMIT,
+        max_wait=settings.ADMISSION_MAX_WAIT_SECONDS,
+        shared_key=LIMITS_KEY,
+    )
@@ -0,0 +1,244 @@
+"""Archivio storico dei menu (SQLite) con indice di ricerca dei piatti.
+
+Redis tiene solo oggi e domani; qui ogni pasto scaricato viene aggiunto e mai
+riscritto, così si può chiedere "quando c'è il piatto X" o vedere l'andamento
+nei mesi. I nomi dei piatti vengono normalizzati (minuscole, senza accenti né
+punteggiatura) e spezzati in token: la tabella dish_tokens è l'indice
+invertito token -> piatto, le altre tabelle collegano piatti, categorie
+(CATEGORY_MAP) e pasti. Con gli indici giusti anche anni di storico restano
+nell'ordine dei millisecondi.
+
+Le scritture girano in un thread a parte e in background: lo scraping non le aspetta.
+Le letture usano una connessione per thread: in WAL non aspettano le scritture,
+che restano serializzate dal lock sulla sola connessione di scrittura.
+"""
+import asyncio
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
+
+from app.settings import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meals (
+    id INTEGER PRIMARY KEY,
+    day TEXT NOT NULL,
+    canteen TEXT NOT NULL,
+    meal TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    UNIQUE (day, canteen, meal)
+);
+CREATE INDEX IF NOT EXISTS meals_canteen_day ON meals (canteen, day);
+
+CREATE TABLE IF NOT EXISTS dishes (
+    id INTEGER PRIMARY KEY,
+    norm TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meal_dishes (
+    meal_id INTEGER NOT NULL REFERENCES meals (id),
+    dish_id INTEGER NOT NULL REFERENCES dishes (id),
+    category TEXT NOT NULL,
+    PRIMARY KEY (meal_id, dish_id, category)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS meal_dishes_dish ON meal_dishes (dish_id, meal_id);
+CREATE INDEX IF NOT EXISTS meal_dishes_category ON meal_dishes (category, meal_id);
+
+CREATE TABLE IF NOT EXISTS dish_tokens (
+    token TEXT NOT NULL,
+    dish_id INTEGER NOT NULL REFERENCES dishes (id),
+    PRIMARY KEY (token, dish_id)
+) WITHOUT ROWID;
+"""
+
+# Parole che non aiutano a distinguere i piatti
+STOPWORDS = {
+    "a", "ai", "al", "alla", "alle", "allo", "agli", "con", "d", "da", "dei", "del", "della",
+    "delle", "degli", "di", "e", "gli", "i", "il", "in", "la", "le", "lo", "su", "un", "una",
+}
+
+# Serializza le scritture (una sola connessione, condivisa tra i thread)
+_lock = threading.Lock()
+_readers = threading.local()
+_pending: Set[asyncio.Task] = set()
+
+
+@lru_cache(maxsize=1)
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(settings.ARCHIVE_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _reader() -> sqlite3.Connection:
+    """Connessione di sola lettura del thread corrente (dopo che _connect ha creato lo schema)."""
+    conn = getattr(_readers, "conn", None)
+    if conn is None:
+        _connect()
+        conn = sqlite3.connect(f"file:{settings.ARCHIVE_PATH}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        _readers.conn = conn
+    return conn
+
+
+def normalize(name: str) -> str:
+    """Minuscole, senza accenti né punteggiatura: "Pasta all'Amatriciana " -> "pasta all amatriciana"."""
+    decomposed = unicodedata.normalize("NFKD", name.lower())
+    ascii_only = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", ascii_only).split())
+
+
+def tokenize(norm: str) -> List[str]:
+    return [t for t in dict.fromkeys(norm.split()) if t not in STOPWORDS]
+
+
+# --- SCRITTURA ---
+
+def _dish_id(conn: sqlite3.Connection, name: str) -> Optional[int]:
+    norm = normalize(name)
+    if not norm:
+        return None
+    row = conn.execute("SELECT id FROM dishes WHERE norm = ?", (norm,)).fetchone()
+    if row:
+        return row["id"]
+    dish_id = conn.execute("INSERT INTO dishes (norm, name) VALUES (?, ?)", (norm, name.strip())).lastrowid
+    conn.executemany(
+        "INSERT OR IGNORE INTO dish_tokens (token, dish_id) VALUES (?, ?)",
+        [(token, dish_id) for token in tokenize(norm)],
+    )
+    return dish_id
+
+
+def _record(meals: List[Dict]):
+    conn = _connect()
+    with _lock, conn:
+        for meal in meals:
+            conn.execute(
+                "INSERT OR IGNORE INTO meals (day, canteen, meal, first_seen) VALUES (?, ?, ?, ?)",
+                (meal["data"], meal["mensa_id"], meal["tipo_pasto"], time.time()),
+            )
+            meal_id = conn.execute(
+                "SELECT id FROM meals WHERE day = ? AND canteen = ? AND meal = ?",
+                (meal["data"], meal["mensa_id"], meal["tipo_pasto"]),
+            ).fetchone()["id"]
+            rows = []
+            for category, dishes in meal["piatti"].items():
+                for dish in dishes:
+                    dish_id = _dish_id(conn, dish["nome"])
+                    if dish_id is not None:
+                        rows.append((meal_id, dish_id, category))
+            # Solo aggiunte: un piatto tolto in giornata resta comunque nello storico
+            conn.executemany(
+                "INSERT OR IGNORE INTO meal_dishes (meal_id, dish_id, category) VALUES (?, ?, ?)", rows
+            )
+
+
+def archive_in_background(meals: List[Dict]):
+    """Accoda l'archiviazione dei pasti senza far aspettare il chiamante."""
+    if not settings.ARCHIVE_ENABLED or not meals:
+        return
+
+    async def run():
+        try:
+            await asyncio.to_thread(_record, meals)
+        except Exception as e:
+            print(f"Archivio menu: scrittura non riuscita: {e}")
+
+    task = asyncio.create_task(run())
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+# --- LETTURA ---
+
+def _filters(q: Optional[str], category: Optional[str], canteen: Optional[str],
+             since: Optional[str], until: Optional[str]) -> tuple[str, list]:
+    clauses, params = [], []
+    if q:
+        # Ogni token della ricerca deve comparire (come prefisso) tra i token del piatto
+        token_queries = []
+        for token in tokenize(normalize(q)) or normalize(q).split():
+            token_queries.append("SELECT dish_id FROM dish_tokens WHERE token >= ? AND token < ?")
+            params.extend([token, token + "\uffff"])
+        if token_queries:
+            clauses.append(f"md.dish_id IN ({' INTERSECT '.join(token_queries)})")
+    if category:
+        clauses.append("md.category = ?")
+        params.append(category)
+    if canteen:
+        clauses.append("m.canteen = ?")
+        params.append(canteen)
+    if since:
+        clauses.append("m.day >= ?")
+        params.append(since)
+    if until:
+        clauses.append("m.day <= ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+
+FROM_JOINS = """
+FROM meal_dishes md
+JOIN meals m ON m.id = md.meal_id
+JOIN dishes d ON d.id = md.dish_id
+"""
+
+
+def _search(q: str, category: Optional[str], canteen: Optional[str],
+            since: Optional[str], until: Optional[str], limit: int) -> List[Dict]:
+    where, params = _filters(q, category, canteen, since, until)
+    rows = _reader().execute(
+        f"SELECT m.day, m.canteen, m.meal, md.category, d.name {FROM_JOINS}{where}"
+        " ORDER BY m.day DESC, m.canteen, m.meal LIMIT ?",
+        [*params, limit],
+    ).fetchall()
+    return [
+        {"data": r["day"], "mensa_id": r["canteen"], "tipo_pasto": r["meal"],
+         "categoria": r["category"], "nome": r["name"]}
+        for r in rows
+    ]
+
+
+def _stats(q: Optional[str], category: Optional[str], canteen: Optional[str],
+           since: Optional[str], until: Optional[str], limit: int) -> Dict:
+    where, params = _filters(q, category, canteen, since, until)
+    conn = _reader()
+    # Le due query vedono lo stesso stato dell'archivio
+    with conn:
+        conn.execute("BEGIN")
+        top = conn.execute(
+            f"SELECT d.name, COUNT(*) AS volte, MIN(m.day) AS prima, MAX(m.day) AS ultima {FROM_JOINS}{where}"
+            " GROUP BY d.id ORDER BY volte DESC, d.name LIMIT ?",
+            [*params, limit],
+        ).fetchall()
+        by_month = conn.execute(
+            f"SELECT substr(m.day, 1, 7) AS mese, COUNT(*) AS volte {FROM_JOINS}{where}"
+            " GROUP BY mese ORDER BY mese",
+            params,
+        ).fetchall()
+    return {
+        "piatti": [
+            {"nome": r["name"], "volte": r["volte"], "prima": r["prima"], "ultima": r["ultima"]} for r in top
+        ],
+        "per_mese": {r["mese"]: r["volte"] for r in by_month},
+    }
+
+
+async def search_dishes(q: str, category: Optional[str] = None, canteen: Optional[str] = None,
+                        since: Optional[str] = None, until: Optional[str] = None, limit: int = 50) -> List[Dict]:
+    """Quando (giorno, mensa, pasto) sono stati serviti i piatti che corrispondono a q."""
+    return await asyncio.to_thread(_search, q, category, canteen, since, until, limit)
+
+
+async def dish_stats(q: Optional[str] = None, category: Optional[str] = None, canteen: Optional[str] = None,
+                     since: Optional[str] = None, until: Optional[str] = None, limit: int = 20) -> Dict:
+    """Piatti più frequenti e numero di presenze per mese."""
+    return await asyncio.to_thread(_stats, q, category, canteen, since, until, limit)
@@ -0,0 +1,101 @@
+"""Traccia diagnostica delle prenotazioni, salvata su disco solo se falliscono.
+
+Durante la prenotazione si tengono in memoria i tempi e l'URL di ogni step
+(costo trascurabile) e, per una frazione campionata delle richieste, gli ultimi
+N snapshot HTML. Solo se la prenotazione fallisce la traccia viene scritta in
+una cartella dedicata (ARTIFACTS_DIR/<timestamp>-<id>/) insieme a HTML e
+screenshot della pagina finale; le cartelle più vecchie oltre ARTIFACTS_MAX_RUNS
+vengono cancellate.
+"""
+import asyncio
+import json
+import random
+import shutil
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from playwright.async_api import Page
+
+from app.events import report_step
+from app.metrics import BOOKING_STEP_SECONDS, trace_id
+from app.settings import settings
+
+
+class BookingTrace:
+    def __init__(self, meal_url: str):
+        self.id = trace_id.get() or uuid.uuid4().hex[:12]
+        self.meal_url = meal_url
+        self.started = time.perf_counter()
+        self._last_step = self.started
+        self.steps: List[Dict] = []
+        self.snapshots: deque = deque(maxlen=settings.ARTIFACTS_SNAPSHOTS)
+        self.sampled = random.random() < settings.ARTIFACTS_SAMPLE_RATE
+
+    def step(self, name: str, page: Optional[Page] = None, **info):
+        """Registra la fine di uno step: nome, ms dall'inizio, URL corrente.
+        La durata dello step alimenta anche l'istogramma booking_step_seconds
+        e lo stream SSE del job."""
+        now = time.perf_counter()
+        BOOKING_STEP_SECONDS.observe(now - self._last_step, engine="playwright", step=name)
+        self._last_step = now
+        entry = {"step": name, "ms": round((now - self.started) * 1000, 1)}
+        if page is not None:
+            entry["url"] = page.url
+        entry.update(info)
+        self.steps.append(entry)
+        report_step(name, engine="playwright", meal_url=self.meal_url, ms=entry["ms"])
+
+    async def snapshot(self, page: Page, name: str):
+        """Registra lo step e, solo per le richieste campionate, l'HTML della pagina."""
+        self.step(name, page)
+        if not self.sampled:
+            return
+        try:
+            self.snapshots.append((name, page.url, await page.content()))
+        except Exception as e:
+            print(f"DEBUG: snapshot '{name}' non riuscito: {e}")
+
+    async def persist_failure(self, page: Page, reason: str):
+        """Cattura lo stato finale della pagina e salva tutto su disco."""
+        self.step("failure", page, reason=reason)
+        if settings.ARTIFACTS_MAX_RUNS <= 0:
+            return  # nessuna cartella da conservare: inutile catturare e scrivere
+        final_html, screenshot = None, None
+        try:
+            final_html = await page.content()
+            screenshot = await page.screenshot(full_page=True)
+        except Exception as e:
+            print(f"DEBUG: cattura stato finale non riuscita: {e}")
+
+        try:
+            run_dir = await asyncio.to_thread(self._write, final_html, screenshot)
+            print(f"DEBUG: artefatti della prenotazione fallita in {run_dir}")
+        except OSError as e:
+            print(f"DEBUG: impossibile salvare gli artefatti: {e}")
+
+    def _write(self, final_html: Optional[str], screenshot: Optional[bytes]) -> Path:
+        root = Path(settings.ARTIFACTS_DIR)
+        run_dir = root / f"{time.strftime('%Y%m%d-%H%M%S')}-{self.id}"
+        run_dir.mkdir(parents=True, exist_ok=True)
+
+        trace = {"id": self.id, "meal_url": self.meal_url, "sampled": self.sampled, "steps": self.steps}
+        (run_dir / "trace.json").write_text(json.dumps(trace, indent=2, ensure_ascii=False))
+        for i, (name, url, html) in enumerate(self.snapshots):
+            (run_dir / f"{i:02d}-{name}.html").write_text(f"<!-- {url} -->\n{html}")
+        if final_html is not None:
+            (run_dir / "final.html").write_text(final_html)
+        if screenshot is not None:
+            (run_dir / "final.png").write_bytes(screenshot)
+
+        _apply_retention(root)
+        return run_dir
+
+
+def _apply_retention(root: Path):
+    runs = sorted(p for p in root.iterdir() if p.is_dir())
+    # Non runs[:-N]: con N = 0 la slice sarebbe vuota e non cancellerebbe nulla
+    for old in runs[:max(len(runs) - settings.ARTIFACTS_MAX_RUNS, 0)]:
+        shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,306 @@
+"""Prenotazioni programmate: l'utente lascia l'intenzione prima dell'apertura.
+
+Invece di far martellare /book a tutti nel momento in cui il pasto diventa
+prenotabile, l'utente registra in anticipo meal_url, piatti preferiti e
+alternative per categoria. Il backend:
+  - poco prima dell'apertura (opens_at - INTENT_PREARM_SECONDS) fa il login e
+    mette la sessione in cache, così la prenotazione vera salta il login (con il
+    motore Playwright avvia anche il browser e il suo pool di contesti);
+  - all'apertura (opens_at) oppure appena lo scraping trova il pasto
+    prenotabile (messaggio su BOOKABLE_CHANNEL) accoda il job nella normale
+    coda prenotazioni, dove worker e controllo di ammissione ne regolano il
+    parallelismo.
+Ogni intenzione parte una sola volta anche con più processi: lo scatto è
+rivendicato con un SET NX in Redis. Un'intenzione con credenziali non più
+leggibili (chiave cambiata) viene segnata come fallita, senza fermare le altre.
+"""
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.date import DateTrigger
+from cryptography.fernet import InvalidToken
+
+from app import menu_store
+from app.booking_queue import enqueue_booking, get_job, seal, unseal
+from app.http_booking import LoginError, http_login, new_client
+from app.redis_client import listen_channels, redis_client
+from app.session_store import cookies_from_httpx, enabled as session_cache_enabled, load_session, save_session
+from app.settings import settings
+
+INTENTS_KEY = "booking:intents"
+
+PENDING = "pending"
+ARMED = "armed"
+FIRED = "fired"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+def _intent_key(intent_id: str) -> str:
+    return f"booking:intent:{intent_id}"
+
+
+def _cred_key(intent_id: str) -> str:
+    return f"booking:intent:cred:{intent_id}"
+
+
+def _claim_key(intent_id: str, action: str) -> str:
+    return f"booking:intent:{action}:{intent_id}"
+
+
+def _meal_index_key(meal_url: str) -> str:
+    return f"booking:intents:meal:{hashlib.sha256(meal_url.encode()).hexdigest()}"
+
+
+def _dedup_key(username: str, meal_url: str) -> str:
+    return f"booking:intent:dedup:{hashlib.sha256(f'{username}|{meal_url}'.encode()).hexdigest()}"
+
+
+def _upcoming_days() -> List[str]:
+    today = date.today()
+    return [today.isoformat(), (today + timedelta(days=1)).isoformat()]
+
+
+async def create_intent(
+    username: str,
+    password: str,
+    meal_url: str,
+    dish_ids: List[str],
+    fallbacks: Dict[str, List[str]],
+    opens_at: Optional[datetime],
+) -> Dict:
+    """Registra l'intenzione (una per utente e pasto: la nuova sostituisce la vecchia)."""
+    ttl = settings.INTENT_TTL_SECONDS
+    previous = await redis_client.get(_dedup_key(username, meal_url))
+    if previous:
+        await cancel_intent(previous)
+
+    intent_id = uuid.uuid4().hex
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_intent_key(intent_id), mapping={
+            "intent_id": intent_id,
+            "status": PENDING,
+            "username": username,
+            "meal_url": meal_url,
+            "dish_ids": json.dumps(dish_ids),
+            "fallbacks": json.dumps(fallbacks),
+            "opens_at": opens_at.timestamp() if opens_at else "",
+            "created_at": time.time(),
+        })
+        pipe.expire(_intent_key(intent_id), ttl)
+        pipe.set(_cred_key(intent_id), seal(password), ex=ttl)
+        pipe.set(_dedup_key(username, meal_url), intent_id, ex=ttl)
+        pipe.sadd(_meal_index_key(meal_url), intent_id)
+        pipe.expire(_meal_index_key(meal_url), ttl)
+        pipe.sadd(INTENTS_KEY, intent_id)
+        await pipe.execute()
+
+    return await get_intent(intent_id)
+
+
+async def get_intent(intent_id: str) -> Optional[Dict]:
+    data = await redis_client.hgetall(_intent_key(intent_id))
+    if not data:
+        return None
+    intent = {
+        "intent_id": data["intent_id"],
+        "status": data["status"],
+        "meal_url": data["meal_url"],
+        "dish_ids": json.loads(data["dish_ids"]),
+        "fallbacks": json.loads(data["fallbacks"]),
+        "opens_at": float(data["opens_at"]) if data["opens_at"] else None,
+        "created_at": float(data["created_at"]),
+        "reason": data.get("reason"),
+        "job": None,
+    }
+    if data.get("job_id"):
+        intent["job"] = await get_job(data["job_id"])
+    return intent
+
+
+async def cancel_intent(intent_id: str) -> bool:
+    data = await redis_client.hgetall(_intent_key(intent_id))
+    if not data or data["status"] == FIRED:
+        return False
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_intent_key(intent_id), "status", CANCELLED)
+        pipe.delete(_cred_key(intent_id))
+        pipe.srem(_meal_index_key(data["meal_url"]), intent_id)
+        pipe.srem(INTENTS_KEY, intent_id)
+        await pipe.execute()
+    return True
+
+
+# --- SCATTO ---
+
+def resolve_dishes(dish_ids: List[str], fallbacks: Dict[str, List[str]], meal: Optional[Dict]) -> List[str]:
+    """Piatti da selezionare: i preferiti presenti nel menu e, per ogni categoria
+    rimasta scoperta, la prima alternativa disponibile. Senza menu noto si
+    mandano i preferiti così come sono."""
+    if meal is None:
+        return list(dish_ids)
+    available = {cat: {d["id"] for d in dishes} for cat, dishes in meal["piatti"].items()}
+    chosen = [d for d in dish_ids if any(d in ids for ids in available.values())]
+    for category, options in fallbacks.items():
+        ids = available.get(category, set())
+        if any(d in ids for d in chosen):
+            continue
+        for option in options:
+            if option in ids:
+                chosen.append(option)
+                break
+    return chosen
+
+
+async def _credentials(intent_id: str) -> Optional[tuple[Dict, str]]:
+    data = await redis_client.hgetall(_intent_key(intent_id))
+    token = await redis_client.get(_cred_key(intent_id))
+    if not data or not token or data["status"] in (CANCELLED, FAILED):
+        return None
+    try:
+        return data, unseal(token)
+    except InvalidToken:
+        # Cifrata con un'altra chiave: non tornerà mai leggibile, inutile riprovare
+        print(f"Intenzione {intent_id[:8]}: credenziali non decifrabili, segnata come fallita.")
+        await _fail(intent_id, data["meal_url"], "Credenziali non più leggibili, registra di nuovo la prenotazione")
+        return None
+
+
+async def _fail(intent_id: str, meal_url: str, reason: str):
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_intent_key(intent_id), mapping={"status": FAILED, "reason": reason})
+        pipe.delete(_cred_key(intent_id))
+        pipe.srem(_meal_index_key(meal_url), intent_id)
+        pipe.srem(INTENTS_KEY, intent_id)
+        await pipe.execute()
+
+
+async def prearm(intent_id: str, warm_up: Optional[Callable[[], None]] = None):
+    """Login anticipato: la sessione finisce nella cache e /book non dovrà rifarlo.
+    Con il motore Playwright warm_up() avvia intanto browser e contesti del pool."""
+    if warm_up is not None and settings.BOOKING_ENGINE == "playwright":
+        warm_up()
+    # Senza cache delle sessioni il login andrebbe perso: l'intenzione resta in attesa
+    if not session_cache_enabled():
+        return
+    if not await redis_client.set(_claim_key(intent_id, "arm"), 1, nx=True, ex=settings.INTENT_TTL_SECONDS):
+        return
+    found = await _credentials(intent_id)
+    if found is None:
+        return
+    data, password = found
+    if await load_session(data["username"], password):
+        await redis_client.hset(_intent_key(intent_id), "status", ARMED)
+        return
+    try:
+        async with new_client() as client:
+            await http_login(client, data["username"], password)
+            await save_session(data["username"], password, cookies_from_httpx(client))
+        await redis_client.hset(_intent_key(intent_id), "status", ARMED)
+        print(f"Intenzione {intent_id[:8]}: login anticipato fatto.")
+    except LoginError as e:
+        print(f"Intenzione {intent_id[:8]}: credenziali rifiutate nel login anticipato ({e.message.strip()}).")
+    except Exception as e:
+        # Non è fatale: il login verrà fatto al momento della prenotazione
+        print(f"Intenzione {intent_id[:8]}: login anticipato non riuscito ({e}).")
+
+
+async def fire(intent_id: str, reason: str):
+    """Accoda la prenotazione dell'intenzione (una volta sola, anche tra processi)."""
+    found = await _credentials(intent_id)
+    if found is None:
+        return
+    if not await redis_client.set(_claim_key(intent_id, "fire"), 1, nx=True, ex=settings.INTENT_TTL_SECONDS):
+        return
+    data, password = found
+    try:
+        meal = await menu_store.find_meal_by_url(data["meal_url"], _upcoming_days())
+        dish_ids = resolve_dishes(json.loads(data["dish_ids"]), json.loads(data["fallbacks"]), meal)
+        job = await enqueue_booking(data["username"], password, data["meal_url"], dish_ids)
+    except Exception:
+        # Libera la rivendicazione: il prossimo segnale potrà riprovare
+        await redis_client.delete(_claim_key(intent_id, "fire"))
+        raise
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_intent_key(intent_id), mapping={"status": FIRED, "job_id": job["job_id"], "fired_at": time.time()})
+        pipe.delete(_cred_key(intent_id))
+        pipe.srem(_meal_index_key(data["meal_url"]), intent_id)
+        pipe.srem(INTENTS_KEY, intent_id)
+        await pipe.execute()
+    print(f"Intenzione {intent_id[:8]} partita ({reason}): job {job['job_id']}")
+
+
+async def fire_for_meal(meal_url: str, reason: str):
+    intent_ids = sorted(await redis_client.smembers(_meal_index_key(meal_url)))
+    if intent_ids:
+        print(f"Pasto prenotabile, {len(intent_ids)} intenzioni in partenza: {meal_url}")
+        results = await asyncio.gather(*(fire(intent_id, reason) for intent_id in intent_ids), return_exceptions=True)
+        for intent_id, result in zip(intent_ids, results):
+            if isinstance(result, Exception):
+                print(f"Intenzione {intent_id[:8]}: partenza non riuscita ({result!r}), riproverà al prossimo segnale.")
+
+
+# --- PROGRAMMAZIONE ---
+
+def schedule_intent(scheduler: AsyncIOScheduler, intent: Dict, warm_up: Optional[Callable[[], None]] = None):
+    """Login anticipato (e avvio del browser con warm_up) e scatto all'ora di apertura indicata (se c'è)."""
+    if not intent.get("opens_at"):
+        return
+    opens_at = datetime.fromtimestamp(intent["opens_at"])
+    intent_id = intent["intent_id"]
+    # I login anticipati sono sparsi nella finestra (in modo stabile per intenzione)
+    # invece di partire tutti nello stesso istante
+    spread = 0.25 + 0.75 * (int(intent_id[:8], 16) / 0xFFFFFFFF)
+    arm_at = max(datetime.now(), opens_at - timedelta(seconds=settings.INTENT_PREARM_SECONDS * spread))
+    scheduler.add_job(prearm, DateTrigger(arm_at), args=[intent_id, warm_up], id=f"intent-arm-{intent_id}",
+                      replace_existing=True, misfire_grace_time=None)
+    scheduler.add_job(fire, DateTrigger(max(datetime.now(), opens_at)), args=[intent_id, "orario di apertura"],
+                      id=f"intent-fire-{intent_id}", replace_existing=True, misfire_grace_time=None)
+
+
+def unschedule_intent(scheduler: AsyncIOScheduler, intent_id: str):
+    for job_id in (f"intent-arm-{intent_id}", f"intent-fire-{intent_id}"):
+        if scheduler.get_job(job_id):
+            scheduler.remove_job(job_id)
+
+
+async def restore_intents(scheduler: AsyncIOScheduler, warm_up: Optional[Callable[[], None]] = None):
+    """All'avvio riprogramma le intenzioni ancora in attesa e fa partire quelle
+    il cui pasto è già prenotabile. Non solleva eccezioni: un'intenzione che non si
+    riesce a ripristinare viene saltata (e registrata nel log) senza fermare le altre."""
+    try:
+        intent_ids = await redis_client.smembers(INTENTS_KEY)
+    except Exception as e:
+        print(f"Intenzioni: ripristino non riuscito ({e}).")
+        return
+    for intent_id in intent_ids:
+        try:
+            intent = await get_intent(intent_id)
+            if intent is None or intent["status"] in (FIRED, CANCELLED, FAILED):
+                await redis_client.srem(INTENTS_KEY, intent_id)
+                continue
+            schedule_intent(scheduler, intent, warm_up)
+            await fire_if_bookable(intent)
+        except Exception as e:
+            print(f"Intenzione {intent_id[:8]}: ripristino non riuscito ({e!r}).")
+
+
+async def fire_if_bookable(intent: Dict):
+    meal = await menu_store.find_meal_by_url(intent["meal_url"], _upcoming_days())
+    if meal is not None and meal.get("prenotabile"):
+        await fire(intent["intent_id"], "pasto già prenotabile")
+
+
+async def listen_bookable():
+    """Task di background: fa partire le intenzioni quando lo scraping trova il pasto prenotabile.
+    Un errore (es. Redis momentaneamente irraggiungibile) perde quel segnale, non l'ascolto."""
+    async def on_message(channel: str, meal_url: str):
+        await fire_for_meal(meal_url, "pasto diventato prenotabile")
+
+    await listen_channels([menu_store.BOOKABLE_CHANNEL], on_message, "Intenzioni")
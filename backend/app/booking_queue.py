@@ -0,0 +1,512 @@
+"""Coda di prenotazioni su Redis con stato consultabile.
+
+POST /book accoda un job e risponde subito con il suo id; un pool di worker
+svuota la coda chiamando il normale flusso di prenotazione. Lo stato del job
+(queued/running/succeeded/failed) resta in Redis per BOOKING_JOB_TTL_SECONDS.
+Un job "batch" (POST /book/batch) contiene più pasti dello stesso utente,
+prenotati con un solo login, e tiene l'esito di ciascuno.
+La password viaggia cifrata in una chiave separata, cancellata appena il
+worker prende in carico il job.
+Il worker sposta il job dalla coda a PROCESSING_KEY (BLMOVE) e da lì, in un solo
+script, al lease in RUNNING_KEY prendendo le credenziali: un job non resta mai
+fuori da entrambe. Il lease è rinnovato dal worker e solo chi lo toglie da
+RUNNING_KEY scrive l'esito finale: se il worker viene fermato a metà il job
+fallisce subito, se il processo muore lo segna come fallito il primo processo
+che trova il lease scaduto. In entrambi i casi il pasto torna prenotabile
+dall'utente. Un job rimasto in PROCESSING_KEY (processo morto prima del lease)
+torna in coda con le credenziali intatte.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from cryptography.fernet import Fernet
+
+from app import events
+from app.admission import AdmissionRejected
+from app.metrics import trace_id
+from app.redis_client import redis_client
+from app.settings import settings
+
+QUEUE_KEY = "booking:queue"
+# Job tolti dalla coda da un worker che non ha ancora preso il lease
+PROCESSING_KEY = "booking:processing"
+# job_id -> scadenza del lease dei job in esecuzione
+RUNNING_KEY = "booking:running"
+
+# Lega il pasto al nuovo job solo se è ancora legato a quello letto (concluso):
+# tra richieste concorrenti che ritentano lo stesso pasto ne vince una
+REPLACE_SCRIPT = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('set', KEYS[1], ARGV[2], 'ex', ARGV[3])
+end
+return false
+""")
+
+# Presa in carico: dalla lista di lavorazione al lease, stato "running" e
+# credenziali consumate nello stesso passo. Restituisce il token cifrato ("" se
+# le credenziali sono scadute) o false se il job non è più da eseguire.
+CLAIM_SCRIPT = redis_client.register_script("""
+if redis.call('lrem', KEYS[1], 1, ARGV[1]) == 0 then
+    return false
+end
+if redis.call('exists', KEYS[3]) == 0 then
+    return false
+end
+local token = redis.call('get', KEYS[4])
+redis.call('del', KEYS[4])
+redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+redis.call('hset', KEYS[3], 'status', 'running', 'updated_at', ARGV[3])
+return token or ''
+""")
+
+# Esito finale, scritto solo da chi toglie il job dai lease: il worker (ARGV[2]
+# vuoto) o chi trova il lease scaduto entro ARGV[2]. Libera il conteggio dei job
+# attivi e i pasti (KEYS[4..]) ancora legati al job.
+FINISH_SCRIPT = redis_client.register_script("""
+local deadline = redis.call('zscore', KEYS[1], ARGV[1])
+if not deadline or (ARGV[2] ~= '' and tonumber(deadline) > tonumber(ARGV[2])) then
+    return 0
+end
+redis.call('zrem', KEYS[1], ARGV[1])
+redis.call('hset', KEYS[2], unpack(ARGV, 4))
+if ARGV[3] == '1' then
+    redis.call('decr', KEYS[3])
+end
+for i = 4, #KEYS do
+    if redis.call('get', KEYS[i]) == ARGV[1] then
+        redis.call('del', KEYS[i])
+    end
+end
+return 1
+""")
+
+# Job fermo in lavorazione (worker morto prima del lease): torna in testa alla coda
+REQUEUE_SCRIPT = redis_client.register_script("""
+if redis.call('lrem', KEYS[1], 1, ARGV[1]) == 1 then
+    return redis.call('lpush', KEYS[2], ARGV[1])
+end
+return 0
+""")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+# Pasto di un batch già coperto da un altro job attivo dello stesso utente
+DUPLICATE = "duplicate"
+
+
+class BookingJobError(Exception):
+    """Errore "atteso" di un job (credenziali, portale, ...): diventa il motivo del fallimento."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+# Il worker riceve (username, password, meal_url, dish_ids) e restituisce il messaggio di successo
+BookingHandler = Callable[[str, str, str, List[str]], Awaitable[str]]
+# Il worker dei batch riceve (username, password, items) e restituisce gli item con l'esito
+BatchHandler = Callable[[str, str, List[Dict]], Awaitable[List[Dict]]]
+
+
+@lru_cache(maxsize=1)
+def _cipher() -> Fernet:
+    # Niente chiave generata al volo: varrebbe solo in questo processo, e i job presi
+    # da un altro worker uvicorn o rimasti in coda dopo un riavvio diventerebbero illeggibili
+    if not settings.SESSION_ENCRYPTION_KEY:
+        raise RuntimeError(
+            "SESSION_ENCRYPTION_KEY non impostata: serve a cifrare le password dei job in coda "
+            "(vedi .env.example per generarla)"
+        )
+    return Fernet(settings.SESSION_ENCRYPTION_KEY.encode())
+
+
+def check_cipher():
+    """Controllo all'avvio: senza una chiave valida il backend non parte, invece di
+    accodare job che nessun altro processo saprebbe leggere."""
+    _cipher()
+
+
+def seal(secret: str) -> str:
+    """Cifra una credenziale da lasciare in Redis per un worker."""
+    return _cipher().encrypt(secret.encode()).decode()
+
+
+def unseal(token: str) -> str:
+    return _cipher().decrypt(token.encode()).decode()
+
+
+def _job_key(job_id: str) -> str:
+    return f"booking:job:{job_id}"
+
+
+def _cred_key(job_id: str) -> str:
+    return f"booking:cred:{job_id}"
+
+
+def _active_key(username: str) -> str:
+    return f"booking:active:{hashlib.sha256(username.encode()).hexdigest()}"
+
+
+def _dedup_key(username: str, meal_url: str) -> str:
+    digest = hashlib.sha256(f"{username}|{meal_url}".encode()).hexdigest()
+    return f"booking:dedup:{digest}"
+
+
+async def _claim_meal(username: str, meal_url: str, job_id: str) -> Optional[Dict]:
+    """Lega il pasto al job. Se lo stesso utente ha già un job in coda o in corso
+    per lo stesso pasto restituisce quello. Un job concluso libera il pasto, ma
+    la chiave può restare se il processo muore prima: conta solo se è attivo."""
+    dedup_key = _dedup_key(username, meal_url)
+    ttl = settings.BOOKING_JOB_TTL_SECONDS
+    pending_checks = 20
+    while not await redis_client.set(dedup_key, job_id, nx=True, ex=ttl):
+        existing_id = await redis_client.get(dedup_key)
+        if existing_id is None:
+            continue  # scaduta nel frattempo
+        existing = await get_job(existing_id)
+        if existing is None and pending_checks:
+            # Pasto appena reclamato da una richiesta concorrente che non ha ancora scritto il job
+            pending_checks -= 1
+            await asyncio.sleep(0.05)
+            continue
+        if existing and existing["status"] in (QUEUED, RUNNING):
+            return existing
+        if await REPLACE_SCRIPT(keys=[dedup_key], args=[existing_id, job_id, ttl]):
+            break
+    return None
+
+
+async def _count_active(username: str, max_active: int, meal_urls: List[str]):
+    active_key = _active_key(username)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.incr(active_key)
+        pipe.expire(active_key, settings.BOOKING_JOB_TTL_SECONDS)
+        active, _ = await pipe.execute()
+    if active > max_active:
+        await redis_client.decr(active_key)
+        if meal_urls:
+            await redis_client.delete(*(_dedup_key(username, url) for url in meal_urls))
+        raise AdmissionRejected(
+            f"Hai già {max_active} prenotazioni in corso",
+            max(1, math.ceil(settings.ADMISSION_TARGET_LATENCY_SECONDS)),
+            scope="user",
+        )
+
+
+async def _push_job(job_id: str, password: str, fields: Dict):
+    now = time.time()
+    ttl = settings.BOOKING_JOB_TTL_SECONDS
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(_job_key(job_id), mapping={
+            "job_id": job_id,
+            "status": QUEUED,
+            "created_at": now,
+            "updated_at": now,
+            **fields,
+        })
+        pipe.expire(_job_key(job_id), ttl)
+        pipe.set(_cred_key(job_id), seal(password), ex=ttl)
+        pipe.rpush(QUEUE_KEY, job_id)
+        await pipe.execute()
+
+
+async def enqueue_booking(
+    username: str, password: str, meal_url: str, dish_ids: List[str], max_active: Optional[int] = None
+) -> Dict:
+    """Accoda una prenotazione. Se lo stesso utente ha già un job in coda o in corso
+    per lo stesso pasto, restituisce quello invece di crearne un altro.
+    Con max_active rifiuta (AdmissionRejected) l'utente che ha già troppi job attivi."""
+    job_id = uuid.uuid4().hex
+    existing = await _claim_meal(username, meal_url, job_id)
+    if existing:
+        return existing
+    if max_active is not None:
+        await _count_active(username, max_active, [meal_url])
+
+    await _push_job(job_id, password, {
+        "username": username,
+        "meal_url": meal_url,
+        "dish_ids": json.dumps(dish_ids),
+        "counted": int(max_active is not None),
+    })
+    return await get_job(job_id)
+
+
+async def enqueue_batch(
+    username: str, password: str, items: List[Dict], max_active: Optional[int] = None
+) -> Dict:
+    """Accoda un batch di pasti ({"meal_url", "dish_ids"}) per lo stesso utente: un
+    solo job, un solo login. I pasti già coperti da un altro job attivo restano
+    nel batch come DUPLICATE con l'id di quel job. Il batch conta come un job attivo."""
+    job_id = uuid.uuid4().hex
+    batch = []
+    for item in items:
+        existing = await _claim_meal(username, item["meal_url"], job_id)
+        if existing:
+            batch.append({**item, "status": DUPLICATE, "job_id": existing["job_id"]})
+        else:
+            batch.append({**item, "status": QUEUED})
+    if max_active is not None:
+        await _count_active(username, max_active, [i["meal_url"] for i in batch if i["status"] == QUEUED])
+
+    await _push_job(job_id, password, {
+        "username": username,
+        "meal_url": "",
+        "dish_ids": "[]",
+        "items": json.dumps(batch),
+        "counted": int(max_active is not None),
+    })
+    return await get_job(job_id)
+
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    data = await redis_client.hgetall(_job_key(job_id))
+    if not data:
+        return None
+    job = {
+        "job_id": data["job_id"],
+        "status": data["status"],
+        "meal_url": data["meal_url"],
+        "dish_ids": json.loads(data["dish_ids"]),
+        "created_at": float(data["created_at"]),
+        "updated_at": float(data["updated_at"]),
+        "message": data.get("message"),
+        "reason": data.get("reason"),
+    }
+    if "items" in data:
+        job["items"] = json.loads(data["items"])
+    return job
+
+
+async def queue_depth() -> int:
+    return await redis_client.llen(QUEUE_KEY)
+
+
+def _emit_status(job_id: str, status: str, fields: Dict):
+    if "items" in fields:
+        fields = {**fields, "items": json.loads(fields["items"])}
+    events.emit_job_event(job_id, {"type": "status", "job_id": job_id, "status": status, **fields})
+
+
+async def _finish(
+    job_id: str, data: Dict, status: str, release: List[str], expired_by: Optional[float] = None, **fields
+) -> bool:
+    """Scrive l'esito finale se il job è ancora nei lease (con expired_by: solo se
+    il lease è scaduto entro quell'istante). Libera i pasti in release ancora legati
+    al job. False se l'esito l'ha già scritto qualcun altro (lease reclamato)."""
+    mapping = {"status": status, "updated_at": time.time(), **fields}
+    args = [job_id, "" if expired_by is None else expired_by, data.get("counted", "0")]
+    for name, value in mapping.items():
+        args += [name, value]
+    finished = await FINISH_SCRIPT(
+        keys=[
+            RUNNING_KEY, _job_key(job_id), _active_key(data["username"]),
+            *(_dedup_key(data["username"], url) for url in release),
+        ],
+        args=args,
+    )
+    if finished:
+        _emit_status(job_id, status, fields)
+    return bool(finished)
+
+
+async def _run_job(job_id: str, handler: BookingHandler, batch_handler: Optional[BatchHandler] = None):
+    lease = settings.BOOKING_JOB_LEASE_SECONDS
+    now = time.time()
+    token = await CLAIM_SCRIPT(
+        keys=[PROCESSING_KEY, RUNNING_KEY, _job_key(job_id), _cred_key(job_id)],
+        args=[job_id, now + lease, now],
+    )
+    if token is None:
+        print(f"Job {job_id} scaduto o già ripreso, ignorato.")
+        return
+    data = await redis_client.hgetall(_job_key(job_id))
+    if not token:
+        print(f"Job {job_id} senza credenziali, ignorato.")
+        await _finish(job_id, data, FAILED, _pending_urls(data), reason="Job scaduto prima dell'esecuzione")
+        return
+    _emit_status(job_id, RUNNING, {})
+
+    try:
+        async with _leased(job_id):
+            if "items" in data:
+                await _run_batch_handler(job_id, data, token, batch_handler)
+            else:
+                await _run_handler(job_id, data, token, handler)
+    except asyncio.CancelledError:
+        # Worker fermato (spegnimento, riavvio): il job non deve restare "running"
+        # bloccando il pasto fino alla scadenza
+        print(f"Job {job_id} interrotto, segnato come fallito.")
+        try:
+            await _abandon(job_id, data, "Prenotazione interrotta dal riavvio del server, riprova")
+        except Exception as e:
+            print(f"Job {job_id}: stato non aggiornato ({e})")
+        raise
+
+
+@asynccontextmanager
+async def _leased(job_id: str):
+    """Rinnova il lease del job finché il worker ci lavora."""
+    lease = settings.BOOKING_JOB_LEASE_SECONDS
+
+    async def renew():
+        while True:
+            await asyncio.sleep(lease / 3)
+            try:
+                # xx: un lease già reclamato non viene ricreato
+                await redis_client.zadd(RUNNING_KEY, {job_id: time.time() + lease}, xx=True)
+            except Exception as e:
+                print(f"Job {job_id}: rinnovo del lease non riuscito ({e})")
+
+    renewer = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewer.cancel()
+
+
+def _pending_urls(data: Dict) -> List[str]:
+    """Pasti del job non ancora prenotati (per un batch: quelli non DUPLICATE)."""
+    if "items" in data:
+        return [item["meal_url"] for item in json.loads(data["items"]) if item["status"] == QUEUED]
+    return [data["meal_url"]]
+
+
+async def _abandon(job_id: str, data: Dict, reason: str, expired_by: Optional[float] = None) -> bool:
+    """Job lasciato a metà: fallito, con i pasti di nuovo prenotabili dall'utente."""
+    fields = {}
+    if "items" in data:
+        fields["items"] = json.dumps([
+            {**item, "status": FAILED, "reason": reason} if item["status"] == QUEUED else item
+            for item in json.loads(data["items"])
+        ])
+    return await _finish(job_id, data, FAILED, _pending_urls(data), expired_by, reason=reason, **fields)
+
+
+# Job visti in PROCESSING_KEY al controllo precedente
+_stuck: set = set()
+
+
+async def reclaim_stale_jobs() -> int:
+    """Segna come falliti i job il cui lease è scaduto (worker morto durante
+    l'esecuzione) e rimette in coda quelli fermi in lavorazione da un intero
+    controllo (worker morto tra BLMOVE e lease)."""
+    global _stuck
+    now = time.time()
+    reclaimed = 0
+    for job_id in await redis_client.zrangebyscore(RUNNING_KEY, "-inf", now):
+        data = await redis_client.hgetall(_job_key(job_id))
+        if not data:
+            await redis_client.zrem(RUNNING_KEY, job_id)
+            continue
+        if await _abandon(job_id, data, "Prenotazione interrotta (worker terminato), riprova", expired_by=now):
+            print(f"Job {job_id}: lease scaduto, worker terminato durante l'esecuzione.")
+            reclaimed += 1
+
+    processing = set(await redis_client.lrange(PROCESSING_KEY, 0, -1))
+    for job_id in processing & _stuck:
+        if await REQUEUE_SCRIPT(keys=[PROCESSING_KEY, QUEUE_KEY], args=[job_id]):
+            print(f"Job {job_id}: fermo in lavorazione, rimesso in coda.")
+            reclaimed += 1
+    # Quelli visti ora per la prima volta: se al prossimo controllo sono ancora lì tornano in coda
+    _stuck = processing - _stuck
+    return reclaimed
+
+
+async def _reclaimer():
+    while True:
+        await asyncio.sleep(settings.BOOKING_JOB_LEASE_SECONDS / 3)
+        try:
+            await reclaim_stale_jobs()
+        except Exception as e:
+            print(f"Coda prenotazioni: controllo dei lease non riuscito ({e})")
+
+
+async def _run_handler(job_id: str, data: Dict, token: str, handler: BookingHandler):
+    try:
+        password = unseal(token)
+        message = await handler(data["username"], password, data["meal_url"], json.loads(data["dish_ids"]))
+    except BookingJobError as e:
+        await _finish(job_id, data, FAILED, [data["meal_url"]], reason=e.reason)
+    except Exception as e:
+        print(f"Job {job_id}: eccezione non gestita: {e}")
+        await _finish(job_id, data, FAILED, [data["meal_url"]], reason=str(e) or type(e).__name__)
+    else:
+        await _finish(job_id, data, SUCCEEDED, [data["meal_url"]], message=message)
+
+
+async def _run_batch_handler(job_id: str, data: Dict, token: str, batch_handler: Optional[BatchHandler]):
+    items = json.loads(data["items"])
+    todo = [item for item in items if item["status"] == QUEUED]
+    try:
+        if batch_handler is None:
+            raise BookingJobError("Prenotazioni multiple non supportate da questo worker")
+        results = iter(await batch_handler(data["username"], unseal(token), todo) if todo else [])
+    except Exception as e:
+        reason = e.reason if isinstance(e, BookingJobError) else (str(e) or type(e).__name__)
+        if not isinstance(e, BookingJobError):
+            print(f"Job {job_id}: eccezione non gestita: {e}")
+        results = iter([{**item, "status": FAILED, "reason": reason} for item in todo])
+
+    items = [next(results) if item["status"] == QUEUED else item for item in items]
+    failed = [item for item in items if item["status"] == FAILED]
+    todo_urls = [item["meal_url"] for item in todo]
+    fields = {"items": json.dumps(items)}
+    if failed:
+        await _finish(
+            job_id, data, FAILED, todo_urls,
+            reason=f"{len(failed)} prenotazioni su {len(items)} non riuscite", **fields,
+        )
+    else:
+        await _finish(job_id, data, SUCCEEDED, todo_urls, message="Prenotazioni effettuate con successo", **fields)
+
+
+async def _worker(worker_id: int, handler: BookingHandler, batch_handler: Optional[BatchHandler]):
+    while True:
+        try:
+            # Il job resta in PROCESSING_KEY finché lo script di presa in carico non lo mette nei lease
+            job_id = await redis_client.blmove(QUEUE_KEY, PROCESSING_KEY, 5, "LEFT", "RIGHT")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Worker prenotazioni {worker_id}: errore Redis {e}, riprovo...")
+            await asyncio.sleep(1)
+            continue
+        if job_id:
+            # Le righe di log del job portano il suo id (con LOG_TRACE_IDS)
+            token = trace_id.set(job_id[:12])
+            # Gli step della prenotazione vengono pubblicati sullo stream del job
+            job_token = events.current_job.set(job_id)
+            try:
+                await _run_job(job_id, handler, batch_handler)
+            except Exception as e:
+                # Esito non scritto (Redis irraggiungibile): il lease scade e il job lo chiude il controllo dei lease
+                print(f"Worker prenotazioni {worker_id}: job {job_id} non concluso ({e})")
+            finally:
+                events.current_job.reset(job_token)
+                trace_id.reset(token)
+
+
+def start_workers(
+    handler: BookingHandler, count: int, batch_handler: Optional[BatchHandler] = None
+) -> List[asyncio.Task]:
+    print(f"Avvio {count} worker per la coda prenotazioni.")
+    tasks = [asyncio.create_task(_worker(i, handler, batch_handler)) for i in range(count)]
+    # Job rimasti "running" da processi morti
+    tasks.append(asyncio.create_task(_reclaimer()))
+    return tasks
+
+
+async def stop_workers(tasks: List[asyncio.Task]):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,283 @@
+"""Browser Playwright avviato al primo uso e riciclato quando serve.
+
+Prima ogni processo lanciava Chromium in lifespan, anche quando con il motore
+HTTP non serviva mai e anche nei worker che non fanno scraping. Ora il browser
+(e il pool di contesti per le prenotazioni) parte alla prima richiesta che ne ha
+bisogno, oppure prima, con warm_up(), quando sta per arrivare lavoro (job di
+prenotazione accodato, inizio di una fascia di prenotazione). Avvii
+concorrenti aspettano lo stesso lancio invece di aprirne due.
+
+Un browser acceso per giorni accumula memoria nei renderer. Il supervisore lo
+riavvia dopo recycle_after_contexts contesti creati o quando i processi
+Chromium superano recycle_rss_mb: aspetta un momento senza lavoro in corso e,
+se non arriva entro drain_timeout, smette di dare il browser a operazioni nuove,
+aspetta quelle in corso (al massimo drain_timeout) e lo sostituisce. Scraping e
+prenotazioni passano da lease()/checkout(), così si sa sempre chi lo sta
+usando. Se il browser muore (crash, OOM) viene rilanciato subito.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright
+
+from app.browser_pool import ContextPool
+from app.metrics import BROWSER_RESTARTS, chromium_rss_bytes
+
+
+class BrowserManager:
+    def __init__(
+        self,
+        pool_options: Dict,
+        launch_options: Optional[Dict] = None,
+        recycle_after_contexts: int = 0,
+        recycle_rss_mb: int = 0,
+        drain_timeout: float = 120.0,
+        check_seconds: float = 30.0,
+    ):
+        self.pool_options = pool_options
+        # headless=True per il server
+        self.launch_options = launch_options or {"headless": True}
+        self.recycle_after_contexts = recycle_after_contexts
+        self.recycle_rss_bytes = recycle_rss_mb * 1024 * 1024
+        self.drain_timeout = drain_timeout
+        self.check_seconds = check_seconds
+
+        self._playwright: Optional[Playwright] = None
+        self._browser: Optional[Browser] = None
+        self._pool: Optional[ContextPool] = None
+        self._lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self._supervisor: Optional[asyncio.Task] = None
+
+        # Operazioni che stanno usando il browser e stato del riciclo
+        self._in_use = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._accepting = asyncio.Event()
+        self._accepting.set()
+        self._recycle_reason: Optional[str] = None
+        self._recycle_since = 0.0
+        self._direct_contexts = 0
+
+        # Statistiche
+        self.generation = 0
+        self.restarts: Dict[str, int] = {}
+
+    @property
+    def launched(self) -> bool:
+        return self._browser is not None
+
+    @property
+    def pool_if_started(self) -> Optional[ContextPool]:
+        return self._pool
+
+    @property
+    def contexts_created(self) -> int:
+        """Contesti aperti sul browser attuale: quelli del pool più quelli dello scraping."""
+        return (self._pool.created if self._pool else 0) + self._direct_contexts
+
+    async def _launch(self):
+        print("Avvio Browser Playwright Global...")
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        browser = None
+        try:
+            browser = await self._playwright.chromium.launch(**self.launch_options)
+            pool = ContextPool(browser, **self.pool_options)
+            await pool.start()
+        except Exception:
+            if browser:
+                await browser.close()
+            await self._playwright.stop()
+            self._playwright = None
+            raise
+        browser.on("disconnected", self._on_disconnected)
+        self._browser, self._pool = browser, pool
+        self._direct_contexts = 0
+        self.generation += 1
+        if self._supervisor is None and (self.recycle_after_contexts or self.recycle_rss_bytes):
+            self._supervisor = asyncio.create_task(self._supervise())
+        print(f"Browser Globale Pronto (avvio n. {self.generation}).")
+
+    async def _ensure(self):
+        if self._pool is not None:
+            return
+        async with self._lock:
+            if self._pool is None:
+                await self._launch()
+
+    async def _close_browser(self):
+        """Chiude pool e browser attuali (Playwright resta avviato per il prossimo)."""
+        browser, pool = self._browser, self._pool
+        # Azzerati prima della chiusura: il "disconnected" che segue non è un crash
+        self._browser = self._pool = None
+        if pool:
+            await pool.close()
+        if browser:
+            print("Chiusura Browser Globale...")
+            try:
+                await browser.close()
+            except Exception as e:
+                print(f"Browser: errore in chiusura ({e}).")
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # --- USO DEL BROWSER ---
+
+    async def start(self):
+        """Avvia il browser se non è già partito (gli errori di avvio arrivano al chiamante)."""
+        await self._ensure()
+
+    @asynccontextmanager
+    async def _use(self) -> AsyncIterator[None]:
+        # Durante un riciclo si aspetta il browser nuovo invece di prendere quello uscente
+        while True:
+            await self._accepting.wait()
+            await self._ensure()
+            if self._accepting.is_set() and self._pool is not None:
+                break
+        self._in_use += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._in_use -= 1
+            if self._in_use == 0:
+                self._idle.set()
+                if self._recycle_reason and self._accepting.is_set():
+                    # Riciclo in attesa: questo è il momento di inattività che aspettava
+                    self._spawn(self.recycle(self._recycle_reason))
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[Browser]:
+        """Il browser per un'operazione che apre i suoi contesti (scraping)."""
+        async with self._use():
+            self._direct_contexts += 1
+            yield self._browser
+
+    @asynccontextmanager
+    async def checkout(self) -> AsyncIterator[tuple[BrowserContext, Page]]:
+        """Un contesto caldo del pool per una prenotazione."""
+        async with self._use():
+            async with self._pool.checkout() as (context, page):
+                yield context, page
+
+    def warm_up(self):
+        """Avvia il browser in background, senza far aspettare il chiamante."""
+        if self._pool is not None or self._tasks:
+            return
+
+        async def run():
+            try:
+                await self._ensure()
+            except Exception as e:
+                print(f"Browser: avvio anticipato non riuscito ({e}), riproverò al primo uso.")
+
+        self._spawn(run())
+
+    # --- RICICLO E SUPERVISIONE ---
+
+    def _count_restart(self, reason: str):
+        BROWSER_RESTARTS.inc(reason=reason)
+        self.restarts[reason] = self.restarts.get(reason, 0) + 1
+
+    async def recycle(self, reason: str):
+        """Riavvio ordinato: niente operazioni nuove, attesa di quelle in corso
+        (al massimo drain_timeout), chiusura e avvio del browser nuovo."""
+        if not self._accepting.is_set():
+            return
+        self._accepting.clear()
+        try:
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                print(f"Browser: {self._in_use} operazioni ancora in corso dopo {self.drain_timeout:.0f}s, chiudo comunque.")
+            print(f"Browser: riavvio ({reason}) dopo {self.contexts_created} contesti.")
+            async with self._lock:
+                await self._close_browser()
+                self._count_restart(reason)
+                self._recycle_reason = None
+                try:
+                    # Subito, non al primo uso: chi aspetta riparte appena il browser è pronto
+                    await self._launch()
+                except Exception as e:
+                    print(f"Browser: riavvio non riuscito ({e}), riproverò al primo uso.")
+        finally:
+            self._accepting.set()
+
+    def _on_disconnected(self, browser: Browser):
+        if browser is not self._browser:
+            return  # chiusura voluta (riciclo o spegnimento)
+        print("Browser: Chromium terminato inaspettatamente, lo riavvio.")
+        self._count_restart("crash")
+
+        async def restart():
+            try:
+                async with self._lock:
+                    if self._browser is browser:
+                        await self._close_browser()
+                    if self._pool is None:
+                        await self._launch()
+            except Exception as e:
+                print(f"Browser: riavvio dopo il crash non riuscito ({e}), riproverò al primo uso.")
+
+        self._spawn(restart())
+
+    async def _recycle_needed(self) -> Optional[str]:
+        if self.recycle_after_contexts and self.contexts_created >= self.recycle_after_contexts:
+            return "contexts"
+        if self.recycle_rss_bytes:
+            rss = await asyncio.to_thread(chromium_rss_bytes, os.getpid())
+            if rss > self.recycle_rss_bytes:
+                return "rss"
+        return None
+
+    async def _supervise(self):
+        """Task di background: controlla le soglie e programma il riciclo."""
+        while True:
+            await asyncio.sleep(self.check_seconds)
+            if self._browser is None or not self._accepting.is_set():
+                continue
+            try:
+                reason = await self._recycle_needed()
+            except Exception as e:
+                print(f"Browser: controllo memoria non riuscito ({e}).")
+                continue
+            if reason is None:
+                continue
+            if self._recycle_reason is None:
+                self._recycle_reason, self._recycle_since = reason, time.monotonic()
+                print(f"Browser: riavvio necessario ({reason}), aspetto che sia inattivo.")
+            # Senza un momento di inattività entro drain_timeout si drena comunque
+            if self._in_use == 0 or time.monotonic() - self._recycle_since > self.drain_timeout:
+                self._spawn(self.recycle(self._recycle_reason))
+
+    def stats(self) -> Dict:
+        return {
+            "launched": self.launched,
+            "generation": self.generation,
+            "in_use": self._in_use,
+            "contexts_created": self.contexts_created,
+            "recycle_pending": self._recycle_reason,
+            "draining": not self._accepting.is_set(),
+            "restarts": self.restarts,
+            "launch_args": self.launch_options.get("args", []),
+        }
+
+    async def close(self):
+        if self._supervisor:
+            self._supervisor.cancel()
+            self._supervisor = None
+        for task in list(self._tasks):
+            task.cancel()
+        async with self._lock:
+            await self._close_browser()
+            if self._playwright:
+                await self._playwright.stop()
+            self._playwright = None
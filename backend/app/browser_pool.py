@@ -0,0 +1,177 @@
+"""Pool di contesti Playwright già pronti per le prenotazioni.
+
+Creare un contesto + pagina costa parecchio proprio nel momento peggiore
+(apertura prenotazioni). Il pool ne tiene N caldi sul browser globale, li pulisce
+tra un utente e l'altro (cookie, storage, pagine extra) e li ricicla dopo K usi
+o se l'heap JS cresce troppo.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+from playwright.async_api import Browser, BrowserContext, Page
+
+HEAP_SCRIPT = "() => (performance.memory ? performance.memory.usedJSHeapSize : 0)"
+CLEAR_STORAGE_SCRIPT = "() => { try { localStorage.clear(); sessionStorage.clear(); } catch (e) {} }"
+
+
+class PooledContext:
+    def __init__(self, context: BrowserContext, page: Page):
+        self.context = context
+        self.page = page
+        self.uses = 0
+
+
+class ContextPool:
+    def __init__(
+        self,
+        browser: Browser,
+        size: int,
+        max_uses: int,
+        max_heap_mb: int,
+        context_options: Optional[Dict] = None,
+        context_setup: Optional[Callable[[BrowserContext], Awaitable[None]]] = None,
+    ):
+        self.browser = browser
+        self.size = size
+        self.max_uses = max_uses
+        self.max_heap_bytes = max_heap_mb * 1024 * 1024
+        self.context_options = context_options or {}
+        # Chiamato su ogni contesto nuovo (es. profilo di intercettazione delle richieste)
+        self.context_setup = context_setup
+
+        self._idle: asyncio.Queue[PooledContext] = asyncio.Queue()
+        self._live = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._closed = False
+
+        # Statistiche
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _create(self) -> PooledContext:
+        self._live += 1
+        try:
+            context = await self.browser.new_context(**self.context_options)
+            if self.context_setup:
+                await self.context_setup(context)
+            page = await context.new_page()
+        except Exception:
+            self._live -= 1
+            raise
+        self.created += 1
+        return PooledContext(context, page)
+
+    async def _discard(self, entry: PooledContext):
+        self._live -= 1
+        self.recycled += 1
+        try:
+            await entry.context.close()
+        except Exception as e:
+            print(f"Pool: errore chiusura contesto: {e}")
+
+    async def start(self):
+        """Riempie il pool prima di accettare richieste."""
+        entries = await asyncio.gather(*(self._create() for _ in range(self.size)))
+        for entry in entries:
+            self._idle.put_nowait(entry)
+        print(f"Pool contesti pronto ({self.size} contesti caldi).")
+
+    async def close(self):
+        self._closed = True
+        for task in list(self._tasks):
+            task.cancel()
+        while not self._idle.empty():
+            await self._discard(self._idle.get_nowait())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _acquire(self) -> PooledContext:
+        try:
+            entry = self._idle.get_nowait()
+            self.hits += 1
+            return entry
+        except asyncio.QueueEmpty:
+            pass
+
+        self.misses += 1
+        if self._live < self.size:
+            return await self._create()
+        return await self._idle.get()
+
+    @asynccontextmanager
+    async def checkout(self) -> AsyncIterator[tuple[BrowserContext, Page]]:
+        start = time.perf_counter()
+        entry = await self._acquire()
+        waited = time.perf_counter() - start
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        entry.uses += 1
+        broken = False
+        try:
+            yield entry.context, entry.page
+        except BaseException:
+            broken = entry.page.is_closed()
+            raise
+        finally:
+            # La pulizia avviene fuori dal percorso della richiesta
+            self._spawn(self._release(entry, broken))
+
+    async def _release(self, entry: PooledContext, broken: bool):
+        if self._closed:
+            await self._discard(entry)
+            return
+        try:
+            recycle = broken or entry.uses >= self.max_uses
+            if not recycle:
+                heap = await entry.page.evaluate(HEAP_SCRIPT)
+                recycle = heap > self.max_heap_bytes
+            if not recycle:
+                await self._reset(entry)
+                self._idle.put_nowait(entry)
+                return
+        except Exception as e:
+            print(f"Pool: contesto non riutilizzabile ({e}), lo ricreo.")
+
+        await self._discard(entry)
+        try:
+            self._idle.put_nowait(await self._create())
+        except Exception as e:
+            print(f"Pool: impossibile ricreare il contesto: {e}")
+
+    async def _reset(self, entry: PooledContext):
+        """Isola l'utente successivo: niente cookie, storage o pagine rimaste aperte."""
+        for page in entry.context.pages:
+            if page is not entry.page:
+                await page.close()
+        await entry.page.unroute_all(behavior="ignoreErrors")
+        if entry.page.url.startswith("http"):
+            await entry.page.evaluate(CLEAR_STORAGE_SCRIPT)
+        await entry.context.clear_cookies()
+        await entry.context.clear_permissions()
+        await entry.page.goto("about:blank")
+
+    def stats(self) -> Dict:
+        return {
+            "size": self.size,
+            "live": self._live,
+            "idle": self._idle.qsize(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "created": self.created,
+            "recycled": self.recycled,
+            "checkouts": self.checkouts,
+            "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+        }
@@ -0,0 +1,45 @@
+"""Profilo di avvio di Chromium per il server.
+
+chromium.launch(headless=True) con i default va bene su un portatile; sul
+server il browser resta acceso per giorni accanto al backend e conta ogni MB.
+Il profilo, configurato nei settings BROWSER_*, aggiunge ai flag di Playwright:
+  - GPU ed estensioni disattivate (niente processo GPU né SwiftShader);
+  - con BROWSER_LOW_MEMORY niente processi di renderer separati per sito e un
+    tetto all'heap V8 di ogni renderer (BROWSER_JS_HEAP_MB);
+  - BROWSER_RENDERER_PROCESS_LIMIT per limitare i processi di renderer;
+  - con BROWSER_SINGLE_PROCESS un solo processo per browser e renderer: la RAM
+    più bassa, ma un renderer che va in crash si porta dietro tutto il browser
+    (il supervisore di BrowserManager lo riavvia).
+Senza BROWSER_CHANNEL Playwright in headless usa già chromium-headless-shell,
+più leggero del Chromium completo; "chromium" passa al nuovo headless.
+Niente --disable-features qui: Chromium tiene solo l'ultimo e Playwright passa
+già il suo.
+"""
+from typing import Dict, List
+
+from app.settings import settings
+
+BASE_ARGS = ["--disable-gpu", "--disable-software-rasterizer", "--disable-extensions"]
+LOW_MEMORY_ARGS = ["--disable-site-isolation-trials"]
+SINGLE_PROCESS_ARGS = ["--single-process", "--no-zygote"]
+
+
+def launch_args() -> List[str]:
+    args = list(BASE_ARGS)
+    if settings.BROWSER_LOW_MEMORY:
+        args += LOW_MEMORY_ARGS
+        if settings.BROWSER_JS_HEAP_MB:
+            args.append(f"--js-flags=--max-old-space-size={settings.BROWSER_JS_HEAP_MB}")
+    if settings.BROWSER_RENDERER_PROCESS_LIMIT:
+        args.append(f"--renderer-process-limit={settings.BROWSER_RENDERER_PROCESS_LIMIT}")
+    if settings.BROWSER_SINGLE_PROCESS:
+        args += SINGLE_PROCESS_ARGS
+    return args + settings.BROWSER_EXTRA_ARGS
+
+
+def launch_options() -> Dict:
+    """Argomenti per chromium.launch() (browser globale, scraping da script, benchmark)."""
+    options = {"headless": True, "args": launch_args()}
+    if settings.BROWSER_CHANNEL:
+        options["channel"] = settings.BROWSER_CHANNEL
+    return options
@@ -0,0 +1,141 @@
+"""Eventi in push (Server-Sent Events) per menu e avanzamento delle prenotazioni.
+
+Invece del polling su /menu/today e /book/{job_id} il client apre uno stream
+SSE e riceve gli eventi appena succedono:
+  - "menu": menu_changed quando lo scraping scrive nuovi dati per un giorno
+    (stesso messaggio di MENU_INVALIDATE_CHANNEL) e bookable quando un pasto
+    diventa prenotabile (BOOKABLE_CHANNEL);
+  - "job:{job_id}": cambi di stato del job e step della prenotazione in corso,
+    pubblicati su PROGRESS_CHANNEL dal worker che la esegue.
+Ogni processo ha una sola sottoscrizione Redis (listen) e smista i messaggi
+alle code in memoria delle connessioni aperte: una connessione inattiva costa
+una coda e una coroutine ferma, non una connessione Redis.
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, Optional, Set
+
+from app import menu_store
+from app.menu_cache import ALL_KEYS, MENU_INVALIDATE_CHANNEL
+from app.metrics import EVENT_STREAMS
+from app.redis_client import listen_channels, redis_client
+from app.settings import settings
+
+PROGRESS_CHANNEL = "booking:progress"
+MENU_TOPIC = "menu"
+
+# Job di prenotazione in esecuzione in questo task (impostato dal worker della coda)
+current_job: ContextVar[Optional[str]] = ContextVar("current_job", default=None)
+
+_subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+_tail: Optional[asyncio.Task] = None
+
+
+def job_topic(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+# --- PUBBLICAZIONE ---
+
+def emit_job_event(job_id: str, event: Dict):
+    """Pubblica un evento del job senza far aspettare il chiamante. Le pubblicazioni
+    sono concatenate, così gli step arrivano nell'ordine in cui sono avvenuti."""
+    global _tail
+    previous = _tail
+    payload = json.dumps({"topic": job_topic(job_id), "event": {**event, "ts": time.time()}})
+
+    async def run():
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await redis_client.publish(PROGRESS_CHANNEL, payload)
+        except Exception as e:
+            print(f"Eventi: pubblicazione non riuscita ({e})")
+
+    _tail = asyncio.create_task(run())
+
+
+def report_step(step: str, **info):
+    """Step della prenotazione in corso, se il task sta eseguendo un job della coda."""
+    job_id = current_job.get()
+    if job_id is not None:
+        emit_job_event(job_id, {"type": "step", "step": step, **info})
+
+
+# --- SMISTAMENTO ---
+
+def _dispatch(topic: str, event: Dict):
+    for queue in _subscribers.get(topic, ()):
+        if queue.full():
+            # Client lento: si perde l'evento più vecchio, non si blocca lo smistamento
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+
+@contextmanager
+def subscribe(topic: str) -> Iterator[asyncio.Queue]:
+    queue: asyncio.Queue = asyncio.Queue(maxsize=settings.EVENTS_QUEUE_SIZE)
+    _subscribers[topic].add(queue)
+    kind = topic.partition(":")[0]
+    EVENT_STREAMS.inc(topic=kind)
+    try:
+        yield queue
+    finally:
+        EVENT_STREAMS.dec(topic=kind)
+        _subscribers[topic].discard(queue)
+        if not _subscribers[topic]:
+            del _subscribers[topic]
+
+
+def _on_message(channel: str, data: str):
+    if channel == PROGRESS_CHANNEL:
+        message = json.loads(data)
+        _dispatch(message["topic"], message["event"])
+    elif channel == MENU_INVALIDATE_CHANNEL:
+        _dispatch(MENU_TOPIC, {"type": "menu_changed", "date": None if data == ALL_KEYS else data})
+    elif channel == menu_store.BOOKABLE_CHANNEL:
+        _dispatch(MENU_TOPIC, {"type": "bookable", "meal_url": data})
+
+
+async def listen():
+    """Task di background: una sottoscrizione Redis per processo, smistata alle connessioni SSE."""
+    async def on_message(channel: str, data: str):
+        _on_message(channel, data)
+
+    await listen_channels(
+        [PROGRESS_CHANNEL, MENU_INVALIDATE_CHANNEL, menu_store.BOOKABLE_CHANNEL], on_message, "Eventi"
+    )
+
+
+# --- STREAM SSE ---
+
+def format_sse(event: Dict) -> str:
+    return f"event: {event.get('type', 'message')}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+async def stream(
+    queue: asyncio.Queue,
+    initial: Iterable[Dict] = (),
+    until: Callable[[Dict], bool] = lambda event: False,
+) -> AsyncIterator[str]:
+    """Corpo della risposta text/event-stream: eventi iniziali, poi quelli della coda
+    fino a until(evento), con un commento di keep-alive se non succede nulla."""
+    # Se la connessione cade il browser riprova dopo 5 secondi
+    yield "retry: 5000\n\n"
+    for event in initial:
+        yield format_sse(event)
+        if until(event):
+            return
+    while True:
+        try:
+            event = await asyncio.wait_for(queue.get(), timeout=settings.EVENTS_HEARTBEAT_SECONDS)
+        except asyncio.TimeoutError:
+            yield ": keep-alive\n\n"
+            continue
+        yield format_sse(event)
+        if until(event):
+            return
@@ -0,0 +1,254 @@
+"""Motore di prenotazione via HTTP puro: stesso flusso di book_meal ma senza browser.
+
+Il webform Drupal viene compilato leggendo i campi nascosti (form_build_id,
+form_token, form_id) dalla pagina e rimandandoli con i valori scelti, un passo
+alla volta, fino al click su "Invia".
+"""
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Set
+from urllib.parse import urljoin
+
+import httpx
+from bs4 import BeautifulSoup, Tag
+
+from app.events import report_step
+from app.metrics import BOOKING_STEP_SECONDS
+from app.scraper import LOGIN_URL, USER_AGENT, SessionExpiredError
+from app.settings import settings
+from app.upstream import UpstreamError, UpstreamUnavailable, check_status, portal
+
+# Numero massimo di POST sul webform prima di arrendersi (evita loop infiniti)
+MAX_FORM_STEPS = 6
+
+VUOI_PRENOTARE = "#edit-vuoi-prenotare"
+TIPOLOGIA_STANDARD = "#edit-tipologia-menu-standard"
+SUBMIT_TYPES = {"submit", "image"}
+
+
+class LoginError(Exception):
+    """Credenziali rifiutate dal portale."""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+
+
+class HttpBookingError(Exception):
+    """Il form non ha la struttura attesa: si può ripiegare su Playwright.
+    Gli errori di rete e i 5xx diventano invece UpstreamUnavailable: col portale
+    giù anche il browser fallirebbe, e dopo "Invia" ritentare può prenotare due volte."""
+
+
+def new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        headers={"User-Agent": USER_AGENT},
+        follow_redirects=True,
+        timeout=settings.BOOKING_HTTP_TIMEOUT,
+    )
+
+
+# --- UTILITY FORM ---
+
+def serialize_form(form: Tag) -> List[tuple[str, str]]:
+    """Riproduce i campi che il browser invierebbe (esclusi i bottoni)."""
+    fields = []
+    for el in form.find_all(["input", "select", "textarea"]):
+        name = el.get("name")
+        if not name or el.has_attr("disabled"):
+            continue
+
+        if el.name == "input":
+            input_type = (el.get("type") or "text").lower()
+            if input_type in SUBMIT_TYPES or input_type in ("button", "reset", "file"):
+                continue
+            if input_type in ("checkbox", "radio"):
+                if el.has_attr("checked"):
+                    fields.append((name, el.get("value", "on")))
+                continue
+            fields.append((name, el.get("value", "")))
+        elif el.name == "select":
+            selected = el.find_all("option", selected=True) or el.find_all("option")[:1]
+            for opt in selected:
+                fields.append((name, opt.get("value", opt.get_text())))
+        else:
+            fields.append((name, el.get_text()))
+    return fields
+
+
+def find_button(form: Tag, selector: str) -> Optional[Tag]:
+    """Restituisce il bottone solo se è un vero submit (non un bottone JS)."""
+    btn = form.select_one(selector)
+    if btn is None:
+        return None
+    btn_type = (btn.get("type") or ("submit" if btn.name == "button" else "text")).lower()
+    return btn if btn_type in SUBMIT_TYPES else None
+
+
+async def submit_form(
+    client: httpx.AsyncClient,
+    page_url: str,
+    form: Tag,
+    overrides: Dict[str, str],
+    button: Optional[Tag],
+) -> httpx.Response:
+    data = [(k, v) for k, v in serialize_form(form) if k not in overrides]
+    data.extend(overrides.items())
+    if button is not None and button.get("name"):
+        data.append((button["name"], button.get("value", "")))
+
+    payload: Dict[str, List[str]] = {}
+    for k, v in data:
+        payload.setdefault(k, []).append(v)
+
+    action = urljoin(page_url, form.get("action") or page_url)
+    return await client.post(action, data=payload)
+
+
+def page_errors(soup: BeautifulSoup) -> List[str]:
+    return [el.get_text(" ", strip=True) for el in soup.select(".messages.error, .alert-danger")]
+
+
+@contextmanager
+def _portal_errors() -> Iterator[None]:
+    """Rete o 5xx: il portale non risponde, non è un form da ripiegare su Playwright."""
+    try:
+        yield
+    except (httpx.HTTPError, UpstreamError) as e:
+        print(f"HTTP: portale non raggiungibile ({e})")
+        raise UpstreamUnavailable(settings.UPSTREAM_OPEN_SECONDS) from e
+
+
+async def get_checked(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    """GET sotto il circuit breaker, ritentata se il portale non risponde (5xx inclusi)."""
+    async def fetch():
+        resp = await client.get(url)
+        check_status(resp.status_code, url)
+        return resp
+    with _portal_errors():
+        return await portal.call(fetch)
+
+
+async def submit_checked(client: httpx.AsyncClient, *args) -> httpx.Response:
+    """submit_form sotto il circuit breaker, senza retry (non idempotente)."""
+    with _portal_errors():
+        async with portal.guard():
+            resp = await submit_form(client, *args)
+            check_status(resp.status_code, str(resp.url))
+            return resp
+
+
+# --- LOGIN ---
+
+async def http_login(client: httpx.AsyncClient, username: str, password: str):
+    """Login Drupal via POST; i cookie di sessione restano nel client."""
+    resp = await get_checked(client, LOGIN_URL)
+    soup = BeautifulSoup(resp.text, "html.parser")
+
+    name_input = soup.select_one('input[name="name"]')
+    form = name_input.find_parent("form") if name_input else None
+    if form is None:
+        raise HttpBookingError("Form di login non trovato")
+
+    resp = await submit_checked(
+        client, str(resp.url), form,
+        {"name": username, "pass": password},
+        find_button(form, '#edit-submit, input[value="Log in"]'),
+    )
+
+    if "user/login" in str(resp.url):
+        errors = page_errors(BeautifulSoup(resp.text, "html.parser"))
+        raise LoginError(errors[0] if errors else "Credenziali non valide")
+
+
+# --- PRENOTAZIONE ---
+
+def _booking_form(soup: BeautifulSoup) -> Optional[Tag]:
+    for selector in (VUOI_PRENOTARE, 'input[value="Invia"]', "#edit-actions-preview-next"):
+        el = soup.select_one(selector)
+        if el is not None and el.find_parent("form") is not None:
+            return el.find_parent("form")
+    return None
+
+
+def _apply_choices(form: Tag, dish_ids: List[str], overrides: Dict[str, str], found: Set[str]):
+    """Imposta checkbox, tipologia menu e piatti presenti nello step corrente."""
+    checkbox = form.select_one(VUOI_PRENOTARE)
+    if checkbox is not None and checkbox.get("name"):
+        overrides[checkbox["name"]] = checkbox.get("value", "1")
+
+    tipologia = form.select_one(TIPOLOGIA_STANDARD)
+    if tipologia is not None and tipologia.get("name"):
+        overrides[tipologia["name"]] = tipologia.get("value", "standard")
+
+    for dish_id in dish_ids:
+        radio = form.find("input", attrs={"type": "radio", "value": dish_id})
+        if radio is not None and radio.get("name"):
+            overrides[radio["name"]] = dish_id
+            found.add(dish_id)
+
+
+async def http_book_meal(client: httpx.AsyncClient, meal_url: str, dish_ids: List[str]) -> bool:
+    """Prenota un pasto con il client già autenticato. Stessa semantica di book_meal."""
+    print(f"HTTP: prenotazione su {meal_url}")
+    with BOOKING_STEP_SECONDS.time(engine="http", step="page_loaded"):
+        resp = await get_checked(client, meal_url)
+    report_step("page_loaded", engine="http", meal_url=meal_url)
+
+    if "user/login" in str(resp.url):
+        print("HTTP: redirect al login, sessione scaduta?")
+        raise SessionExpiredError(str(resp.url))
+
+    overrides: Dict[str, str] = {}
+    found: Set[str] = set()
+
+    for step in range(MAX_FORM_STEPS):
+        soup = BeautifulSoup(resp.text, "html.parser")
+        page_url = str(resp.url)
+        form = _booking_form(soup)
+        if form is None:
+            if step == 0:
+                raise HttpBookingError("Webform di prenotazione non trovato")
+            print(f"HTTP: form scomparso allo step {step}. Errori: {page_errors(soup)}")
+            return False
+
+        # Ultimo passo: conferma finale
+        invia = find_button(form, 'input[value="Invia"]')
+        if invia is not None:
+            with BOOKING_STEP_SECONDS.time(engine="http", step="invia"):
+                resp = await submit_checked(client, page_url, form, {}, invia)
+            report_step("invia", engine="http", meal_url=meal_url)
+            result = BeautifulSoup(resp.text, "html.parser")
+            errors = page_errors(result)
+            if errors:
+                print(f"HTTP: errori dopo 'Invia': {errors}")
+                return False
+            status = result.select_one(".messages.status")
+            if status is not None:
+                print(f"HTTP: messaggio di successo: {status.get_text(' ', strip=True)}")
+            return True
+
+        _apply_choices(form, dish_ids, overrides, found)
+
+        button = find_button(form, "#edit-actions-preview-next")
+        step_name = "anteprima"
+        if button is not None:
+            missing = [d for d in dish_ids if d not in found]
+            if missing:
+                print(f"HTTP: piatti non trovati nel form: {missing}")
+        else:
+            button = find_button(form, "#edit-cards-next, #edit-actions-wizard-next")
+            step_name = f"procedi_{step + 1}"
+        if button is None:
+            raise HttpBookingError(f"Nessun bottone di avanzamento allo step {step}")
+
+        print(f"HTTP: step {step}, click '{button.get('value', '')}'")
+        with BOOKING_STEP_SECONDS.time(engine="http", step=step_name):
+            resp = await submit_checked(client, page_url, form, overrides, button)
+        report_step(step_name, engine="http", meal_url=meal_url)
+
+        errors = page_errors(BeautifulSoup(resp.text, "html.parser"))
+        if errors:
+            print(f"HTTP: errori di validazione: {errors}")
+            return False
+
+    raise HttpBookingError("Troppi step nel webform")
@@ -0,0 +1,163 @@
+"""Profilo di intercettazione delle richieste per le prenotazioni Playwright.
+
+Lo scraping blocca immagini, font, media e CSS (block_resources); le
+prenotazioni invece giravano senza alcun filtro perché il webform ha bisogno
+dei suoi script e dei CSS: le classi js-webform-states-hidden nascondono i
+campi via foglio di stile e i controlli di visibilità di book_meal ne
+dipendono. Questo profilo è più fine:
+  - passano documento, script, XHR/fetch e CSS del portale (e degli host in
+    BOOKING_ALLOWED_HOSTS);
+  - vengono bloccati i tipi in BOOKING_BLOCKED_RESOURCE_TYPES (immagini, font,
+    media...), gli URL che contengono uno dei BOOKING_BLOCKED_URL_PATTERNS
+    (analytics, tracker) e qualsiasi altro host;
+  - con BOOKING_STATIC_CACHE gli script e i CSS del portale vengono tenuti in
+    memoria e serviti a tutti i contesti del processo senza riscaricarli.
+Prima di attivarlo su un portale nuovo va provato con bench.verify_interception,
+che ripete una prenotazione registrata (HAR) con il profilo attivo. Per questo è
+spento di default (BOOKING_INTERCEPTION=off): va acceso solo dopo una verifica
+riuscita su un HAR del portale vero.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import urlsplit
+
+from playwright.async_api import BrowserContext, Route
+
+from app.metrics import BOOKING_INTERCEPTED_BYTES, BOOKING_INTERCEPTED_REQUESTS
+from app.settings import settings
+
+ALWAYS_ALLOWED_TYPES = {"document"}
+CACHEABLE_TYPES = {"script", "stylesheet"}
+
+
+class StaticCache:
+    """LRU in memoria di script e CSS del portale, condivisa tra i contesti."""
+
+    def __init__(self, max_bytes: int, ttl_seconds: float):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.size = 0
+        # url -> (scadenza, status, header, body)
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict[str, str], bytes]]" = OrderedDict()
+
+    def get(self, url: str) -> Optional[Tuple[int, Dict[str, str], bytes]]:
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(url)
+            return None
+        self._entries.move_to_end(url)
+        return entry[1:]
+
+    def put(self, url: str, status: int, headers: Dict[str, str], body: bytes):
+        if len(body) > self.max_bytes // 4:
+            return
+        if url in self._entries:
+            self._drop(url)
+        self._entries[url] = (time.monotonic() + self.ttl_seconds, status, headers, body)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, url: str):
+        self.size -= len(self._entries.pop(url)[3])
+
+    def stats(self) -> Dict:
+        return {"entries": len(self._entries), "bytes": self.size}
+
+
+class InterceptionProfile:
+    def __init__(
+        self,
+        portal_host: str,
+        allowed_hosts: Iterable[str],
+        blocked_types: Iterable[str],
+        blocked_patterns: Iterable[str],
+        cache: Optional[StaticCache] = None,
+    ):
+        self.allowed_hosts = {portal_host, *allowed_hosts}
+        self.portal_host = portal_host
+        self.blocked_types = set(blocked_types)
+        self.blocked_patterns = [p.lower() for p in blocked_patterns]
+        self.cache = cache
+
+    def decide(self, url: str, resource_type: str) -> str:
+        """"allow" o "block" per una richiesta (senza contare la cache)."""
+        if resource_type in ALWAYS_ALLOWED_TYPES and urlsplit(url).hostname in self.allowed_hosts:
+            return "allow"
+        lowered = url.lower()
+        if any(pattern in lowered for pattern in self.blocked_patterns):
+            return "block"
+        if resource_type in self.blocked_types:
+            return "block"
+        if urlsplit(url).hostname not in self.allowed_hosts:
+            return "block"
+        return "allow"
+
+    async def handle(self, route: Route):
+        request = route.request
+        action = self.decide(request.url, request.resource_type)
+        if action == "block":
+            BOOKING_INTERCEPTED_REQUESTS.inc(action="blocked")
+            await route.abort("blockedbyclient")
+            return
+
+        cacheable = (
+            self.cache is not None
+            and request.method == "GET"
+            and request.resource_type in CACHEABLE_TYPES
+            and urlsplit(request.url).hostname == self.portal_host
+        )
+        if cacheable:
+            hit = self.cache.get(request.url)
+            if hit is not None:
+                status, headers, body = hit
+                BOOKING_INTERCEPTED_REQUESTS.inc(action="cached")
+                BOOKING_INTERCEPTED_BYTES.inc(len(body), action="cached")
+                await route.fulfill(status=status, headers=headers, body=body)
+                return
+            try:
+                response = await route.fetch()
+                body = await response.body()
+            except Exception as e:
+                # Es. replay da HAR senza rete: lasciamo gestire agli altri handler
+                print(f"Intercettazione: fetch di {request.url} non riuscito ({e}), passo la richiesta.")
+                BOOKING_INTERCEPTED_REQUESTS.inc(action="fetch_error")
+                await route.fallback()
+                return
+            if response.status == 200:
+                self.cache.put(request.url, response.status, response.headers, body)
+            BOOKING_INTERCEPTED_REQUESTS.inc(action="allowed")
+            BOOKING_INTERCEPTED_BYTES.inc(len(body), action="allowed")
+            await route.fulfill(response=response, body=body)
+            return
+
+        BOOKING_INTERCEPTED_REQUESTS.inc(action="allowed")
+        # fallback e non continue_: eventuali altri handler (es. replay HAR) restano attivi
+        await route.fallback()
+
+    async def apply(self, context: BrowserContext):
+        """Attiva il profilo su tutte le pagine (tab) del contesto."""
+        await context.route("**/*", self.handle)
+
+
+_static_cache = StaticCache(
+    max_bytes=settings.BOOKING_STATIC_CACHE_MAX_MB * 1024 * 1024,
+    ttl_seconds=settings.BOOKING_STATIC_CACHE_TTL_SECONDS,
+)
+
+
+def booking_profile(static_cache: Optional[bool] = None) -> Optional[InterceptionProfile]:
+    """Profilo configurato nei settings (None con BOOKING_INTERCEPTION="off")."""
+    if settings.BOOKING_INTERCEPTION == "off":
+        return None
+    use_cache = settings.BOOKING_STATIC_CACHE if static_cache is None else static_cache
+    return InterceptionProfile(
+        portal_host=urlsplit(settings.PORTAL_BASE_URL).hostname,
+        allowed_hosts=settings.BOOKING_ALLOWED_HOSTS,
+        blocked_types=settings.BOOKING_BLOCKED_RESOURCE_TYPES,
+        blocked_patterns=settings.BOOKING_BLOCKED_URL_PATTERNS,
+        cache=_static_cache if use_cache else None,
+    )
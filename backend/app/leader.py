@@ -0,0 +1,112 @@
+"""Elezione del leader tra i processi uvicorn (lease su Redis).
+
+Con N worker uvicorn ogni processo eseguiva lifespan per intero: N scraping
+all'avvio, N cron giornalieri e N loop di aggiornamento contro il portale. Ora
+lo scraping programmato è compito di un solo processo, quello che possiede la
+chiave LEADER_KEY (SET NX con scadenza). Il leader rinnova il lease ogni
+LEADER_RENEW_SECONDS; se muore o resta isolato da Redis il lease scade dopo
+LEADER_LEASE_SECONDS e un altro processo lo prende al giro successivo.
+
+Rinnovo e rilascio verificano il token con uno script Lua, così un processo
+non può mai allungare o cancellare il lease di un altro.
+"""
+import asyncio
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+from app.redis_client import redis_client
+
+LEADER_KEY = "leader:scheduler"
+
+# Rinnova solo se il lease è ancora nostro
+RENEW_SCRIPT = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+# Rilascia solo se il lease è ancora nostro
+RELEASE_SCRIPT = redis_client.register_script("""
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+""")
+
+
+class LeaderLease:
+    def __init__(self, lease_seconds: float, renew_seconds: float, key: str = LEADER_KEY):
+        self.key = key
+        self.lease_ms = int(lease_seconds * 1000)
+        self.renew_seconds = renew_seconds
+        # pid per leggibilità in Redis, uuid per unicità tra host
+        self.token = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self.is_leader = False
+        self._valid_until = 0.0
+        self.elections = 0
+
+    async def _try_acquire(self) -> bool:
+        return bool(await redis_client.set(self.key, self.token, nx=True, px=self.lease_ms))
+
+    async def _renew(self) -> bool:
+        return bool(await RENEW_SCRIPT(keys=[self.key], args=[self.token, self.lease_ms]))
+
+    async def release(self):
+        if self.is_leader:
+            await RELEASE_SCRIPT(keys=[self.key], args=[self.token])
+            self.is_leader = False
+
+    async def _tick(self) -> bool:
+        """Un giro di acquisizione/rinnovo: True se dopo il giro siamo leader."""
+        start = time.monotonic()
+        try:
+            held = await (self._renew() if self.is_leader else self._try_acquire())
+        except Exception as e:
+            # Redis irraggiungibile: si resta leader solo finché il lease
+            # sarebbe comunque valido, poi si cede per non avere due leader
+            print(f"Leader: Redis non raggiungibile ({e}).")
+            return self.is_leader and start < self._valid_until
+        if held:
+            self._valid_until = start + self.lease_ms / 1000
+        return held
+
+    async def run(self, duties: Callable[[], Awaitable[None]]):
+        """Task di background: esegue duties() finché questo processo è leader e
+        la interrompe appena perde il lease."""
+        task: Optional[asyncio.Task] = None
+        try:
+            while True:
+                leader = await self._tick()
+                if leader and not self.is_leader:
+                    self.is_leader = True
+                    self.elections += 1
+                    print(f"Leader: questo processo ({self.token}) gestisce scraping e scheduler.")
+                    task = asyncio.create_task(duties())
+                elif not leader and self.is_leader:
+                    self.is_leader = False
+                    print("Leader: lease perso, interrompo i compiti del leader.")
+                    if task:
+                        task.cancel()
+                        task = None
+                elif leader and task.done() and not task.cancelled() and task.exception():
+                    print(f"Leader: compiti del leader terminati con errore ({task.exception()}), li riavvio.")
+                    task = asyncio.create_task(duties())
+                await asyncio.sleep(self.renew_seconds)
+        finally:
+            if task:
+                task.cancel()
+            try:
+                await self.release()
+            except Exception as e:
+                print(f"Leader: rilascio del lease non riuscito ({e}).")
+
+    async def stats(self) -> Dict:
+        return {
+            "is_leader": self.is_leader,
+            "token": self.token,
+            "current_leader": await redis_client.get(self.key),
+            "elections": self.elections,
+        }
@@ -1,15 +1,34 @@
 import asyncio
-from datetime import date, timedelta
-from typing import List, Optional
+import hashlib
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from email.utils import formatdate
+from typing import Awaitable, Callable, Dict, List, Literal, Optional
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from playwright.async_api import async_playwright, Browser, Playwright
+from playwright.async_api import Page
 
 # Importiamo le funzioni e l'utility di ottimizzazione
-from app.scraper import scrape_and_cache_daily, get_cached_menu, book_meal, setup_optimized_page
+from app.scraper import scrape_and_cache_daily, get_cached_menu, book_meal, goto_checked, listing_days, LOGIN_URL, USER_AGENT, SessionExpiredError
+from app.http_booking import http_login, http_book_meal, new_client as new_http_client, LoginError, HttpBookingError
+from app.browser_manager import BrowserManager
+from app.menu_cache import get_or_build, etag_matches, listen_invalidations, range_key
+from app.booking_queue import (
+    check_cipher, enqueue_batch, enqueue_booking, get_job, queue_depth, start_workers, stop_workers, BookingJobError,
+    FAILED as JOB_FAILED, SUCCEEDED as JOB_SUCCEEDED,
+)
+from app.admission import AdmissionRejected, from_settings as admission_from_settings
+from app import archive, booking_intents, browser_profile, events, interception, menu_store, metrics, upstream
+from app.leader import LeaderLease
+from app.refresh import booking_window_starts, listen_revalidations, refresh_loop, request_revalidation
+from app.single_flight import FlightBusy, FlightConflict, SingleFlight
+from app.session_store import load_session, save_session, cookies_from_httpx, apply_to_httpx
 from app.settings import settings
 
 # --- MODELLI DATI ---
@@ -19,46 +38,149 @@ class BookingRequest(BaseModel):
     meal_url: str
     dish_ids: List[str]
 
+class BatchItem(BaseModel):
+    meal_url: str
+    dish_ids: List[str]
+
+class BatchBookingRequest(BaseModel):
+    username: str
+    password: str
+    items: List[BatchItem]
+
+class BookingIntentRequest(BaseModel):
+    username: str
+    password: str
+    meal_url: str
+    dish_ids: List[str]
+    # Alternative per categoria (es. {"primi_piatti": ["123", "124"]}) se i preferiti mancano
+    fallbacks: Dict[str, List[str]] = {}
+    # Apertura prevista delle prenotazioni; senza, si parte quando lo scraping vede il pasto prenotabile
+    opens_at: Optional[datetime] = None
+
 # --- STATO GLOBALE ---
-# Qui salviamo l'istanza del browser aperta una volta sola
-playwright_instance: Optional[Playwright] = None
-global_browser: Optional[Browser] = None
+# Filtro delle richieste per i contesti di prenotazione (None se BOOKING_INTERCEPTION="off")
+booking_profile = interception.booking_profile()
+# Browser e pool di contesti avviati al primo uso, una volta sola per processo
+# (profilo di avvio per server, riciclato dopo N contesti, oltre una soglia di RSS o dopo un crash)
+browsers = BrowserManager(
+    pool_options={
+        "size": settings.BROWSER_POOL_SIZE,
+        "max_uses": settings.BROWSER_POOL_MAX_USES,
+        "max_heap_mb": settings.BROWSER_POOL_MAX_HEAP_MB,
+        "context_options": {"user_agent": USER_AGENT},
+        "context_setup": booking_profile.apply if booking_profile else None,
+    },
+    launch_options=browser_profile.launch_options(),
+    recycle_after_contexts=settings.BROWSER_RECYCLE_AFTER_CONTEXTS,
+    recycle_rss_mb=settings.BROWSER_RECYCLE_RSS_MB,
+    drain_timeout=settings.BROWSER_DRAIN_TIMEOUT_SECONDS,
+    check_seconds=settings.BROWSER_CHECK_SECONDS,
+)
+booking_workers: List[asyncio.Task] = []
+background_tasks: List[asyncio.Task] = []
+
+# AMMISSIONE: limite di prenotazioni contemporanee adattivo (latenza, errori, RAM)
+# al posto del vecchio semaforo fisso a 5
+admission = admission_from_settings()
 
-# SEMAFORO: Limitiamo a 5 le prenotazioni contemporanee per non far esplodere la RAM
-MAX_CONCURRENT_BOOKINGS = 5
-booking_semaphore = asyncio.Semaphore(MAX_CONCURRENT_BOOKINGS)
+# Idempotency-Key: risorsa creata una sola volta per chiave, anche tra worker
+idempotency = SingleFlight(
+    "idempotency",
+    lock_seconds=30,
+    result_ttl_seconds=settings.IDEMPOTENCY_TTL_SECONDS,
+    wait_seconds=settings.IDEMPOTENCY_WAIT_SECONDS,
+    poll_seconds=0.05,
+)
+
+# Un solo processo (il leader) fa scraping e scheduling dei job periodici
+leader = LeaderLease(settings.LEADER_LEASE_SECONDS, settings.LEADER_RENEW_SECONDS)
 
 scheduler = AsyncIOScheduler()
+DAILY_SCRAPE_JOB = "daily-scrape"
+
+async def scheduled_scrape():
+    # Lo scraping riusa il browser globale invece di lanciare un secondo Chromium
+    # (scrape_and_cache_daily gestisce da sé i propri errori: qui arriva solo l'avvio fallito)
+    try:
+        async with browsers.lease() as browser:
+            await scrape_and_cache_daily(browser)
+    except Exception as e:
+        print(f"Scraping saltato, avvio browser non riuscito: {e}")
+
+async def warm_up_browser():
+    browsers.warm_up()
+
+async def leader_duties():
+    """Compiti del solo leader: scraping all'avvio e giornaliero, controlli incrementali
+    e prenotazioni programmate. Viene cancellata se il lease passa a un altro processo."""
+    scheduler.add_job(scheduled_scrape, CronTrigger(hour=1, minute=0), id=DAILY_SCRAPE_JOB, replace_existing=True)
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(scheduled_scrape())
+            # Prenotazioni programmate: riprogrammate dopo un riavvio (o un cambio di leader)
+            # e fatte partire quando lo scraping segnala un pasto prenotabile. Il ripristino
+            # non solleva eccezioni, così un'intenzione rovinata non blocca lo scraping
+            tg.create_task(booking_intents.restore_intents(scheduler, browsers.warm_up))
+            tg.create_task(booking_intents.listen_bookable())
+            # Tra uno scraping completo e l'altro, controlli incrementali a intervallo adattivo.
+            # Le richieste di revalidazione di tutti i processi le ascolta solo il leader;
+            # con il refresh spento nessuno le pubblica (vedi request_revalidation)
+            if settings.REFRESH_ENABLED:
+                tg.create_task(refresh_loop(browsers.lease))
+                tg.create_task(listen_revalidations())
+    finally:
+        if scheduler.get_job(DAILY_SCRAPE_JOB):
+            scheduler.remove_job(DAILY_SCRAPE_JOB)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global playwright_instance, global_browser
-    
+    global booking_workers
+
+    if settings.LOG_TRACE_IDS:
+        metrics.install_trace_log_prefix()
+
     print("--- AVVIO BACKEND ---")
-    
-    # 1. AVVIAMO IL BROWSER GLOBALE (Singleton)
-    print("Avvio Browser Playwright Global...")
-    playwright_instance = await async_playwright().start()
-    # headless=True per il server
-    global_browser = await playwright_instance.chromium.launch(headless=True)
-    print("Browser Globale Pronto.")
-
-    # 2. SCHEDULER
-    scheduler.add_job(scrape_and_cache_daily, CronTrigger(hour=1, minute=0))
+
+    # Le password dei job in coda sono cifrate con una chiave comune a tutti i processi
+    check_cipher()
+
+    # 1. NIENTE BROWSER ALL'AVVIO: parte al primo scraping o alla prima prenotazione Playwright
+
+    # Invalidazione della cache /menu quando uno scraping scrive nuovi dati
+    background_tasks.append(asyncio.create_task(listen_invalidations()))
+    # Eventi in push per gli stream SSE aperti su questo processo
+    background_tasks.append(asyncio.create_task(events.listen()))
+
+    # Worker che svuotano la coda delle prenotazioni
+    # Almeno un worker per slot, altrimenti il limite adattivo non potrebbe crescere
+    booking_workers = start_workers(
+        run_booking, max(settings.BOOKING_WORKERS, settings.ADMISSION_MAX_CONCURRENCY), batch_handler=run_batch_booking
+    )
+    # La stima dell'attesa in coda somma i limiti di tutti i processi
+    background_tasks.append(asyncio.create_task(admission.share_limit()))
+
+    # 2. SCHEDULER (in ogni processo, per le prenotazioni programmate e il warm-up;
+    # i job di scraping li aggiunge solo il leader). Il warm-up serve davvero in ogni
+    # processo: ognuno ha il suo browser e i suoi worker, e il job di una fascia di
+    # prenotazione può finire su uno qualsiasi di loro
+    if settings.BOOKING_ENGINE == "playwright" and settings.BROWSER_WARMUP_AT_WINDOWS:
+        for start in booking_window_starts():
+            scheduler.add_job(warm_up_browser, CronTrigger(hour=start.hour, minute=start.minute))
     scheduler.start()
-    
-    # Eseguiamo uno scraping all'avvio in background
-    asyncio.create_task(scrape_and_cache_daily())
-    
+
+    # 3. ELEZIONE: un solo processo tra i worker uvicorn fa scraping e aggiornamenti
+    background_tasks.append(asyncio.create_task(leader.run(leader_duties)))
+
     yield
-    
+
     # --- SPEGNIMENTO ---
     print("--- SPEGNIMENTO BACKEND ---")
-    if global_browser:
-        print("Chiusura Browser Globale...")
-        await global_browser.close()
-    if playwright_instance:
-        await playwright_instance.stop()
+    await stop_workers(booking_workers)
+    for task in background_tasks:
+        task.cancel()
+    # Aspettiamo i task così il leader rilascia il lease e un altro processo subentra subito
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await browsers.close()
     scheduler.shutdown()
 
 app = FastAPI(lifespan=lifespan)
@@ -69,68 +191,620 @@ app = FastAPI(lifespan=lifespan)
 async def root():
     return {"message": "IntrAgenzia Backend is running (Optimized)"}
 
+@app.get("/metrics")
+async def read_metrics():
+    """Metriche in formato testo Prometheus."""
+    try:
+        metrics.BOOKING_QUEUE_DEPTH.set(await queue_depth())
+    except Exception as e:
+        print(f"Metriche: profondità coda non disponibile ({e})")
+    await asyncio.to_thread(metrics.update_process_stats, os.getpid())
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats/admission")
+async def read_admission_stats():
+    return admission.stats()
+
+@app.get("/stats/pool")
+async def read_pool_stats():
+    pool = browsers.pool_if_started
+    if not pool:
+        raise HTTPException(status_code=503, detail="Browser pool not started")
+    return pool.stats()
+
+@app.get("/stats/browser")
+async def read_browser_stats():
+    return browsers.stats()
+
+@app.get("/stats/leader")
+async def read_leader_stats():
+    return await leader.stats()
+
+@app.get("/stats/upstream")
+async def read_upstream_stats():
+    return await upstream.portal.stats()
+
+async def freshness_headers(day: date) -> Dict[str, str]:
+    """Età dei dati del giorno (ultimo scraping riuscito). Se sono vecchi si serve
+    comunque quello che c'è e si chiede al leader un aggiornamento in background.
+    Solo per oggi e domani, i giorni che lo scraping legge: per gli altri giorni
+    (date scelte dal client) non ci sono né età né aggiornamenti da chiedere."""
+    if day not in listing_days():
+        return {}
+    scraped_at = await menu_store.scraped_at(day.isoformat())
+    age = time.time() - scraped_at if scraped_at else None
+    stale = age is None or age > settings.MENU_STALE_AFTER_SECONDS
+    if stale:
+        try:
+            await request_revalidation()
+        except Exception as e:
+            print(f"Revalidazione menu non richiesta: {e}")
+    headers = {"X-Menu-Freshness": "stale" if stale else "fresh"}
+    if scraped_at:
+        # Non "Age": quello è il tempo passato in una cache HTTP, non l'età dei dati
+        headers["X-Menu-Age"] = str(int(age))
+        headers["Last-Modified"] = formatdate(scraped_at, usegmt=True)
+    return headers
+
+async def cached_json_response(request: Request, day: date, cache_key: str, build_payload) -> Response:
+    """Risposta JSON servita dalla cache in-process, con ETag e 304. Le chiavi iniziano
+    con il giorno ("{giorno}" o "{giorno}|...") o sono range_key(...), così l'invalidazione
+    del giorno le svuota tutte.
+    Età e freschezza dei dati viaggiano negli header, fuori dal body e dall'ETag."""
+    async def build() -> bytes:
+        return json.dumps(await build_payload(), ensure_ascii=False).encode()
+
+    body, etag = await get_or_build(cache_key, build)
+    headers = {"ETag": etag, "Cache-Control": "no-cache", **await freshness_headers(day)}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+async def menu_response(request: Request, day: date) -> Response:
+    async def payload():
+        return {"date": day.isoformat(), "menu": await get_cached_menu(day)}
+    return await cached_json_response(request, day, day.isoformat(), payload)
+
+@app.get("/menu")
+async def read_menu(
+    request: Request,
+    canteen: Optional[str] = None,
+    day: Optional[date] = Query(None, alias="date"),
+    meal: Optional[Literal["pranzo", "cena"]] = None,
+):
+    """Pasti per mensa (id, es. "pascoli"), giorno (default oggi) e tipo pasto; ogni filtro è opzionale."""
+    day = day or date.today()
+
+    async def payload():
+        # Controllato solo a cache fredda: le mense sconosciute non finiscono in cache
+        if canteen and not await menu_store.canteen_exists(canteen):
+            raise HTTPException(status_code=404, detail="Mensa sconosciuta")
+        meals = await menu_store.get_meals(day.isoformat(), canteen=canteen, meal=meal)
+        return {"date": day.isoformat(), "canteen": canteen, "meal": meal, "menu": meals}
+    return await cached_json_response(request, day, f"{day.isoformat()}|{canteen or '*'}|{meal or '*'}", payload)
+
+@app.get("/menu/range")
+async def read_menu_range(
+    request: Request,
+    start: date = Query(..., alias="from"),
+    end: date = Query(..., alias="to"),
+    canteen: Optional[str] = None,
+    meal: Optional[Literal["pranzo", "cena"]] = None,
+):
+    """Pasti di tutti i giorni da from a to (inclusi), letti da Redis con una sola MGET."""
+    days = (end - start).days + 1
+    if days < 1:
+        raise HTTPException(status_code=422, detail="'to' precede 'from'")
+    if days > settings.MENU_RANGE_MAX_DAYS:
+        raise HTTPException(status_code=422, detail=f"Al massimo {settings.MENU_RANGE_MAX_DAYS} giorni per richiesta")
+    day_strs = [(start + timedelta(days=i)).isoformat() for i in range(days)]
+
+    async def payload():
+        if canteen and not await menu_store.canteen_exists(canteen):
+            raise HTTPException(status_code=404, detail="Mensa sconosciuta")
+        menus = await menu_store.get_meals_range(day_strs, canteen=canteen, meal=meal)
+        return {"from": day_strs[0], "to": day_strs[-1], "canteen": canteen, "meal": meal, "days": menus}
+    # La freschezza è quella del giorno più vicino a oggi tra quelli richiesti
+    freshness_day = min(max(start, date.today()), end)
+    cache_key = range_key(day_strs[0], day_strs[-1], canteen or "*", meal or "*")
+    return await cached_json_response(request, freshness_day, cache_key, payload)
+
+@app.get("/menu/canteens")
+async def read_canteens():
+    return await menu_store.get_canteens()
+
+@app.get("/archive/search")
+async def search_archive(
+    q: str = Query(..., min_length=2),
+    category: Optional[str] = None,
+    canteen: Optional[str] = None,
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    limit: int = Query(50, ge=1, le=500),
+):
+    """Quando è stato servito un piatto: ricerca per parole (anche parziali) nello storico."""
+    results = await archive.search_dishes(
+        q, category, canteen, since and since.isoformat(), until and until.isoformat(), limit
+    )
+    return {"q": q, "results": results}
+
+@app.get("/archive/stats")
+async def read_archive_stats(
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    canteen: Optional[str] = None,
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    limit: int = Query(20, ge=1, le=200),
+):
+    """Piatti più frequenti e presenze per mese, con gli stessi filtri della ricerca."""
+    return await archive.dish_stats(
+        q, category, canteen, since and since.isoformat(), until and until.isoformat(), limit
+    )
+
 @app.get("/menu/today")
-async def read_menu_today():
-    today = date.today()
-    menu = await get_cached_menu(today)
-    return {"date": today.isoformat(), "menu": menu}
+async def read_menu_today(request: Request):
+    return await menu_response(request, date.today())
 
 @app.get("/menu/tomorrow")
-async def read_menu_tomorrow():
-    tomorrow = date.today() + timedelta(days=1)
-    menu = await get_cached_menu(tomorrow)
-    return {"date": tomorrow.isoformat(), "menu": menu}
+async def read_menu_tomorrow(request: Request):
+    return await menu_response(request, date.today() + timedelta(days=1))
 
-@app.post("/book")
-async def make_reservation_endpoint(request: BookingRequest):
-    """
-    Endpoint ottimizzato: usa il browser globale ma SENZA blocco risorse per affidabilità.
-    """
-    if not global_browser:
+async def http_session_login(client, username: str, password: str):
+    """Login HTTP e salvataggio della sessione in cache (401 se le credenziali sono errate)."""
+    print(f"Login HTTP per {username}...")
+    try:
+        with metrics.BOOKING_STEP_SECONDS.time(engine="http", step="login"):
+            await http_login(client, username, password)
+    except LoginError as e:
+        raise HTTPException(status_code=401, detail=e.message.strip())
+    events.report_step("login", engine="http")
+    await save_session(username, password, cookies_from_httpx(client))
+
+
+async def book_with_http(request: BookingRequest) -> bool:
+    """Prenotazione senza browser: login e webform via POST diretti."""
+    async with new_http_client() as client:
+        cookies = await load_session(request.username, request.password)
+        if cookies:
+            print(f"Sessione in cache per {request.username}, salto il login.")
+            apply_to_httpx(client, cookies)
+            try:
+                return await http_book_meal(client, request.meal_url, request.dish_ids)
+            except SessionExpiredError:
+                print("Sessione in cache scaduta, nuovo login...")
+                client.cookies.clear()
+
+        await http_session_login(client, request.username, request.password)
+        return await http_book_meal(client, request.meal_url, request.dish_ids)
+
+
+async def playwright_login(page: Page, username: str, password: str):
+    print(f"Login per {username}...")
+    await upstream.portal.call(lambda: goto_checked(page, LOGIN_URL))
+    await page.fill('input[name="name"]', username)
+    await page.fill('input[name="pass"]', password)
+
+    with metrics.BOOKING_STEP_SECONDS.time(engine="playwright", step="login"):
+        async with upstream.portal.guard(), page.expect_navigation():
+            await page.click('#edit-submit')
+
+    if "user/login" in page.url:
+         error_msg = "Credenziali non valide"
+         try:
+             div = page.locator(".messages.error")
+             if await div.count() > 0:
+                 error_msg = await div.first.text_content()
+         except: pass
+         raise HTTPException(status_code=401, detail=error_msg.strip())
+    events.report_step("login", engine="playwright")
+
+
+async def book_with_playwright(request: BookingRequest) -> bool:
+    try:
+        await browsers.start()
+    except Exception as e:
+        print(f"Avvio browser non riuscito: {e}")
         raise HTTPException(status_code=500, detail="Browser service not available")
 
-    async with booking_semaphore:
-        print(f"Inizio slot prenotazione per: {request.username}")
-        
-        # Creiamo un contesto
-        context = await global_browser.new_context(
-             user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
-        )
-        page = await context.new_page()
-        
-        # RIMOZIONE: Non chiamiamo setup_optimized_page(page) qui.
-        # Lasciamo che la pagina carichi tutto per evitare problemi con script nascosti.
-        
+    # Contesto già caldo dal pool (ripulito tra un utente e l'altro)
+    # Niente blocco dei CSS dello scraping (block_resources) qui: rompe i controlli di
+    # visibilità del webform. I contesti del pool usano il profilo selettivo di
+    # app.interception (script e CSS del portale passano, il resto no).
+    async with browsers.checkout() as (context, page):
+        cookies = await load_session(request.username, request.password)
+        if cookies:
+            print(f"Sessione in cache per {request.username}, salto il login.")
+            await context.add_cookies(cookies)
+            try:
+                return await book_meal(page, request.meal_url, request.dish_ids)
+            except SessionExpiredError:
+                print("Sessione in cache scaduta, nuovo login...")
+                await context.clear_cookies()
+
+        await playwright_login(page, request.username, request.password)
+        await save_session(request.username, request.password, await context.cookies())
+
+        return await book_meal(page, request.meal_url, request.dish_ids)
+
+
+# --- PRENOTAZIONI MULTIPLE (un login, una sessione) ---
+
+async def book_items_in_session(items: List[BatchItem], book_one, relogin, cached: bool) -> list:
+    """Prenota gli item nella stessa sessione, BOOKING_BATCH_PARALLEL alla volta.
+    Restituisce per ogni item l'esito (bool) o l'eccezione. Se la sessione in cache
+    risulta scaduta rifà il login una volta e ritenta solo quegli item (se anche il
+    login fallisce, la sua eccezione diventa l'esito di quegli item)."""
+    semaphore = asyncio.Semaphore(max(1, settings.BOOKING_BATCH_PARALLEL))
+
+    async def one(item: BatchItem):
+        async with semaphore:
+            return await book_one(item)
+
+    results = await asyncio.gather(*(one(item) for item in items), return_exceptions=True)
+    expired = [n for n, r in enumerate(results) if isinstance(r, SessionExpiredError)]
+    if cached and expired:
+        print("Sessione in cache scaduta, nuovo login...")
         try:
-            print(f"Login per {request.username}...")
-            await page.goto("https://intragenzia.adisu.umbria.it/user/login")
-            await page.fill('input[name="name"]', request.username)
-            await page.fill('input[name="pass"]', request.password)
-            
-            async with page.expect_navigation():
-                await page.click('#edit-submit')
-            
-            if "user/login" in page.url:
-                 error_msg = "Credenziali non valide"
-                 try:
-                     div = page.locator(".messages.error")
-                     if await div.count() > 0:
-                         error_msg = await div.first.text_content()
-                 except: pass
-                 raise HTTPException(status_code=401, detail=error_msg.strip())
-
-            success = await book_meal(page, request.meal_url, request.dish_ids)
-            
+            await relogin()
+        except Exception as e:
+            # Gli item già prenotati nel primo giro tengono il loro esito
+            for n in expired:
+                results[n] = e
+            return results
+        retried = await asyncio.gather(*(one(items[n]) for n in expired), return_exceptions=True)
+        for n, result in zip(expired, retried):
+            results[n] = result
+    return results
+
+
+async def book_batch_with_http(username: str, password: str, items: List[BatchItem]) -> list:
+    async with new_http_client() as client:
+        async def relogin():
+            client.cookies.clear()
+            await http_session_login(client, username, password)
+
+        cookies = await load_session(username, password)
+        if cookies:
+            print(f"Sessione in cache per {username}, salto il login.")
+            apply_to_httpx(client, cookies)
+        else:
+            await relogin()
+
+        async def book_one(item: BatchItem):
+            return await http_book_meal(client, item.meal_url, item.dish_ids)
+
+        return await book_items_in_session(items, book_one, relogin, cached=bool(cookies))
+
+
+async def book_batch_with_playwright(username: str, password: str, items: List[BatchItem]) -> list:
+    try:
+        await browsers.start()
+    except Exception as e:
+        print(f"Avvio browser non riuscito: {e}")
+        raise HTTPException(status_code=500, detail="Browser service not available")
+
+    # Un contesto (quindi un login) per tutto il batch, una tab per pasto:
+    # le tab in più vengono chiuse dal pool al rilascio del contesto
+    async with browsers.checkout() as (context, page):
+        async def relogin():
+            await context.clear_cookies()
+            await playwright_login(page, username, password)
+            await save_session(username, password, await context.cookies())
+
+        cookies = await load_session(username, password)
+        if cookies:
+            print(f"Sessione in cache per {username}, salto il login.")
+            await context.add_cookies(cookies)
+        else:
+            await relogin()
+
+        async def book_one(item: BatchItem):
+            tab = await context.new_page()
+            try:
+                return await book_meal(tab, item.meal_url, item.dish_ids)
+            finally:
+                await tab.close()
+
+        return await book_items_in_session(items, book_one, relogin, cached=bool(cookies))
+
+
+async def run_batch_booking(username: str, password: str, items: List[Dict]) -> List[Dict]:
+    """Batch di prenotazioni dello stesso utente, eseguito dai worker della coda:
+    un solo slot di ammissione, un solo login. Restituisce gli item con l'esito."""
+    batch = [BatchItem(meal_url=item["meal_url"], dish_ids=item["dish_ids"]) for item in items]
+    await check_portal(settings.BOOKING_ENGINE)
+    async with admission.slot(username):
+        print(f"Inizio slot prenotazione multipla per: {username} ({len(batch)} pasti)")
+        results: list = [None] * len(batch)
+        engines = [settings.BOOKING_ENGINE] * len(batch)
+        start = time.perf_counter()
+        rejected = unavailable = False
+        try:
+            pending = list(range(len(batch)))
+            if settings.BOOKING_ENGINE == "http":
+                try:
+                    http_results = await book_batch_with_http(username, password, batch)
+                except HttpBookingError as e:
+                    # Login HTTP non interpretabile: tutto il batch passa a Playwright (come /book)
+                    if not settings.BOOKING_HTTP_FALLBACK:
+                        raise
+                    http_results = [e] * len(batch)
+                for n, result in zip(pending, http_results):
+                    results[n] = result
+                # Gli item che il motore HTTP non sa interpretare ripiegano su Playwright
+                pending = [
+                    n for n, r in enumerate(results)
+                    if isinstance(r, HttpBookingError) and settings.BOOKING_HTTP_FALLBACK
+                ]
+                if pending:
+                    print(f"Motore HTTP non applicabile a {len(pending)} pasti, fallback su Playwright...")
+            if pending:
+                fallback = await book_batch_with_playwright(username, password, [batch[n] for n in pending])
+                for n, result in zip(pending, fallback):
+                    results[n] = result
+                    engines[n] = "playwright"
+        except HTTPException as he:
+            rejected = True
+            raise BookingJobError(str(he.detail))
+        except upstream.UpstreamUnavailable as e:
+            unavailable = True
+            raise BookingJobError(str(e))
+        finally:
+            outcomes = []
+            for n, result in enumerate(results):
+                outcome = (
+                    "rejected" if rejected else "unavailable" if unavailable
+                    else "success" if result is True else "failed" if result is False else "error"
+                )
+                outcomes.append(outcome)
+                metrics.BOOKINGS_TOTAL.inc(engine=engines[n], outcome=outcome)
+            # Il limite adattivo ragiona per singola prenotazione: durata media per pasto
+            admission.record(
+                (time.perf_counter() - start) / len(batch),
+                upstream_ok=rejected or not unavailable and "error" not in outcomes,
+            )
+            print(f"Fine slot prenotazione multipla per: {username}")
+
+    done = []
+    for item, result in zip(items, results):
+        if result is True:
+            done.append({**item, "status": JOB_SUCCEEDED, "message": "Prenotazione effettuata con successo"})
+        elif result is False:
+            done.append({**item, "status": JOB_FAILED, "reason": "Errore generico durante la prenotazione"})
+        else:
+            print(f"Prenotazione {item['meal_url']} non riuscita: {result!r}")
+            reason = result.detail if isinstance(result, HTTPException) else (str(result) or type(result).__name__)
+            done.append({**item, "status": JOB_FAILED, "reason": reason})
+    return done
+
+
+async def run_booking(username: str, password: str, meal_url: str, dish_ids: List[str]) -> str:
+    """
+    Prenotazione vera e propria, eseguita dai worker della coda: motore HTTP (se configurato)
+    con fallback sul browser globale, che gira SENZA blocco risorse per affidabilità.
+    """
+    request = BookingRequest(username=username, password=password, meal_url=meal_url, dish_ids=dish_ids)
+    await check_portal(settings.BOOKING_ENGINE)
+    async with admission.slot(username):
+        print(f"Inizio slot prenotazione per: {username}")
+        engine, outcome = settings.BOOKING_ENGINE, "error"
+        start = time.perf_counter()
+        try:
+            success = None
+            if settings.BOOKING_ENGINE == "http":
+                try:
+                    success = await book_with_http(request)
+                except HttpBookingError as e:
+                    if not settings.BOOKING_HTTP_FALLBACK:
+                        raise
+                    print(f"Motore HTTP non applicabile ({e}), fallback su Playwright...")
+
+            if success is None:
+                engine = "playwright"
+                success = await book_with_playwright(request)
+
             if success:
-                return {"status": "success", "message": "Prenotazione effettuata con successo"}
+                outcome = "success"
+                return "Prenotazione effettuata con successo"
             else:
-                raise HTTPException(status_code=500, detail="Errore generico durante la prenotazione")
-                
+                outcome = "failed"
+                raise BookingJobError("Errore generico durante la prenotazione")
+
         except HTTPException as he:
-            raise he
-        except Exception as e:
-            print(f"Exception during booking: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+            outcome = "rejected"
+            raise BookingJobError(str(he.detail))
+        except upstream.UpstreamUnavailable as e:
+            outcome = "unavailable"
+            raise BookingJobError(str(e))
         finally:
-            await context.close()
-            print(f"Fine slot prenotazione per: {request.username}")
+            # Credenziali rifiutate non dicono nulla sullo stato del portale
+            admission.record(time.perf_counter() - start, upstream_ok=outcome in ("success", "rejected"))
+            metrics.BOOKINGS_TOTAL.inc(engine=engine, outcome=outcome)
+            print(f"Fine slot prenotazione per: {username}")
+
+
+async def check_admission():
+    """Rifiuti immediati (503 con Retry-After): portale in errore o coda troppo lunga."""
+    try:
+        await upstream.portal.check()
+    except upstream.UpstreamUnavailable as e:
+        raise AdmissionRejected(str(e), e.retry_after, scope="upstream")
+    await admission.check_queue(await queue_depth())
+
+
+async def check_portal(engine: str):
+    """A circuito aperto il job fallisce in millisecondi, senza occupare uno slot."""
+    try:
+        await upstream.portal.check()
+    except upstream.UpstreamUnavailable as e:
+        metrics.BOOKINGS_TOTAL.inc(engine=engine, outcome="unavailable")
+        raise BookingJobError(str(e))
+
+
+async def idempotent(
+    key: Optional[str],
+    kind: str,
+    request: BaseModel,
+    response: Response,
+    create: Callable[[], Awaitable[Dict]],
+    id_field: str,
+    load: Callable[[str], Awaitable[Optional[Dict]]],
+) -> Dict:
+    """Header Idempotency-Key: la prima richiesta crea la risorsa; le ripetizioni con la
+    stessa chiave (anche in contemporanea, anche su un altro worker) ricevono la stessa
+    risorsa nel suo stato attuale, con l'header Idempotent-Replayed. La chiave vale per
+    utente; riusarla per una richiesta diversa dà 422."""
+    if not key:
+        return await create()
+    created: Dict[str, Dict] = {}
+
+    async def run() -> str:
+        created["resource"] = await create()
+        return created["resource"][id_field]
+
+    # La password non entra nell'impronta: non deve finire in Redis, nemmeno come hash
+    fingerprint = hashlib.sha256(f"{kind}|{request.model_dump_json(exclude={'password'})}".encode()).hexdigest()
+    scope = hashlib.sha256(f"{request.username}|{key}".encode()).hexdigest()
+    try:
+        resource_id, replayed = await idempotency.run(scope, run, fingerprint)
+    except FlightConflict:
+        raise HTTPException(status_code=422, detail="Idempotency-Key già usata per una richiesta diversa")
+    except FlightBusy as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if not replayed:
+        return created["resource"]
+    response.headers["Idempotent-Replayed"] = "true"
+    resource = await load(resource_id)
+    if resource is None:
+        raise HTTPException(status_code=404, detail="Risorsa creata con questa Idempotency-Key non più disponibile")
+    return resource
+
+
+async def enqueue_or_reject(enqueue: Callable[[], Awaitable[Dict]]) -> Dict:
+    """Accoda dopo il controllo di ammissione; se il sistema è saturo 503 con Retry-After."""
+    try:
+        await check_admission()
+        job = await enqueue()
+    except AdmissionRejected as e:
+        metrics.BOOKINGS_REJECTED.inc(reason=e.scope)
+        raise HTTPException(status_code=503, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+    # Il browser si avvia mentre il job aspetta il suo turno in coda
+    if settings.BOOKING_ENGINE == "playwright":
+        browsers.warm_up()
+    return job
+
+
+@app.post("/book", status_code=202)
+async def make_reservation_endpoint(
+    request: BookingRequest, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """Accoda la prenotazione e risponde subito con il job da interrogare su GET /book/{job_id}.
+    Se il sistema è saturo risponde 503 con Retry-After invece di accodare."""
+    async def create():
+        return await enqueue_or_reject(lambda: enqueue_booking(
+            request.username, request.password, request.meal_url, request.dish_ids,
+            max_active=settings.ADMISSION_PER_USER_LIMIT,
+        ))
+    return await idempotent(idempotency_key, "book", request, response, create, "job_id", get_job)
+
+
+@app.post("/book/batch", status_code=202)
+async def make_batch_reservation_endpoint(
+    request: BatchBookingRequest, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """Più pasti dello stesso utente in un solo job: un login, una sessione, esito per
+    pasto nel campo "items" di GET /book/{job_id}."""
+    urls = [item.meal_url for item in request.items]
+    if not urls:
+        raise HTTPException(status_code=422, detail="Nessun pasto da prenotare")
+    if len(urls) > settings.BOOKING_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=422, detail=f"Al massimo {settings.BOOKING_BATCH_MAX_ITEMS} pasti per richiesta")
+    if len(set(urls)) != len(urls):
+        raise HTTPException(status_code=422, detail="Pasto ripetuto nella richiesta")
+
+    async def create():
+        return await enqueue_or_reject(lambda: enqueue_batch(
+            request.username, request.password, [item.model_dump() for item in request.items],
+            max_active=settings.ADMISSION_PER_USER_LIMIT,
+        ))
+    return await idempotent(idempotency_key, "batch", request, response, create, "job_id", get_job)
+
+
+@app.post("/book/intents", status_code=201)
+async def create_booking_intent(
+    request: BookingIntentRequest, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255)
+):
+    """Prenotazione programmata: parte da sola all'apertura, con login già fatto."""
+    async def create():
+        intent = await booking_intents.create_intent(
+            request.username, request.password, request.meal_url,
+            request.dish_ids, request.fallbacks, request.opens_at,
+        )
+        booking_intents.schedule_intent(scheduler, intent, browsers.warm_up)
+        await booking_intents.fire_if_bookable(intent)
+        return await booking_intents.get_intent(intent["intent_id"])
+    return await idempotent(
+        idempotency_key, "intent", request, response, create, "intent_id", booking_intents.get_intent
+    )
+
+
+@app.get("/book/intents/{intent_id}")
+async def read_booking_intent(intent_id: str):
+    intent = await booking_intents.get_intent(intent_id)
+    if not intent:
+        raise HTTPException(status_code=404, detail="Prenotazione programmata non trovata")
+    return intent
+
+
+@app.delete("/book/intents/{intent_id}")
+async def cancel_booking_intent(intent_id: str):
+    if not await booking_intents.cancel_intent(intent_id):
+        raise HTTPException(status_code=409, detail="Prenotazione programmata già partita o inesistente")
+    booking_intents.unschedule_intent(scheduler, intent_id)
+    return {"intent_id": intent_id, "status": booking_intents.CANCELLED}
+
+
+@app.get("/book/{job_id}")
+async def read_booking_job(job_id: str):
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Prenotazione non trovata")
+    return job
+
+
+# --- EVENTI IN PUSH (SSE) ---
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_response(body) -> StreamingResponse:
+    return StreamingResponse(body, media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/events/menu")
+async def menu_events():
+    """Stream SSE dei cambi di menu (menu_changed con la data) e dei pasti diventati
+    prenotabili (bookable con meal_url), al posto del polling su /menu."""
+    async def body():
+        with events.subscribe(events.MENU_TOPIC) as queue:
+            async for chunk in events.stream(queue):
+                yield chunk
+    return sse_response(body())
+
+@app.get("/book/{job_id}/events")
+async def booking_job_events(job_id: str):
+    """Stream SSE del job: stato attuale, step della prenotazione man mano che
+    avvengono, stato finale (poi lo stream si chiude)."""
+    if not await get_job(job_id):
+        raise HTTPException(status_code=404, detail="Prenotazione non trovata")
+
+    def finished(event: Dict) -> bool:
+        return event.get("type") == "status" and event.get("status") in (JOB_SUCCEEDED, JOB_FAILED)
+
+    async def body():
+        # Iscritti prima di leggere lo stato, così nessun evento cade nel mezzo
+        with events.subscribe(events.job_topic(job_id)) as queue:
+            job = await get_job(job_id)
+            initial = [{"type": "status", **job}] if job else []
+            async for chunk in events.stream(queue, initial, until=finished):
+                yield chunk
+    return sse_response(body())
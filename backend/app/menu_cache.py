@@ -0,0 +1,133 @@
+"""Cache in-process delle risposte /menu, già serializzate e con ETag.
+
+Davanti a Redis si tengono i byte pronti da spedire e un ETag forte per ogni
+giorno: i client che fanno polling ricevono 304 senza toccare Redis né
+ri-serializzare il JSON. Quando lo scraper scrive nuovi dati pubblica un
+messaggio su MENU_INVALIDATE_CHANNEL; ogni worker è in ascolto e svuota la
+propria copia. MENU_CACHE_TTL_SECONDS limita comunque la durata di una voce,
+nel caso un messaggio vada perso.
+Le chiavi dipendono da date, mense e intervalli scelti dai client: la cache è
+un LRU di al massimo MENU_CACHE_MAX_ENTRIES voci, e le voci scadute vengono
+tolte invece di restare in memoria. Una lettura da Redis partita prima di
+un'invalidazione non salva il suo risultato: invalidate() la toglie dalle
+letture in corso e solo quella in corso per la chiave può scrivere.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from app.redis_client import listen_channels, redis_client
+from app.settings import settings
+
+MENU_INVALIDATE_CHANNEL = "menu:invalidate"
+ALL_KEYS = "*"
+# Le risposte su più giorni ("range|{da}|{a}|...") si svuotano con ognuno dei loro giorni
+RANGE_PREFIX = "range|"
+
+# chiave -> (scadenza, body, etag), dalla meno usata di recente
+_entries: "OrderedDict[str, Tuple[float, bytes, str]]" = OrderedDict()
+# chiave -> lettura in corso: il future fa da generazione della chiave
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+async def get_or_build(key: str, build: Callable[[], Awaitable[bytes]]) -> Tuple[bytes, str]:
+    """Body ed ETag per la chiave; le richieste concorrenti su una voce mancante
+    condividono un'unica lettura da Redis."""
+    entry = _entries.get(key)
+    if entry:
+        if entry[0] > time.monotonic():
+            _entries.move_to_end(key)
+            return entry[1], entry[2]
+        del _entries[key]
+
+    pending = _inflight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        body = await build()
+        result = (body, make_etag(body))
+        # Invalidata durante la lettura: il risultato va a chi aspettava, non in cache
+        if _inflight.get(key) is future:
+            _store(key, result)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        future.exception()  # evita il warning "exception was never retrieved"
+        raise
+    finally:
+        if _inflight.get(key) is future:
+            del _inflight[key]
+
+
+def _store(key: str, result: Tuple[bytes, str]):
+    now = time.monotonic()
+    _entries[key] = (now + settings.MENU_CACHE_TTL_SECONDS, *result)
+    _entries.move_to_end(key)
+    if len(_entries) <= settings.MENU_CACHE_MAX_ENTRIES:
+        return
+    for expired in [k for k, entry in _entries.items() if entry[0] <= now]:
+        del _entries[expired]
+    while len(_entries) > settings.MENU_CACHE_MAX_ENTRIES:
+        _entries.popitem(last=False)
+
+
+def range_key(start: str, end: str, *parts: str) -> str:
+    return "|".join((RANGE_PREFIX + start, end, *parts))
+
+
+def _range_covers(cached_key: str, day: str) -> bool:
+    if not cached_key.startswith(RANGE_PREFIX):
+        return False
+    start, end = cached_key[len(RANGE_PREFIX):].split("|", 2)[:2]
+    # Date ISO: il confronto tra stringhe segue quello tra date
+    return start <= day <= end
+
+
+def _matches(cached_key: str, key: str) -> bool:
+    return key == ALL_KEYS or cached_key == key or cached_key.startswith(key + "|") or _range_covers(cached_key, key)
+
+
+def invalidate(key: str):
+    """Svuota la voce e quelle derivate ("{key}|..."), es. tutte le query di un giorno,
+    comprese le risposte su intervalli che contengono il giorno. Le letture in corso
+    su quelle chiavi non finiscono in cache e le richieste successive ne fanno una nuova."""
+    if key == ALL_KEYS:
+        _entries.clear()
+    else:
+        for cached_key in [k for k in _entries if _matches(k, key)]:
+            del _entries[cached_key]
+    for building_key in [k for k in _inflight if _matches(k, key)]:
+        del _inflight[building_key]
+
+
+async def publish_invalidation(keys: Iterable[str]):
+    """Invalida le chiavi in questo processo e negli altri worker (via pub/sub)."""
+    for key in keys:
+        invalidate(key)
+        await redis_client.publish(MENU_INVALIDATE_CHANNEL, key)
+
+
+async def listen_invalidations():
+    """Task di background: applica le invalidazioni pubblicate dagli altri processi.
+    Dopo una disconnessione potremmo aver perso messaggi: si svuota tutta la cache."""
+    async def on_message(channel: str, data: str):
+        invalidate(data)
+
+    await listen_channels([MENU_INVALIDATE_CHANNEL], on_message, "Cache menu", on_gap=lambda: invalidate(ALL_KEYS))
@@ -0,0 +1,90 @@
+"""Codifica dei pasti salvati in Redis (menu:{giorno}:{mensa}:{pasto}).
+
+Il JSON ripeteva in ogni pasto i nomi dei campi e di ogni piatto ("id",
+"nome") e va riletto carattere per carattere a ogni lettura a cache fredda.
+Con MENU_CODEC="msgpack" il pasto diventa una lista posizionale (MEAL_FIELDS)
+codificata in msgpack, preceduta da due byte:
+  - 0xC1, che msgpack non usa mai e che il JSON non può avere in testa;
+  - la versione dello schema (SCHEMA_VERSION), da incrementare quando cambiano
+    i campi posizionali.
+I valori senza intestazione sono JSON (il formato precedente): restano
+leggibili finché non scadono o non vengono riscritti dallo scraping, quindi
+cambiare codec non richiede migrazioni.
+"""
+import json
+from typing import Dict, List
+
+import msgpack
+
+from app.settings import settings
+
+MAGIC = 0xC1
+SCHEMA_VERSION = 1
+
+# Ordine dei campi nella lista posizionale; campi in più finiscono nel dict finale
+MEAL_FIELDS = ("data", "mensa", "mensa_id", "tipo_pasto", "url", "prenotato", "prenotabile", "piatti")
+DISH_FIELDS = ("id", "nome")
+_DISH_KEYS = frozenset(DISH_FIELDS)
+
+
+class CodecError(ValueError):
+    """Valore in un formato o in una versione di schema che questo processo non conosce."""
+
+
+def _pack_dishes(piatti: Dict[str, List[Dict]]) -> Dict[str, List]:
+    return {
+        category: [
+            [dish["id"], dish["nome"]] if dish.keys() == _DISH_KEYS else dish
+            for dish in dishes
+        ]
+        for category, dishes in piatti.items()
+    }
+
+
+def _unpack_dishes(piatti: Dict[str, List]) -> Dict[str, List[Dict]]:
+    return {
+        # Letterale e non dict(zip(...)): è il ciclo più caldo della decodifica
+        category: [{"id": dish[0], "nome": dish[1]} if type(dish) is list else dish for dish in dishes]
+        for category, dishes in piatti.items()
+    }
+
+
+def encode(meal: Dict) -> bytes:
+    if settings.MENU_CODEC == "json":
+        return json.dumps(meal).encode()
+    values = [meal.get(field) for field in MEAL_FIELDS]
+    values[-1] = _pack_dishes(meal.get("piatti") or {})
+    extra = {k: v for k, v in meal.items() if k not in MEAL_FIELDS}
+    return bytes((MAGIC, SCHEMA_VERSION)) + msgpack.packb([*values, extra])
+
+
+def decode(raw: bytes) -> Dict:
+    """Pasto salvato da encode (o JSON del formato precedente). CodecError per
+    qualunque valore illeggibile, così una chiave corrotta si salta invece di
+    far fallire la risposta."""
+    if not raw or raw[0] != MAGIC:
+        try:
+            meal = json.loads(raw)
+        except ValueError as e:  # anche UnicodeDecodeError
+            raise CodecError(f"Menu JSON non leggibile: {e}") from e
+        if type(meal) is not dict:
+            raise CodecError(f"Menu JSON non valido: {type(meal).__name__} invece di un oggetto")
+        return meal
+    if len(raw) < 2 or raw[1] != SCHEMA_VERSION:
+        raise CodecError(f"Versione di schema del menu non supportata: {raw[1:2].hex() or 'mancante'}")
+    try:
+        values = msgpack.unpackb(raw[2:])
+    except (ValueError, msgpack.UnpackException) as e:
+        raise CodecError(f"Menu msgpack non leggibile: {e}") from e
+    if type(values) is not list or len(values) != len(MEAL_FIELDS) + 1:
+        raise CodecError(f"Menu msgpack non valido: attesi {len(MEAL_FIELDS) + 1} valori")
+    *values, extra = values
+    meal = dict(zip(MEAL_FIELDS, values))
+    if type(meal["piatti"]) is not dict or type(extra) is not dict:
+        raise CodecError("Menu msgpack non valido: piatti o campi extra non sono un dizionario")
+    try:
+        meal["piatti"] = _unpack_dishes(meal["piatti"])
+    except (TypeError, IndexError, AttributeError) as e:
+        raise CodecError(f"Menu msgpack non valido: piatti malformati ({e})") from e
+    meal.update(extra)
+    return meal
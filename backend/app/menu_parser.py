@@ -0,0 +1,105 @@
+"""Estrazione dei dati dall'HTML delle pagine del portale, senza browser.
+
+Lo scraper prende l'HTML con una sola chiamata (page.content()) e lo analizza
+qui con BeautifulSoup, invece di fare una chiamata Playwright per ogni nodo.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup
+
+CATEGORY_MAP = {
+    "Primi piatti": "primi_piatti",
+    "Secondi piatti": "secondi_piatti",
+    "Contorni": "contorni",
+    "Frutta": "frutta",
+    "Dessert": "dessert",
+}
+
+NUMERIC_ID = re.compile(r"^\d+$")
+
+ALREADY_BOOKED = "Risulta già presente una prenotazione"
+
+
+def _soup(html: str) -> BeautifulSoup:
+    return BeautifulSoup(html, "html.parser")
+
+
+def extract_menu_links(html: str) -> List[Tuple[str, str]]:
+    """Coppie (testo, href) dei link in div.view-menu, nell'ordine della pagina."""
+    links = []
+    for a in _soup(html).select("div.view-menu a"):
+        text = a.get_text()
+        href = a.get("href")
+        if text and href:
+            links.append((text, href))
+    return links
+
+
+# Mensa e tipo pasto cercati ognuno per conto suo, come faceva il vecchio controllo
+# ("Mensa Pascoli" e "pranzo" nel testo): separatore, ordine e prefissi del testo
+# del link possono cambiare. Il nome finisce a un separatore, al tipo pasto o alla data.
+MEAL_TYPE = re.compile(r"\b(pranzo|cena)\b", re.IGNORECASE)
+CANTEEN_NAME = re.compile(
+    r"\b(mensa\s+.+?)\s*(?=[-–—,:;|()]|\b(?:pranzo|cena)\b|\bdel\s+\d|\d{1,2}/|$)", re.IGNORECASE
+)
+
+
+def parse_menu_link(text: str) -> Optional[Tuple[str, str]]:
+    """(nome mensa, tipo pasto) dal testo di un link dell'elenco, None se non riconosciuto.
+    "Mensa Pascoli - Pranzo del 17/10/2026" -> ("Mensa Pascoli", "pranzo")"""
+    canteen = CANTEEN_NAME.search(text)
+    meal = MEAL_TYPE.search(text)
+    if not canteen or not meal:
+        return None
+    return " ".join(canteen.group(1).split()), meal.group(1).lower()
+
+
+def looks_like_meal_link(text: str) -> bool:
+    """Link che sembra un pasto (nomina una mensa o un tipo pasto) anche se non riconosciuto."""
+    return bool(MEAL_TYPE.search(text)) or "mensa" in text.lower()
+
+
+def canteen_id(name: str) -> str:
+    """Identificativo stabile della mensa per chiavi e query: "Mensa Via del Giochetto" -> "via-del-giochetto"."""
+    slug = re.sub(r"^mensa\s+", "", name.strip().lower())
+    return re.sub(r"[^a-z0-9]+", "-", slug).strip("-")
+
+
+def parse_menu_html(html: str) -> tuple[Dict, bool, bool]:
+    """Restituisce (piatti raggruppati per categoria, prenotato, prenotabile)."""
+    soup = _soup(html)
+
+    checkbox_wrapper = soup.select_one(".js-form-item-vuoi-prenotare")
+    prenotabile = (
+        checkbox_wrapper is not None
+        and "js-webform-states-hidden" not in (checkbox_wrapper.get("class") or [])
+    )
+
+    prenotato = False
+    warning = soup.select_one(".alert.alert-warning")
+    if warning is not None and ALREADY_BOOKED in warning.get_text():
+        prenotato = True
+        prenotabile = False
+
+    grouped = {v: [] for v in CATEGORY_MAP.values()}
+    for fs in soup.find_all("fieldset"):
+        legend = fs.select_one(".fieldset-legend")
+        if legend is None:
+            continue
+        cat_key = CATEGORY_MAP.get(legend.get_text().strip())
+        if not cat_key:
+            continue
+
+        labels = {}
+        for label in fs.find_all("label"):
+            labels.setdefault(label.get("for"), label)
+        for radio in fs.select("input[type=radio]"):
+            val = radio.get("value")
+            if not val or not NUMERIC_ID.match(val.strip()):
+                continue
+            label = labels.get(radio.get("id"))
+            if label is not None:
+                grouped[cat_key].append({"id": val.strip(), "nome": label.get_text().strip()})
+
+    return grouped, prenotato, prenotabile
@@ -0,0 +1,162 @@
+"""Archivio dei menu in Redis, indicizzato per mensa × giorno × pasto.
+
+Ogni pasto è una chiave a sé (menu:{giorno}:{mensa}:{pasto}) con il solo pasto
+codificato da menu_codec; per ogni giorno un set (menu:index:{giorno}) elenca le
+coppie "{mensa}:{pasto}" presenti e un hash (menu:canteens) mappa gli id delle
+mense sul nome mostrato dal portale. Una query precisa è una sola GET, le altre
+una SMEMBERS + MGET, senza mai deserializzare un giorno intero; un intervallo di
+giorni è una pipeline di SMEMBERS + una sola MGET.
+"""
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app import menu_codec
+from app.redis_client import redis_bytes, redis_client
+
+CANTEENS_KEY = "menu:canteens"
+# giorno -> timestamp dell'ultimo scraping riuscito di quel giorno
+SCRAPED_AT_KEY = "menu:scraped_at"
+# Pubblicato con l'URL del pasto quando lo scraping lo trova prenotabile
+BOOKABLE_CHANNEL = "menu:bookable"
+MEALS = ("pranzo", "cena")
+
+# Oggi e domani più un margine: i giorni passati escono da soli
+MENU_TTL_SECONDS = 3 * 24 * 3600
+
+# Letture di SCRAPED_AT_KEY tenute in memoria per qualche secondo, per non
+# aggiungere un round trip Redis alle risposte /menu servite dalla cache
+# (le voci scadute vengono tolte a ogni inserimento: restano solo quelle recenti)
+SCRAPED_AT_CACHE_SECONDS = 5
+_scraped_at: Dict[str, Tuple[float, Optional[float]]] = {}
+
+
+def meal_key(day_str: str, canteen: str, meal: str) -> str:
+    return f"menu:{day_str}:{canteen}:{meal}"
+
+
+def hash_key(day_str: str, canteen: str, meal: str) -> str:
+    return f"menu:hash:{day_str}:{canteen}:{meal}"
+
+
+def index_key(day_str: str) -> str:
+    return f"menu:index:{day_str}"
+
+
+def _meal_order(member: str):
+    canteen, _, meal = member.partition(":")
+    return canteen, MEALS.index(meal) if meal in MEALS else len(MEALS)
+
+
+async def indexed_meals(day_str: str) -> List[str]:
+    """Coppie "{mensa}:{pasto}" salvate per il giorno, in ordine stabile."""
+    return sorted(await redis_client.smembers(index_key(day_str)), key=_meal_order)
+
+
+def _select(members: Iterable[str], canteen: Optional[str], meal: Optional[str]) -> List[str]:
+    return sorted(
+        (m for m in members
+         if (not canteen or m.partition(":")[0] == canteen) and (not meal or m.partition(":")[2] == meal)),
+        key=_meal_order,
+    )
+
+
+def _decode(raws: Iterable[Optional[bytes]]) -> List[Dict]:
+    meals = []
+    for raw in raws:
+        if not raw:
+            continue
+        try:
+            meals.append(menu_codec.decode(raw))
+        except menu_codec.CodecError as e:
+            # Es. valore scritto da una versione più nuova durante un rilascio graduale
+            print(f"Menu: pasto ignorato ({e})")
+    return meals
+
+
+async def get_meals(
+    day_str: str, canteen: Optional[str] = None, meal: Optional[str] = None
+) -> List[Dict]:
+    """Pasti del giorno, filtrati per mensa e/o tipo pasto."""
+    if canteen and meal:
+        return _decode([await redis_bytes.get(meal_key(day_str, canteen, meal))])
+
+    members = _select(await redis_client.smembers(index_key(day_str)), canteen, meal)
+    if not members:
+        return []
+    return _decode(await redis_bytes.mget([meal_key(day_str, *m.split(":", 1)) for m in members]))
+
+
+async def get_meals_range(
+    day_strs: List[str], canteen: Optional[str] = None, meal: Optional[str] = None
+) -> Dict[str, List[Dict]]:
+    """Pasti di più giorni in due round trip: gli indici in pipeline, poi una sola MGET."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for day_str in day_strs:
+            pipe.smembers(index_key(day_str))
+        indexes = await pipe.execute()
+
+    selected = [(day_str, _select(members, canteen, meal)) for day_str, members in zip(day_strs, indexes)]
+    keys = [meal_key(day_str, *m.split(":", 1)) for day_str, members in selected for m in members]
+    raws = iter(await redis_bytes.mget(keys) if keys else [])
+    return {day_str: _decode([next(raws) for _ in members]) for day_str, members in selected}
+
+
+async def find_meal_by_url(url: str, day_strs: Iterable[str]) -> Optional[Dict]:
+    """Pasto salvato con questo URL del portale tra i giorni indicati (oggi/domani)."""
+    for day_str in day_strs:
+        for meal in await get_meals(day_str):
+            if meal.get("url") == url:
+                return meal
+    return None
+
+
+async def scraped_at(day_str: str) -> Optional[float]:
+    """Quando è stato letto per intero l'ultima volta il giorno (None se mai)."""
+    cached = _scraped_at.get(day_str)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    raw = await redis_client.hget(SCRAPED_AT_KEY, day_str)
+    value = float(raw) if raw else None
+    now = time.monotonic()
+    for expired in [d for d, (expires, _) in _scraped_at.items() if expires <= now]:
+        del _scraped_at[expired]
+    _scraped_at[day_str] = (now + SCRAPED_AT_CACHE_SECONDS, value)
+    return value
+
+
+async def get_canteens() -> Dict[str, str]:
+    """id mensa -> nome sul portale."""
+    return await redis_client.hgetall(CANTEENS_KEY)
+
+
+async def canteen_exists(canteen: str) -> bool:
+    return bool(await redis_client.hexists(CANTEENS_KEY, canteen))
+
+
+async def publish_bookable(meals: Iterable[Dict]):
+    for meal in meals:
+        if meal.get("prenotabile") and meal.get("url"):
+            await redis_client.publish(BOOKABLE_CHANNEL, meal["url"])
+
+
+def stage_meal(pipe, meal_data: Dict, fingerprint: str):
+    """Accoda su una pipeline la scrittura di un pasto, della sua impronta e dell'indice."""
+    day_str, canteen, meal = meal_data["data"], meal_data["mensa_id"], meal_data["tipo_pasto"]
+    pipe.set(meal_key(day_str, canteen, meal), menu_codec.encode(meal_data), ex=MENU_TTL_SECONDS)
+    pipe.set(hash_key(day_str, canteen, meal), fingerprint, ex=MENU_TTL_SECONDS)
+    pipe.sadd(index_key(day_str), f"{canteen}:{meal}")
+    pipe.expire(index_key(day_str), MENU_TTL_SECONDS)
+    pipe.hset(CANTEENS_KEY, canteen, meal_data["mensa"])
+
+
+def stage_scraped_at(pipe, day_strs: Iterable[str], timestamp: float):
+    for day_str in day_strs:
+        pipe.hset(SCRAPED_AT_KEY, day_str, timestamp)
+
+
+def stage_removal(pipe, day_str: str, members: Iterable[str]):
+    """Accoda la cancellazione dei pasti spariti dal portale."""
+    for member in members:
+        canteen, meal = member.split(":", 1)
+        pipe.delete(meal_key(day_str, canteen, meal), hash_key(day_str, canteen, meal))
+        pipe.srem(index_key(day_str), member)
@@ -0,0 +1,270 @@
+"""Metriche in formato Prometheus e trace id nelle righe di log.
+
+Contatori, gauge e istogrammi vivono in memoria nel processo (un dict per
+metrica, nessun lock: tutto gira nell'event loop) e vengono resi in formato
+testo da GET /metrics. Il costo per osservazione è una ricerca nel dict e
+qualche somma, quindi l'instrumentazione resta sempre attiva.
+
+Con LOG_TRACE_IDS=true ogni riga stampata durante un job di prenotazione o uno
+scraping viene prefissata con il suo trace id, così i print di richieste
+concorrenti si possono separare.
+"""
+import contextvars
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # chiave -> [conteggi per bucket (non cumulativi), somma, totale]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total_sum, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total_sum!r}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+# --- METRICHE DEL BACKEND ---
+
+BOOKING_STEP_SECONDS = Histogram(
+    "booking_step_seconds", "Durata di ogni step della prenotazione", ("engine", "step"))
+BOOKINGS_TOTAL = Counter(
+    "bookings_total", "Prenotazioni concluse per motore ed esito", ("engine", "outcome"))
+BOOKING_SLOT_WAIT_SECONDS = Histogram(
+    "booking_slot_wait_seconds", "Attesa per uno slot del controllo di ammissione")
+BOOKINGS_IN_PROGRESS = Gauge(
+    "bookings_in_progress", "Prenotazioni che occupano uno slot")
+BOOKING_CONCURRENCY_LIMIT = Gauge(
+    "booking_concurrency_limit", "Limite corrente di prenotazioni contemporanee")
+BOOKINGS_REJECTED = Counter(
+    "bookings_rejected_total", "Richieste /book rifiutate con 503", ("reason",))
+BOOKING_INTERCEPTED_REQUESTS = Counter(
+    "booking_intercepted_requests_total", "Richieste dei contesti di prenotazione per esito del filtro",
+    ("action",))
+BOOKING_INTERCEPTED_BYTES = Counter(
+    "booking_intercepted_bytes_total", "Byte di script/CSS scaricati o serviti dalla cache locale", ("action",))
+BOOKING_QUEUE_DEPTH = Gauge(
+    "booking_queue_depth", "Job in attesa nella coda prenotazioni")
+
+SCRAPE_SECONDS = Histogram(
+    "scrape_seconds", "Durata di uno scraping completo o incrementale", ("mode",))
+SCRAPE_PAGE_SECONDS = Histogram(
+    "scrape_page_seconds", "Durata dello scraping di una singola pagina", ("kind",))
+
+UPSTREAM_CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open", "1 se il circuito verso il portale è aperto in questo processo")
+UPSTREAM_FAILURES = Counter(
+    "upstream_failures_total", "Errori del portale (timeout, rete, 5xx)")
+UPSTREAM_FAST_FAILS = Counter(
+    "upstream_fast_fails_total", "Chiamate al portale rifiutate subito a circuito aperto")
+
+SINGLE_FLIGHT_TOTAL = Counter(
+    "single_flight_total", "Chiamate single-flight per esito (executed, joined, replayed, busy)",
+    ("flight", "outcome"))
+
+EVENT_STREAMS = Gauge(
+    "event_streams_open", "Connessioni SSE aperte per tipo di stream", ("topic",))
+
+REDIS_COMMAND_SECONDS = Histogram(
+    "redis_command_seconds", "Latenza dei comandi Redis (pipeline come un unico comando)", ("command",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0))
+
+BROWSER_RESTARTS = Counter(
+    "browser_restarts_total", "Riavvii del browser globale per motivo (contexts, rss, crash)", ("reason",))
+
+PROCESS_RSS_BYTES = Gauge(
+    "process_resident_memory_bytes", "RSS del processo backend")
+CHROMIUM_PROCESSES = Gauge(
+    "chromium_processes", "Processi Chromium figli del backend")
+CHROMIUM_RSS_BYTES = Gauge(
+    "chromium_resident_memory_bytes", "RSS totale dei processi Chromium figli del backend")
+
+
+# --- PROCESSI ---
+
+def process_tree(root_pid: int) -> List[Tuple[int, str, int]]:
+    """(pid, nome, RSS in kB) del processo e di tutti i discendenti, letti da /proc."""
+    children: Dict[int, List[int]] = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # Il nome del processo è tra parentesi e può contenere spazi
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        name, rss_kb = "", 0
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("Name:"):
+                    name = line.partition(":")[2].strip()
+                elif line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+        except OSError:
+            continue
+        tree.append((pid, name, rss_kb))
+    return tree
+
+
+def _chromium_rss(tree: List[Tuple[int, str, int]], root_pid: int) -> List[int]:
+    return [rss for pid, name, rss in tree if pid != root_pid and ("chrom" in name or "headless" in name)]
+
+
+def chromium_rss_bytes(root_pid: int) -> int:
+    """RSS totale dei processi Chromium discendenti (0 senza /proc)."""
+    if not Path("/proc/self/status").exists():
+        return 0
+    return sum(_chromium_rss(process_tree(root_pid), root_pid)) * 1024
+
+
+def update_process_stats(root_pid: int):
+    """Aggiorna le gauge di memoria; senza /proc (non Linux) restano vuote."""
+    if not Path("/proc/self/status").exists():
+        return
+    tree = process_tree(root_pid)
+    chromium = _chromium_rss(tree, root_pid)
+    PROCESS_RSS_BYTES.set(sum(rss for pid, _, rss in tree if pid == root_pid) * 1024)
+    CHROMIUM_PROCESSES.set(len(chromium))
+    CHROMIUM_RSS_BYTES.set(sum(chromium) * 1024)
+
+
+# --- TRACE ID ---
+
+trace_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_id", default=None)
+
+
+class _TraceIdWriter:
+    """Stream che antepone il trace id corrente a ogni riga scritta."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._line_start = True
+
+    def write(self, text: str) -> int:
+        current = trace_id.get()
+        if current and text:
+            prefix = f"[{current}] "
+            lines = text.split("\n")
+            out = [(prefix if (i > 0 or self._line_start) and line else "") + line for i, line in enumerate(lines)]
+            self._stream.write("\n".join(out))
+        else:
+            self._stream.write(text)
+        if text:
+            self._line_start = text.endswith("\n")
+        return len(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def install_trace_log_prefix():
+    if not isinstance(sys.stdout, _TraceIdWriter):
+        sys.stdout = _TraceIdWriter(sys.stdout)
@@ -1,4 +1,71 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
 import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+
+from app.metrics import REDIS_COMMAND_SECONDS
 from app.settings import settings
 
-redis_client = redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+class _TimedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        start = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            REDIS_COMMAND_SECONDS.observe(time.perf_counter() - start, command="PIPELINE")
+
+
+class _TimedRedis(redis.Redis):
+    """Client Redis che registra la latenza di ogni comando (e di ogni pipeline)."""
+
+    async def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_SECONDS.observe(time.perf_counter() - start, command=str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> Pipeline:
+        return _TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+redis_client = _TimedRedis.from_url(settings.REDIS_URL, decode_responses=True)
+# Stesso server, risposte in byte: per i valori binari (menu codificati in msgpack)
+redis_bytes = _TimedRedis.from_url(settings.REDIS_URL)
+
+
+async def listen_channels(
+    channels: list[str],
+    handler: Callable[[str, str], Awaitable[None]],
+    label: str,
+    on_gap: Optional[Callable[[], None]] = None,
+):
+    """Task di background: handler(canale, messaggio) per ogni messaggio pubblicato
+    sui canali, con nuova sottoscrizione dopo ogni disconnessione. Un errore
+    dell'handler perde quel messaggio, non l'ascolto. on_gap viene chiamata quando
+    dei messaggi potrebbero essere andati persi (sottoscrizione e disconnessione)."""
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(*channels)
+            if on_gap:
+                on_gap()
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                try:
+                    await handler(message["channel"], message["data"])
+                except Exception as e:
+                    print(f"{label}: messaggio su {message['channel']} non gestito ({e!r})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"{label}: ascolto interrotto ({e}), riprovo...")
+            if on_gap:
+                on_gap()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,106 @@
+"""Aggiornamento adattivo dei menu tra uno scraping completo e l'altro.
+
+Lo scraping notturno da solo lascia i dati vecchi per ore (menu pubblicati in
+ritardo, pasti che diventano prenotabili). Questo loop ricontrolla le pagine con
+un intervallo che si adatta: REFRESH_MIN_INTERVAL_SECONDS dopo un cambiamento o
+dentro le fasce di prenotazione, altrimenti raddoppia a ogni giro senza novità
+fino a REFRESH_MAX_INTERVAL_SECONDS. Ogni giro confronta un'impronta delle parti
+rilevanti del DOM e ri-analizza/salva solo i pasti cambiati.
+
+Un worker che serve un menu di oggi o domani più vecchio di
+MENU_STALE_AFTER_SECONDS chiede un giro anticipato (request_revalidation): il
+messaggio arriva al leader, che sveglia il loop. La richiesta HTTP intanto
+riceve subito il menu vecchio. Con REFRESH_ENABLED=False il loop non gira e
+non si pubblica nulla: i dati restano quelli dello scraping notturno.
+"""
+import asyncio
+import time
+from datetime import datetime, time as dtime
+from typing import AsyncContextManager, Callable, List, Optional, Tuple
+
+from playwright.async_api import Browser
+
+from app.redis_client import listen_channels, redis_client
+from app.scraper import refresh_changed_menus
+from app.settings import settings
+
+
+REVALIDATE_CHANNEL = "menu:revalidate"
+REVALIDATE_LOCK_KEY = "menu:revalidate:lock"
+
+# Svegliato da listen_revalidations per anticipare il prossimo controllo
+_wake = asyncio.Event()
+# Ultima revalidazione chiesta da questo processo (time.monotonic)
+_last_request = float("-inf")
+
+
+def _parse_windows(windows: List[str]) -> List[Tuple[dtime, dtime]]:
+    parsed = []
+    for window in windows:
+        start, end = window.split("-")
+        parsed.append((dtime.fromisoformat(start.strip()), dtime.fromisoformat(end.strip())))
+    return parsed
+
+
+def booking_window_starts() -> List[dtime]:
+    return [start for start, _ in _parse_windows(settings.REFRESH_BOOKING_WINDOWS)]
+
+
+def in_booking_window(now: Optional[datetime] = None) -> bool:
+    current = (now or datetime.now()).time()
+    return any(start <= current < end for start, end in _parse_windows(settings.REFRESH_BOOKING_WINDOWS))
+
+
+def next_interval(current: float, changed: bool, now: Optional[datetime] = None) -> float:
+    """Intervallo fino al prossimo controllo, dato quello appena usato."""
+    if changed or in_booking_window(now):
+        return settings.REFRESH_MIN_INTERVAL_SECONDS
+    return min(current * 2, settings.REFRESH_MAX_INTERVAL_SECONDS)
+
+
+async def refresh_loop(lease_browser: Callable[[], AsyncContextManager[Browser]]):
+    """Task di background: controlli incrementali finché il processo è attivo
+    (il browser è chiesto a ogni giro, così può essere avviato al primo uso o
+    sostituito da un riciclo tra un giro e l'altro)."""
+    interval = settings.REFRESH_MIN_INTERVAL_SECONDS
+    while True:
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=interval)
+            print("Aggiornamento menu anticipato: richiesto per dati vecchi.")
+        except asyncio.TimeoutError:
+            pass
+        _wake.clear()
+        changed = 0
+        try:
+            async with lease_browser() as browser:
+                changed = await refresh_changed_menus(browser)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Aggiornamento menu non riuscito: {e}")
+        interval = next_interval(interval, changed > 0)
+        print(f"Aggiornamento menu: {changed} pasti cambiati, prossimo controllo tra {interval:.0f}s.")
+
+
+async def request_revalidation():
+    """Chiede al leader un controllo anticipato dei menu (al massimo uno ogni
+    MENU_REVALIDATE_MIN_INTERVAL_SECONDS, per tutti i worker insieme). Il limite
+    è controllato prima in memoria, così le richieste con dati vecchi non aggiungono
+    un round trip Redis a ogni risposta."""
+    global _last_request
+    if not settings.REFRESH_ENABLED:
+        return  # nessun leader in ascolto: la richiesta non verrebbe mai consumata
+    now = time.monotonic()
+    if now - _last_request < settings.MENU_REVALIDATE_MIN_INTERVAL_SECONDS:
+        return
+    _last_request = now
+    if await redis_client.set(REVALIDATE_LOCK_KEY, 1, nx=True, ex=settings.MENU_REVALIDATE_MIN_INTERVAL_SECONDS):
+        await redis_client.publish(REVALIDATE_CHANNEL, "1")
+
+
+async def listen_revalidations():
+    """Task di background del leader: sveglia refresh_loop alle richieste di revalidazione."""
+    async def on_message(channel: str, data: str):
+        _wake.set()
+
+    await listen_channels([REVALIDATE_CHANNEL], on_message, "Aggiornamento menu")
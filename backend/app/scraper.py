@@ -1,28 +1,35 @@
-import json
-import re
 import asyncio
-from datetime import date, timedelta
+import hashlib
+import time
+from datetime import date, datetime, timedelta
 from typing import List, Dict, Optional
-from playwright.async_api import async_playwright, Page, Route
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Route
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError
 
 from app.settings import settings
 from app.redis_client import redis_client
+from app.menu_parser import (
+    canteen_id, extract_menu_links, looks_like_meal_link, parse_menu_html, parse_menu_link,
+)
+from app import archive, browser_profile, menu_store
+from app.artifacts import BookingTrace
+from app.menu_cache import publish_invalidation
+from app.metrics import SCRAPE_PAGE_SECONDS, SCRAPE_SECONDS, trace_id
+from app.single_flight import SingleFlight
+from app.upstream import UpstreamUnavailable, check_status, portal
 
 # --- CONFIGURAZIONE ---
-BASE_URL = "https://intragenzia.adisu.umbria.it"
+BASE_URL = settings.PORTAL_BASE_URL.rstrip("/")
 LOGIN_URL = f"{BASE_URL}/user/login"
 MENU_TODAY = f"{BASE_URL}/menu-odierni"
 MENU_TOMORROW = f"{BASE_URL}/menu-domani"
 
-CATEGORY_MAP = {
-    "Primi piatti": "primi_piatti",
-    "Secondi piatti": "secondi_piatti",
-    "Contorni": "contorni",
-    "Frutta": "frutta",
-    "Dessert": "dessert",
-}
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
+
+
+class SessionExpiredError(Exception):
+    """Il portale ha rimandato al login: la sessione (cookie) non è più valida."""
 
-NUMERIC_ID = re.compile(r"^\d+$")
 
 # --- UTILITY PER PERFORMANCE ---
 async def block_resources(route: Route):
@@ -36,13 +43,23 @@ async def setup_optimized_page(page: Page):
     """Applica il blocco risorse a una pagina."""
     await page.route("**/*", block_resources)
 
+async def setup_optimized_context(context: BrowserContext):
+    """Applica il blocco risorse a tutte le pagine (tab) di un contesto."""
+    await context.route("**/*", block_resources)
+
 
 # --- FUNZIONI DI BASE ---
 
+async def goto_checked(page: Page, url: str, **kwargs):
+    """page.goto che tratta le risposte 5xx come errore del portale (per il circuit breaker)."""
+    response = await page.goto(url, **kwargs)
+    check_status(response.status if response else None, url)
+    return response
+
 async def login(page: Page):
     """Esegue il login al portale ADISU."""
     print(f"Eseguendo il login per {settings.MENU_USERNAME}...")
-    await page.goto(LOGIN_URL)
+    await goto_checked(page, LOGIN_URL)
     
     await page.wait_for_selector('input[name="name"]')
     await page.fill('input[name="name"]', settings.MENU_USERNAME)
@@ -52,105 +69,119 @@ async def login(page: Page):
     print("Login effettuato.")
 
 
-async def get_menu_urls(page: Page) -> List[Optional[str]]:
-    urls = [None, None, None, None] 
-    pages_to_check = [(MENU_TODAY, 0), (MENU_TOMORROW, 2)]
-    
-    for page_url, start_idx in pages_to_check:
-        print(f"Cercando link menu in: {page_url}")
-        await page.goto(page_url)
-        
-        links = page.locator("div.view-menu a")
-        count = await links.count()
-        
-        for i in range(count):
-            link = links.nth(i)
-            text = await link.text_content()
-            href = await link.get_attribute("href")
-            
-            if not text or not href:
+async def _fetch_menu_links(context: BrowserContext, page_url: str) -> List[tuple[str, str]]:
+    print(f"Cercando link menu in: {page_url}")
+    page = await context.new_page()
+    try:
+        with SCRAPE_PAGE_SECONDS.time(kind="listing"):
+            await portal.call(lambda: goto_checked(page, page_url))
+            # Un solo round trip: HTML completo analizzato in Python
+            return extract_menu_links(await page.content())
+    finally:
+        await page.close()
+
+
+def listing_days() -> tuple[date, date]:
+    """I giorni coperti dallo scraping: quelli delle pagine elenco (oggi e domani)."""
+    today = date.today()
+    return today, today + timedelta(days=1)
+
+
+async def get_meal_links(context: BrowserContext, days: tuple[date, date]) -> List[tuple[date, str, str, str]]:
+    """(giorno, mensa, tipo pasto, URL) di tutti i pasti elencati oggi e domani, per ogni mensa."""
+
+    # Le due pagine elenco vengono aperte in parallelo in due tab
+    listings = await asyncio.gather(
+        _fetch_menu_links(context, MENU_TODAY),
+        _fetch_menu_links(context, MENU_TOMORROW),
+    )
+
+    meals, seen = [], set()
+    for day_obj, links in zip(days, listings):
+        for text, href in links:
+            parsed = parse_menu_link(text)
+            if parsed is None:
+                if looks_like_meal_link(text):
+                    # Formato del portale cambiato? Senza questo log lo scraping trova zero pasti in silenzio
+                    print(f"Link del menu non riconosciuto, ignorato: {text.strip()!r} ({href})")
+                continue
+            if (day_obj, *parsed) in seen:
                 continue
+            seen.add((day_obj, *parsed))
+            full_url = href if href.startswith("http") else f"{BASE_URL}{href}"
+            meals.append((day_obj, parsed[0], parsed[1], full_url))
 
-            if "Mensa Pascoli" in text:
-                full_url = href if href.startswith("http") else f"{BASE_URL}{href}"
-                text_lower = text.lower()
-                if "pranzo" in text_lower:
-                    urls[start_idx] = full_url
-                elif "cena" in text_lower:
-                    urls[start_idx + 1] = full_url
-                    
-    return urls
+    return meals
 
 
-async def parse_menu_page(page: Page, url: str) -> tuple[Dict, bool, bool]:
-    print(f"Parsing menu: {url}")
-    await page.goto(url)
-    
-    prenotabile = False
-    checkbox_wrapper = page.locator(".js-form-item-vuoi-prenotare")
-    
-    if await checkbox_wrapper.count() > 0:
-        classes = await checkbox_wrapper.get_attribute("class") or ""
-        if "js-webform-states-hidden" in classes:
-            prenotabile = False
-        else:
-            prenotabile = True
-    else:
-        prenotabile = False
-
-    prenotato = False
-    warning_loc = page.locator(".alert.alert-warning")
-    if await warning_loc.count() > 0:
-        msg = await warning_loc.text_content()
-        if msg and "Risulta già presente una prenotazione" in msg:
-            prenotato = True
-            prenotabile = False 
-
-    grouped = {v: [] for v in CATEGORY_MAP.values()}
-    fieldsets = page.locator("fieldset")
-    fs_count = await fieldsets.count()
-    
-    for i in range(fs_count):
-        fs = fieldsets.nth(i)
-        legend_loc = fs.locator(".fieldset-legend")
-        if await legend_loc.count() == 0: continue
-            
-        legend_text = (await legend_loc.text_content()).strip()
-        cat_key = CATEGORY_MAP.get(legend_text)
-        if not cat_key: continue
-            
-        radios = fs.locator("input[type=radio]")
-        r_count = await radios.count()
-        
-        for j in range(r_count):
-            radio = radios.nth(j)
-            val = await radio.get_attribute("value")
-            if not val or not NUMERIC_ID.match(val.strip()): continue
-                
-            radio_id = await radio.get_attribute("id")
-            label_loc = fs.locator(f"label[for='{radio_id}']")
-            if await label_loc.count() > 0:
-                name = (await label_loc.text_content()).strip()
-                grouped[cat_key].append({"id": val.strip(), "nome": name})
-                
-    return grouped, prenotato, prenotabile
+VISIBLE_SCRIPT = """(selector) => Array.from(document.querySelectorAll(selector)).some(
+    (el) => !!(el.offsetWidth || el.offsetHeight || el.getClientRects().length)
+)"""
 
 
-async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
-    """Prenotazione con LOGGING AVANZATO, SCREENSHOT e gestione TAB."""
+# Timeout di default (ms) degli step del webform, sovrascrivibili con BOOKING_STEP_TIMEOUTS
+STEP_TIMEOUTS = {
+    "page_load": 30000,
+    "checkbox": 3000,
+    "cards_next": 5000,
+    "tipologia": 5000,
+    "dishes": 5000,
+    "preview": 5000,
+    "submit": 10000,
+    "confirmation": 15000,
+}
+
+
+def _step_timeout(step: str) -> int:
+    return settings.BOOKING_STEP_TIMEOUTS.get(step, STEP_TIMEOUTS[step])
+
+
+async def _wait_visible(page: Page, selector: str, step: str) -> bool:
+    """Attende che almeno un elemento del selettore sia visibile (polling su animation frame)."""
+    try:
+        await page.wait_for_function(VISIBLE_SCRIPT, arg=selector, timeout=_step_timeout(step))
+        return True
+    except PlaywrightTimeoutError:
+        return False
+
+
+async def book_meal(page: Page, meal_url: str, dish_ids: List[str], wait_mode: Optional[str] = None) -> bool:
+    """Prenotazione con LOGGING AVANZATO, TRACCIA DIAGNOSTICA e gestione TAB.
+
+    La traccia (tempi e URL degli step, snapshot HTML campionati) resta in memoria
+    e viene salvata su disco solo se la prenotazione fallisce.
+    """
+    trace = BookingTrace(meal_url)
+    success = await _book_meal_steps(page, meal_url, dish_ids, wait_mode, trace)
+    if not success:
+        await trace.persist_failure(page, "prenotazione non riuscita")
+    return success
+
+
+async def _book_meal_steps(
+    page: Page, meal_url: str, dish_ids: List[str], wait_mode: Optional[str], trace: BookingTrace
+) -> bool:
+    """wait_mode "events" attende il segnale DOM/URL preciso di ogni step del webform,
+    "sleep" usa le vecchie attese fisse + networkidle (default: BOOKING_WAIT_MODE).
+    """
+    events = (wait_mode or settings.BOOKING_WAIT_MODE) == "events"
     print(f"\n--- DEBUG START: Prenotazione su {meal_url} ---")
     
     try:
         # 1. Navigazione
-        await page.goto(meal_url)
-        await page.wait_for_load_state("networkidle")
+        if events:
+            # "load" garantisce che i behaviors JS di Drupal (tab, card) siano agganciati
+            await portal.call(lambda: goto_checked(page, meal_url, wait_until="load", timeout=_step_timeout("page_load")))
+        else:
+            await portal.call(lambda: goto_checked(page, meal_url))
+            await page.wait_for_load_state("networkidle")
         print(f"DEBUG: Pagina caricata. URL: {page.url}")
-        await page.screenshot(path="debug_1_page_loaded.png")
+        await trace.snapshot(page, "page_loaded")
 
         # Controllo Login scaduto
         if "user/login" in page.url:
              print("DEBUG: ERRORE - Redirect al login rilevato! Sessione scaduta?")
-             return False
+             raise SessionExpiredError(page.url)
 
         # --- 1-BIS. APERTURA TAB PRENOTAZIONE (FIX UTENTE) ---
         try:
@@ -162,10 +193,12 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
             if await page.locator(tab_selector).count() > 0:
                 print("DEBUG: Tab 'Prenotazione' trovato. Provo a cliccarlo...")
                 await page.click(tab_selector)
-                # Piccola attesa per l'animazione del tab
-                await asyncio.sleep(0.5)
+                # Piccola attesa per l'animazione del tab (in modalità events
+                # basta l'attesa sulla checkbox visibile qui sotto)
+                if not events:
+                    await asyncio.sleep(0.5)
                 print("DEBUG: Tab 'Prenotazione' cliccato.")
-                await page.screenshot(path="debug_1bis_tab_clicked.png")
+                await trace.snapshot(page, "tab_clicked")
             else:
                 print("DEBUG: Tab 'Prenotazione' NON trovato. Forse la pagina è già espansa?")
         except Exception as e:
@@ -175,9 +208,9 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
         try:
             # Attendiamo che la checkbox diventi visibile (dopo il click sul tab)
             try:
-                await page.wait_for_selector("#edit-vuoi-prenotare", state="visible", timeout=3000)
+                await page.wait_for_selector("#edit-vuoi-prenotare", state="visible", timeout=_step_timeout("checkbox"))
             except:
-                print("DEBUG: Checkbox non visibile entro 3s. Provo comunque a cliccarla via JS.")
+                print("DEBUG: Checkbox non visibile entro il timeout. Provo comunque a cliccarla via JS.")
 
             # Usiamo JS per cliccare in modo sicuro
             check_script = """() => {
@@ -190,6 +223,7 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
             }"""
             if await page.evaluate(check_script):
                 print("DEBUG: Checkbox 'Vuoi prenotare' attivata.")
+                trace.step("checkbox", page)
             else:
                  print("DEBUG: Impossibile cliccare la checkbox (JS false).")
                  
@@ -197,7 +231,7 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
                  error_msg = await page.locator(".messages.error").all_text_contents()
                  if error_msg:
                      print(f"DEBUG: Messaggi di errore in pagina: {error_msg}")
-                 await page.screenshot(path="debug_error_no_checkbox.png")
+                 trace.step("no_checkbox", page)
                  return False
 
         except Exception as e:
@@ -206,33 +240,43 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
 
         # Procedi 1
         try:
-            await page.wait_for_selector("#edit-cards-next", state="attached", timeout=5000)
+            await page.wait_for_selector("#edit-cards-next", state="attached", timeout=_step_timeout("cards_next"))
             await page.evaluate("() => document.querySelector('#edit-cards-next').click()")
             print("DEBUG: Cliccato 'Procedi' (Step 1).")
+            trace.step("procedi_1", page)
         except Exception as e:
             print(f"DEBUG: Errore bottone Procedi 1: {e}")
-            await page.screenshot(path="debug_error_procedi1.png")
+            trace.step("error_procedi1", page, error=str(e))
             return False
     
         # 3. Tipo Menu (Gestione opzionale se c'è solo un menu)
         try:
-            await page.wait_for_load_state("networkidle")
+            if events:
+                # Step successivo pronto: tipologia menu oppure direttamente i piatti
+                await _wait_visible(page, "#edit-tipologia-menu-standard, fieldset input[type='radio']", "tipologia")
+            else:
+                await page.wait_for_load_state("networkidle")
             if await page.locator("#edit-tipologia-menu-standard").count() > 0:
                 await page.evaluate("() => document.querySelector('#edit-tipologia-menu-standard').click()")
                 print("DEBUG: Selezionato 'Menu Standard'.")
                 
-                await page.wait_for_selector("#edit-cards-next", state="attached", timeout=5000)
+                await page.wait_for_selector("#edit-cards-next", state="attached", timeout=_step_timeout("cards_next"))
                 await page.evaluate("() => document.querySelector('#edit-cards-next').click()")
                 print("DEBUG: Cliccato 'Procedi' (Step 2).")
+                trace.step("procedi_2", page)
             else:
                 print("DEBUG: Selezione tipologia menu non trovata (potrebbe essere implicita).")
         except Exception as e:
              print(f"DEBUG: Errore/Skip Step Tipo Menu: {e}")
 
         # 4. Selezione Piatti
-        await page.wait_for_load_state("networkidle")
-        await asyncio.sleep(1) 
-        await page.screenshot(path="debug_2_dish_selection.png")
+        if events:
+            if not await _wait_visible(page, "fieldset input[type='radio']", "dishes"):
+                print("DEBUG: Radio dei piatti non visibili entro il timeout.")
+        else:
+            await page.wait_for_load_state("networkidle")
+            await asyncio.sleep(1) 
+        await trace.snapshot(page, "dish_selection")
         
         print(f"DEBUG: ID Piatti richiesti: {dish_ids}")
         
@@ -262,31 +306,34 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
                 print(f"DEBUG: ⚠️ Trovato ma non cliccabile: {dish_id}")
                 missing_dishes.append(dish_id)
 
-        # 5. Anteprima
+        # 5. Anteprima. Gli step "anteprima" e "invia" coprono click e pagina successiva,
+        # come i POST del motore HTTP: booking_step_seconds è confrontabile tra i due
         print("DEBUG: Tentativo click 'Anteprima'...")
         try:
-            await page.wait_for_selector("#edit-actions-preview-next", state="attached", timeout=5000)
+            await page.wait_for_selector("#edit-actions-preview-next", state="attached", timeout=_step_timeout("preview"))
             await page.evaluate("() => document.querySelector('#edit-actions-preview-next').click()")
             print("DEBUG: Cliccato 'Anteprima'.")
         except Exception as e:
             print(f"DEBUG: Errore bottone Anteprima: {e}")
-            await page.screenshot(path="debug_error_preview.png")
+            trace.step("error_preview", page, error=str(e))
             return False
         
         # 6. Conferma Finale
         print("DEBUG: Attendo caricamento pagina finale (bottone Invia)...")
-        await page.wait_for_load_state("networkidle")
-        await page.screenshot(path="debug_3_pre_submit.png")
+        if not events:
+            await page.wait_for_load_state("networkidle")
 
         submit_selector = 'input[value="Invia"]'
         try:
-            await page.wait_for_selector(submit_selector, state="attached", timeout=10000)
+            await page.wait_for_selector(submit_selector, state="attached", timeout=_step_timeout("submit"))
         except:
             print("DEBUG: Bottone 'Invia' NON comparso.")
             errors = await page.locator(".messages.error").all_text_contents()
             if errors:
                 print(f"DEBUG: Errori di validazione trovati: {errors}")
+            trace.step("no_submit", page)
             return False
+        await trace.snapshot(page, "anteprima")
 
         # Click INVIA
         submit_script = """() => {
@@ -297,10 +344,23 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
         
         if await page.evaluate(submit_script):
             print("DEBUG: Cliccato 'Invia'. Attesa conferma...")
-            await page.wait_for_load_state("networkidle")
-            await asyncio.sleep(3) 
-            
-            await page.screenshot(path="debug_4_success.png")
+            if events:
+                try:
+                    await page.wait_for_selector(
+                        ".messages.status, .messages.error", state="attached", timeout=_step_timeout("confirmation")
+                    )
+                except PlaywrightTimeoutError:
+                    print("DEBUG: Nessun messaggio di conferma entro il timeout.")
+            else:
+                await page.wait_for_load_state("networkidle")
+                await asyncio.sleep(3) 
+            await trace.snapshot(page, "invia")
+
+            if events:
+                errors = await page.locator(".messages.error").all_text_contents()
+                if errors:
+                    print(f"DEBUG: Errori dopo 'Invia': {errors}")
+                    return False
             
             if await page.locator(".messages.status").count() > 0:
                  success_msg = await page.locator(".messages.status").first.text_content()
@@ -310,75 +370,200 @@ async def book_meal(page: Page, meal_url: str, dish_ids: List[str]) -> bool:
             return True
         else:
             print("DEBUG: Errore JS nel click 'Invia'.")
+            trace.step("error_submit", page)
             return False
             
+    except (SessionExpiredError, UpstreamUnavailable):
+        raise
     except Exception as e:
         print(f"DEBUG: ECCEZIONE GENERALE BOOK_MEAL: {e}")
         import traceback
         traceback.print_exc()
-        await page.screenshot(path="debug_exception_crash.png")
+        trace.step("exception", page, error=str(e))
         return False
 
 
 
-async def scrape_and_cache_daily():
-    print("--- INIZIO SCRAPING GIORNALIERO ---")
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        # Usiamo user agent reale
-        context = await browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/121.0.0.0 Safari/537.36"
-        )
+# Solo le parti della pagina pasto da cui dipendono i dati salvati: prenotabilità,
+# avviso "già prenotato" e piatti (restano fuori token del form, blocchi dinamici ecc.)
+RELEVANT_DOM_SCRIPT = """() => Array.from(document.querySelectorAll(
+    '.js-form-item-vuoi-prenotare, .alert.alert-warning, fieldset'
+)).map((el) => el.outerHTML).join('')"""
+
+async def _scrape_meal(
+    context: BrowserContext, semaphore: asyncio.Semaphore, url: str, known_hash: Optional[str]
+) -> tuple[str, Optional[tuple[Dict, bool, bool]]]:
+    """Restituisce (impronta, dati del pasto); i dati sono None se l'impronta
+    coincide con known_hash, cioè la pagina non è cambiata."""
+    async with semaphore:
         page = await context.new_page()
-        
-        # OTTIMIZZAZIONE: Blocchiamo le risorse anche qui
-        await setup_optimized_page(page)
-        
         try:
-            await login(page)
-            menu_urls = await get_menu_urls(page)
-            
-            today = date.today()
-            tomorrow = today + timedelta(days=1)
-            
-            meal_definitions = [
-                (today, "pranzo"), (today, "cena"),
-                (tomorrow, "pranzo"), (tomorrow, "cena")
-            ]
-            
-            results = {today.isoformat(): [], tomorrow.isoformat(): []}
-            
-            for i, url in enumerate(menu_urls):
-                day_obj, tipo = meal_definitions[i]
-                if not url: continue
-                
-                dishes, prenotato, prenotabile = await parse_menu_page(page, url)
-                
+            print(f"Parsing menu: {url}")
+            with SCRAPE_PAGE_SECONDS.time(kind="meal"):
+                await portal.call(lambda: goto_checked(page, url))
+                relevant = await page.evaluate(RELEVANT_DOM_SCRIPT)
+                fingerprint = hashlib.sha256(f"{url}\n{relevant}".encode()).hexdigest()
+                if fingerprint == known_hash:
+                    return fingerprint, None
+                return fingerprint, parse_menu_html(await page.content())
+        finally:
+            await page.close()
+
+
+async def _scrape_with_browser(browser: Browser, only_changed: bool = False) -> int:
+    """Scraping di tutte le mense. Con only_changed ri-analizza solo i pasti la cui
+    pagina è cambiata rispetto all'ultima impronta salvata. Restituisce il numero
+    di pasti aggiornati."""
+    # Usiamo user agent reale
+    context = await browser.new_context(user_agent=USER_AGENT)
+    
+    # OTTIMIZZAZIONE: Blocchiamo le risorse su tutte le tab del contesto
+    await setup_optimized_context(context)
+    
+    try:
+        page = await context.new_page()
+        await portal.call(lambda: login(page))
+        await page.close()
+
+        days = listing_days()
+        meal_links = await get_meal_links(context, days)
+        slots = [
+            (day_obj.isoformat(), canteen, canteen_id(canteen), tipo, url)
+            for day_obj, canteen, tipo, url in meal_links
+        ]
+
+        known_hashes = [None] * len(slots)
+        if only_changed and slots:
+            known_hashes = await redis_client.mget([menu_store.hash_key(d, c, t) for d, _, c, t, _ in slots])
+        
+        # Tutte le pagine pasto di tutte le mense in parallelo (tab che condividono
+        # il login), con un limite di concorrenza. Una pagina che non si carica
+        # lascia in Redis l'ultima versione buona di quel pasto.
+        semaphore = asyncio.Semaphore(settings.SCRAPE_CONCURRENCY)
+        results = await asyncio.gather(*(
+            _scrape_meal(context, semaphore, url, known_hash)
+            for (_, _, _, _, url), known_hash in zip(slots, known_hashes)
+        ), return_exceptions=True)
+
+        changed_days = set()
+        failed_days = set()
+        updated = []
+        async with redis_client.pipeline(transaction=True) as pipe:
+            for (day_str, canteen, cid, tipo, url), result in zip(slots, results):
+                if isinstance(result, BaseException):
+                    print(f"Pasto non aggiornato ({url}): {result}")
+                    failed_days.add(day_str)
+                    continue
+                fingerprint, parsed = result
+                if parsed is None:
+                    continue
+
+                dishes, prenotato, prenotabile = parsed
                 meal_data = {
-                    "data": day_obj.isoformat(),
+                    "data": day_str,
+                    "mensa": canteen,
+                    "mensa_id": cid,
                     "tipo_pasto": tipo,
+                    "url": url,
                     "prenotato": prenotato,
                     "prenotabile": prenotabile,
                     "piatti": dishes
                 }
-                results[day_obj.isoformat()].append(meal_data)
-            
-            for day_str, meals in results.items():
-                if meals:
-                    key = f"menu:{day_str}"
-                    await redis_client.set(key, json.dumps(meals))
-                    print(f"Salvato menu per {day_str} ({len(meals)} pasti).")
-                else:
-                    print(f"Nessun dato per {day_str}.")
+                menu_store.stage_meal(pipe, meal_data, fingerprint)
+                changed_days.add(day_str)
+                updated.append(meal_data)
+
+            # Pasti spariti dall'elenco (solo per i giorni il cui elenco non era vuoto:
+            # un elenco vuoto può essere un problema temporaneo del portale)
+            for day_str in {slot[0] for slot in slots}:
+                current = {f"{cid}:{tipo}" for d, _, cid, tipo, _ in slots if d == day_str}
+                stale = set(await menu_store.indexed_meals(day_str)) - current
+                if stale:
+                    menu_store.stage_removal(pipe, day_str, stale)
+                    changed_days.add(day_str)
+            # Solo i giorni letti per intero contano come aggiornati (età del menu servito).
+            # Anche un giorno senza pasti in elenco è stato letto: senza data resterebbe
+            # "vecchio" per sempre e ogni richiesta chiederebbe una revalidazione
+            menu_store.stage_scraped_at(pipe, {d.isoformat() for d in days} - failed_days, time.time())
+            await pipe.execute()
+
+        for day_str in sorted(changed_days):
+            print(f"Salvato menu per {day_str} ({sum(1 for s in slots if s[0] == day_str)} pasti).")
+        if not slots:
+            print("Nessun pasto trovato negli elenchi.")
+        if failed_days:
+            print(f"Scraping parziale: pagine non caricate per {', '.join(sorted(failed_days))}.")
+
+        # Le risposte /menu in cache nei worker vanno ricostruite
+        await publish_invalidation(sorted(changed_days))
+        # Le prenotazioni programmate aspettano questo segnale per partire
+        await menu_store.publish_bookable(updated)
+        # Storico su SQLite in background: lo scraping non aspetta la scrittura
+        archive.archive_in_background(updated)
+        return len(updated)
+    finally:
+        await context.close()
+
+
+# Avvio, cron giornaliero, refresh e script non fanno mai due scraping insieme
+_scrapes = SingleFlight(
+    "scrape",
+    lock_seconds=settings.SCRAPE_LOCK_SECONDS,
+    result_ttl_seconds=settings.SCRAPE_COALESCE_SECONDS,
+    wait_seconds=settings.SCRAPE_LOCK_SECONDS,
+    poll_seconds=1.0,
+)
+
+
+async def _run_scrape(browser: Optional[Browser], only_changed: bool) -> int:
+    """Se uno scraping è già in corso (o appena finito) ne restituisce l'esito invece
+    di ripeterlo: completo e incrementale lasciano in Redis gli stessi dati."""
+    changed, replayed = await _scrapes.run("menus", lambda: _scrape_once(browser, only_changed))
+    if replayed:
+        print(f"Scraping già in corso o appena concluso: ne riuso l'esito ({changed} pasti aggiornati).")
+    return changed
+
+
+async def _scrape_once(browser: Optional[Browser], only_changed: bool) -> int:
+    """Usa il browser passato (quello globale) se presente, altrimenti ne avvia
+    uno dedicato (es. lanciato da script)."""
+    mode = "incremental" if only_changed else "full"
+    # A circuito aperto niente browser né login: si riprova al prossimo giro
+    await portal.check()
+    token = trace_id.set(f"scrape-{mode}-{datetime.now():%H%M%S}")
+    try:
+        with SCRAPE_SECONDS.time(mode=mode):
+            if browser is not None:
+                return await _scrape_with_browser(browser, only_changed)
+            async with async_playwright() as p:
+                own_browser = await p.chromium.launch(**browser_profile.launch_options())
+                try:
+                    return await _scrape_with_browser(own_browser, only_changed)
+                finally:
+                    await own_browser.close()
+    finally:
+        trace_id.reset(token)
+
+
+async def scrape_and_cache_daily(browser: Optional[Browser] = None):
+    """Scraping completo dei menu di oggi e domani."""
+    print("--- INIZIO SCRAPING GIORNALIERO ---")
+    try:
+        await _run_scrape(browser, only_changed=False)
+    except UpstreamUnavailable as e:
+        print(f"Scraping rimandato: {e}. Restano in uso gli ultimi menu salvati.")
+    except Exception as e:
+        print(f"ERRORE CRITICO SCRAPING: {e}")
+    finally:
+        print("--- FINE SCRAPING GIORNALIERO ---")
 
-        except Exception as e:
-            print(f"ERRORE CRITICO SCRAPING: {e}")
-        finally:
-            await browser.close()
-            print("--- FINE SCRAPING GIORNALIERO ---")
-
-async def get_cached_menu(day: date):
-    key = f"menu:{day.isoformat()}"
-    raw = await redis_client.get(key)
-    if not raw: return None
-    return json.loads(raw)
+
+async def refresh_changed_menus(browser: Optional[Browser] = None) -> int:
+    """Aggiornamento incrementale: ri-analizza e salva solo i pasti la cui pagina
+    è cambiata. Restituisce quanti pasti sono cambiati."""
+    return await _run_scrape(browser, only_changed=True)
+
+async def get_cached_menu(day: date) -> Optional[List[Dict]]:
+    """Pasti del giorno della mensa predefinita (formato delle rotte /menu/today e /menu/tomorrow)."""
+    meals = await menu_store.get_meals(day.isoformat(), canteen=canteen_id(settings.DEFAULT_CANTEEN))
+    return meals or None
@@ -0,0 +1,91 @@
+"""Cache cifrata delle sessioni Drupal per utente, per saltare il login in /book.
+
+In Redis finiscono solo i cookie del portale, cifrati con Fernet, sotto una
+chiave derivata dall'hash dello username. Insieme ai cookie viene salvato un
+HMAC della password: la sessione viene riusata solo da chi conosce ancora la
+password giusta.
+"""
+import hashlib
+import hmac
+import json
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+import httpx
+from cryptography.fernet import Fernet, InvalidToken
+
+from app.redis_client import redis_client
+from app.settings import settings
+
+# Formato comune dei cookie: quello di Playwright (context.cookies / add_cookies)
+Cookies = List[Dict]
+
+
+def enabled() -> bool:
+    return settings.SESSION_CACHE_ENABLED and bool(settings.SESSION_ENCRYPTION_KEY)
+
+
+@lru_cache(maxsize=1)
+def _fernet() -> Optional[Fernet]:
+    if not enabled():
+        return None
+    return Fernet(settings.SESSION_ENCRYPTION_KEY.encode())
+
+
+def _key(username: str) -> str:
+    return f"session:{hashlib.sha256(username.encode()).hexdigest()}"
+
+
+def _password_tag(password: str) -> str:
+    secret = settings.SESSION_ENCRYPTION_KEY.encode()
+    return hmac.new(secret, password.encode(), hashlib.sha256).hexdigest()
+
+
+async def load_session(username: str, password: str) -> Optional[Cookies]:
+    """Cookie salvati per l'utente, oppure None (cache spenta, scaduta o password diversa)."""
+    fernet = _fernet()
+    if fernet is None:
+        return None
+
+    token = await redis_client.get(_key(username))
+    if not token:
+        return None
+    try:
+        data = json.loads(fernet.decrypt(token.encode()))
+    except (InvalidToken, ValueError):
+        return None
+
+    if not hmac.compare_digest(data.get("pw", ""), _password_tag(password)):
+        return None
+    return data.get("cookies") or None
+
+
+async def save_session(username: str, password: str, cookies: Cookies):
+    fernet = _fernet()
+    if fernet is None or not cookies:
+        return
+    payload = json.dumps({"pw": _password_tag(password), "cookies": cookies})
+    token = fernet.encrypt(payload.encode()).decode()
+    await redis_client.set(_key(username), token, ex=settings.SESSION_TTL_SECONDS)
+
+
+# --- CONVERSIONE COOKIE httpx <-> Playwright ---
+
+def cookies_from_httpx(client: httpx.AsyncClient) -> Cookies:
+    return [
+        {
+            "name": c.name,
+            "value": c.value or "",
+            "domain": c.domain,
+            "path": c.path or "/",
+            "expires": c.expires if c.expires is not None else -1,
+            "httpOnly": c.has_nonstandard_attr("HttpOnly"),
+            "secure": c.secure,
+        }
+        for c in client.cookies.jar
+    ]
+
+
+def apply_to_httpx(client: httpx.AsyncClient, cookies: Cookies):
+    for c in cookies:
+        client.cookies.set(c["name"], c["value"], domain=c["domain"], path=c.get("path", "/"))
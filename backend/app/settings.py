@@ -1,3 +1,5 @@
+from typing import Dict, List
+
 from pydantic_settings import BaseSettings
 
 
@@ -6,6 +8,169 @@ class Settings(BaseSettings):
     MENU_PASSWORD: str
     REDIS_URL: str = "redis://localhost:6379/0"
 
+    # Portale ADISU (sovrascrivibile per puntare a un portale finto in locale)
+    PORTAL_BASE_URL: str = "https://intragenzia.adisu.umbria.it"
+
+    # Motore di prenotazione: "playwright" (browser) oppure "http" (richieste dirette)
+    BOOKING_ENGINE: str = "playwright"
+    # Se il motore HTTP non riesce a interpretare il form si ripiega su Playwright
+    BOOKING_HTTP_FALLBACK: bool = True
+    BOOKING_HTTP_TIMEOUT: float = 20.0
+
+    # Attese nel flusso Playwright: "events" (segnali DOM/URL di ogni step) oppure
+    # "sleep" (attese fisse + networkidle, comportamento storico).
+    BOOKING_WAIT_MODE: str = "events"
+    # Timeout in ms per step, es. '{"confirmation": 20000}' (gli step non indicati usano i default)
+    BOOKING_STEP_TIMEOUTS: Dict[str, int] = {}
+
+    # Diagnostica prenotazioni: artefatti salvati solo per quelle fallite
+    ARTIFACTS_DIR: str = "artifacts"
+    ARTIFACTS_MAX_RUNS: int = 50          # cartelle conservate (le più vecchie vengono cancellate; 0 = nessuna)
+    ARTIFACTS_SNAPSHOTS: int = 5          # snapshot HTML tenuti in memoria per richiesta
+    ARTIFACTS_SAMPLE_RATE: float = 0.1    # frazione di richieste con snapshot HTML degli step
+
+    # Coda prenotazioni: worker per processo e durata dello stato dei job. Un job in
+    # esecuzione rinnova il suo lease; se non lo fa per LEASE secondi (worker morto)
+    # viene segnato come fallito e il pasto torna prenotabile
+    BOOKING_WORKERS: int = 5
+    BOOKING_JOB_TTL_SECONDS: int = 86400
+    BOOKING_JOB_LEASE_SECONDS: int = 120
+
+    # POST /book/batch: pasti per richiesta e prenotazioni contemporanee (tab o
+    # richieste HTTP) nella stessa sessione; 1 = una dopo l'altra
+    BOOKING_BATCH_MAX_ITEMS: int = 6
+    BOOKING_BATCH_PARALLEL: int = 3
+
+    # Chiave Fernet (obbligatoria) per le password dei job in coda e per la cache delle
+    # sessioni utente in Redis, uguale in tutti i processi. Generabile con
+    # `python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`.
+    SESSION_ENCRYPTION_KEY: str = ""
+    # Cache delle sessioni: False = login a ogni prenotazione
+    SESSION_CACHE_ENABLED: bool = True
+    SESSION_TTL_SECONDS: int = 3600
+
+    # Durata massima di una risposta /menu nella cache in-process (rete di sicurezza
+    # nel caso un'invalidazione via pub/sub vada persa)
+    MENU_CACHE_TTL_SECONDS: int = 300
+    # Risposte tenute al massimo nella cache in-process (le meno usate escono per prime)
+    MENU_CACHE_MAX_ENTRIES: int = 512
+    # Formato dei pasti salvati in Redis: "msgpack" (compatto, con versione di schema)
+    # o "json"; i valori già salvati restano leggibili in entrambi i casi
+    MENU_CODEC: str = "msgpack"
+    # Giorni massimi per richiesta a /menu/range
+    MENU_RANGE_MAX_DAYS: int = 14
+
+    # Pagine menu analizzate in parallelo (tab) durante lo scraping
+    SCRAPE_CONCURRENCY: int = 4
+    # Mensa servita dalle rotte /menu/today e /menu/tomorrow (le altre via /menu?canteen=)
+    DEFAULT_CANTEEN: str = "Mensa Pascoli"
+
+    # Storico dei menu (SQLite) per ricerca piatti e statistiche
+    ARCHIVE_ENABLED: bool = True
+    ARCHIVE_PATH: str = "menu_archive.sqlite3"
+
+    # Aggiornamento adattivo dei menu tra uno scraping completo e l'altro: intervallo
+    # minimo dopo un cambiamento o nelle fasce di prenotazione, poi raddoppia fino al massimo
+    REFRESH_ENABLED: bool = True
+    REFRESH_MIN_INTERVAL_SECONDS: int = 120
+    REFRESH_MAX_INTERVAL_SECONDS: int = 1800
+    REFRESH_BOOKING_WINDOWS: List[str] = ["10:00-14:00", "17:00-20:00"]
+
+    # Filtro delle richieste nelle prenotazioni Playwright: "selective" lascia passare
+    # documento, script, XHR e CSS del portale (più BOOKING_ALLOWED_HOSTS) e blocca
+    # i tipi e gli URL elencati e ogni altro host; "off" scarica tutto. Spento finché
+    # bench.verify_interception non passa su un HAR registrato dal portale vero
+    BOOKING_INTERCEPTION: str = "off"
+    BOOKING_ALLOWED_HOSTS: List[str] = []
+    BOOKING_BLOCKED_RESOURCE_TYPES: List[str] = ["image", "media", "font", "manifest", "texttrack"]
+    BOOKING_BLOCKED_URL_PATTERNS: List[str] = [
+        "google-analytics", "googletagmanager", "gtag/js", "matomo", "piwik",
+        "hotjar", "facebook", "doubleclick",
+    ]
+    # Cache in memoria di script e CSS del portale, condivisa tra i contesti del processo
+    BOOKING_STATIC_CACHE: bool = True
+    BOOKING_STATIC_CACHE_MAX_MB: int = 32
+    BOOKING_STATIC_CACHE_TTL_SECONDS: int = 3600
+
+    # Profilo di avvio di Chromium (vedi app.browser_profile). CHANNEL vuoto = headless
+    # shell di Playwright; SINGLE_PROCESS risparmia RAM ma un crash ferma tutto il browser
+    BROWSER_CHANNEL: str = ""
+    BROWSER_LOW_MEMORY: bool = True
+    BROWSER_JS_HEAP_MB: int = 256          # heap V8 massimo per renderer (0 = default)
+    BROWSER_RENDERER_PROCESS_LIMIT: int = 0
+    BROWSER_SINGLE_PROCESS: bool = False
+    BROWSER_EXTRA_ARGS: List[str] = []
+
+    # Riciclo del browser globale: dopo N contesti creati o oltre RSS MB di Chromium
+    # (0 = mai) viene riavviato appena è inattivo, o dopo DRAIN secondi smettendo di
+    # accettare lavoro nuovo e aspettando quello in corso. Controllo ogni CHECK secondi
+    BROWSER_RECYCLE_AFTER_CONTEXTS: int = 500
+    BROWSER_RECYCLE_RSS_MB: int = 1500
+    BROWSER_DRAIN_TIMEOUT_SECONDS: int = 120
+    BROWSER_CHECK_SECONDS: int = 30
+
+    # Pool di contesti browser per le prenotazioni
+    BROWSER_POOL_SIZE: int = 5
+    BROWSER_POOL_MAX_USES: int = 20       # dopo K prenotazioni il contesto viene ricreato
+    BROWSER_POOL_MAX_HEAP_MB: int = 150   # heap JS oltre cui il contesto viene ricreato
+
+    # Prefisso [trace id] sulle righe di log dei job di prenotazione e degli scraping
+    LOG_TRACE_IDS: bool = False
+
+    # Controllo di ammissione delle prenotazioni: limite di concorrenza adattivo
+    # tra MIN e MAX, ridotto se il portale rallenta, sbaglia o la RAM scarseggia
+    ADMISSION_INITIAL_CONCURRENCY: int = 5
+    ADMISSION_MIN_CONCURRENCY: int = 1
+    ADMISSION_MAX_CONCURRENCY: int = 10
+    ADMISSION_TARGET_LATENCY_SECONDS: float = 20.0   # durata media di una prenotazione oltre cui si riduce
+    ADMISSION_MAX_ERROR_RATE: float = 0.2
+    ADMISSION_MIN_FREE_MEMORY_MB: int = 300
+    ADMISSION_PER_USER_LIMIT: int = 2                # prenotazioni attive (in coda o in corso) per utente
+    ADMISSION_MAX_WAIT_SECONDS: float = 60.0         # attesa stimata in coda oltre cui /book risponde 503
+
+    # Prenotazioni programmate: login anticipato prima dell'apertura e durata delle intenzioni
+    INTENT_PREARM_SECONDS: int = 120
+    INTENT_TTL_SECONDS: int = 2 * 86400
+
+    # Con più worker uvicorn scraping e scheduler girano in un solo processo (leader):
+    # il lease su Redis scade dopo LEASE secondi se non viene rinnovato
+    LEADER_LEASE_SECONDS: int = 15
+    LEADER_RENEW_SECONDS: int = 5
+
+    # Chromium parte al primo uso; con il motore playwright viene avviato in anticipo
+    # all'inizio di ogni fascia di prenotazione (REFRESH_BOOKING_WINDOWS)
+    BROWSER_WARMUP_AT_WINDOWS: bool = True
+
+    # Stream SSE (/events/menu, /book/{job_id}/events): keep-alive per i proxy
+    # ed eventi tenuti in coda per connessione prima di scartare i più vecchi
+    EVENTS_HEARTBEAT_SECONDS: int = 15
+    EVENTS_QUEUE_SIZE: int = 100
+
+    # Scraping unico: uno scraping già in corso (in questo o in un altro processo) viene
+    # atteso invece di ripeterlo, e il suo esito vale anche per chi arriva entro COALESCE secondi
+    SCRAPE_LOCK_SECONDS: int = 900
+    SCRAPE_COALESCE_SECONDS: int = 30
+
+    # Header Idempotency-Key su POST /book, /book/batch e /book/intents: la stessa chiave
+    # restituisce la stessa risorsa per TTL secondi; una richiesta identica ancora in corso
+    # viene attesa al massimo WAIT secondi
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+    IDEMPOTENCY_WAIT_SECONDS: float = 10.0
+
+    # Circuit breaker verso il portale: dopo THRESHOLD errori di fila (timeout, rete, 5xx)
+    # le chiamate falliscono subito per OPEN_SECONDS; le richieste idempotenti vengono
+    # ritentate RETRIES volte con backoff esponenziale a jitter (base e tetto in secondi)
+    UPSTREAM_FAILURE_THRESHOLD: int = 5
+    UPSTREAM_OPEN_SECONDS: int = 30
+    UPSTREAM_RETRIES: int = 2
+    UPSTREAM_RETRY_BASE_SECONDS: float = 0.5
+    UPSTREAM_RETRY_MAX_SECONDS: float = 5.0
+
+    # Menu serviti anche se vecchi (header X-Menu-Age / X-Menu-Freshness): oltre STALE_AFTER
+    # la richiesta chiede al leader un aggiornamento in background, al massimo ogni MIN_INTERVAL
+    MENU_STALE_AFTER_SECONDS: int = 3600
+    MENU_REVALIDATE_MIN_INTERVAL_SECONDS: int = 60
+
     class Config:
         env_file = ".env"
 
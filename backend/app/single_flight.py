@@ -0,0 +1,132 @@
+"""Esecuzioni uniche per chiave (single-flight), nel processo e tra i worker.
+
+Lavoro identico avviato più volte insieme (scraping lanciato all'avvio, dal
+cron e dal refresh; la stessa richiesta POST ritentata da un client dopo un
+timeout) veniva eseguito ogni volta. Con SingleFlight.run(chiave, fn):
+  - nello stesso processo le chiamate concorrenti aspettano il future di
+    quella già partita;
+  - tra processi la prima prende un lock su Redis (SET NX con scadenza) e le
+    altre aspettano che lo rilasci, poi leggono il risultato;
+  - il risultato resta in Redis per result_ttl_seconds: chi arriva dopo lo
+    riceve di nuovo (replay) senza rieseguire fn.
+Se fn fallisce il risultato non viene salvato e la chiamata successiva riprova.
+Con un'impronta (fingerprint) la stessa chiave usata per una richiesta diversa
+dà FlightConflict, come vuole la semantica di Idempotency-Key.
+"""
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from app.leader import RELEASE_SCRIPT
+from app.metrics import SINGLE_FLIGHT_TOTAL
+from app.redis_client import redis_client
+
+# Salva il risultato e rilascia il lock (solo se ancora nostro) in un colpo solo,
+# così chi aspetta il rilascio trova sempre il risultato
+COMPLETE_SCRIPT = redis_client.register_script("""
+if tonumber(ARGV[3]) > 0 then
+    redis.call('set', KEYS[2], ARGV[2], 'ex', ARGV[3])
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+return 1
+""")
+
+
+class FlightConflict(Exception):
+    """La chiave è già stata usata per una richiesta diversa."""
+
+
+class FlightBusy(Exception):
+    """L'esecuzione in corso in un altro processo non è finita entro l'attesa massima."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Richiesta identica ancora in corso")
+        self.retry_after = max(1, round(retry_after))
+
+
+class SingleFlight:
+    def __init__(
+        self,
+        name: str,
+        lock_seconds: float,
+        result_ttl_seconds: int,
+        wait_seconds: float,
+        poll_seconds: float = 0.1,
+    ):
+        self.name = name
+        self.lock_ms = int(lock_seconds * 1000)
+        self.result_ttl_seconds = result_ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _lock_key(self, key: str) -> str:
+        return f"flight:{self.name}:lock:{key}"
+
+    def _result_key(self, key: str) -> str:
+        return f"flight:{self.name}:result:{key}"
+
+    def _checked(self, stored_fingerprint: str, fingerprint: str, value: Any) -> Any:
+        if stored_fingerprint != fingerprint:
+            raise FlightConflict(f"Chiave già usata per una richiesta diversa ({self.name})")
+        return value
+
+    async def run(
+        self, key: str, fn: Callable[[], Awaitable[Any]], fingerprint: str = ""
+    ) -> Tuple[Any, bool]:
+        """(risultato, replayed): replayed è True se il risultato viene da un'altra
+        esecuzione (in corso o finita da poco) invece che da questa chiamata.
+        Il risultato deve essere serializzabile in JSON."""
+        pending = self._inflight.get(key)
+        if pending is not None:
+            SINGLE_FLIGHT_TOTAL.inc(flight=self.name, outcome="joined")
+            stored_fingerprint, value = await asyncio.shield(pending)
+            return self._checked(stored_fingerprint, fingerprint, value), True
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value, replayed = await self._run_shared(key, fn, fingerprint)
+            future.set_result((fingerprint, value))
+            return value, replayed
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # evita il warning "exception was never retrieved"
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _run_shared(
+        self, key: str, fn: Callable[[], Awaitable[Any]], fingerprint: str
+    ) -> Tuple[Any, bool]:
+        lock_key, result_key = self._lock_key(key), self._result_key(key)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            stored = await redis_client.get(result_key)
+            if stored is not None:
+                data = json.loads(stored)
+                SINGLE_FLIGHT_TOTAL.inc(flight=self.name, outcome="replayed")
+                return self._checked(data["fingerprint"], fingerprint, data["value"]), True
+            if await redis_client.set(lock_key, token, nx=True, px=self.lock_ms):
+                break
+            # In corso in un altro processo: si aspetta il rilascio del lock (o la sua
+            # scadenza, se quel processo è morto) e si riprova
+            if time.monotonic() >= deadline:
+                SINGLE_FLIGHT_TOTAL.inc(flight=self.name, outcome="busy")
+                raise FlightBusy(self.poll_seconds)
+            await asyncio.sleep(self.poll_seconds)
+
+        SINGLE_FLIGHT_TOTAL.inc(flight=self.name, outcome="executed")
+        try:
+            value = await fn()
+        except BaseException:
+            await RELEASE_SCRIPT(keys=[lock_key], args=[token])
+            raise
+        payload = json.dumps({"fingerprint": fingerprint, "value": value})
+        await COMPLETE_SCRIPT(keys=[lock_key, result_key], args=[token, payload, self.result_ttl_seconds])
+        return value, False
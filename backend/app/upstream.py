@@ -0,0 +1,188 @@
+"""Salute del portale: circuit breaker e retry condivisi da scraping e prenotazioni.
+
+Quando il portale è lento o giù, ogni richiesta aspettava i timeout di
+Playwright/httpx (decine di secondi) e occupava uno slot. Ora ogni chiamata al
+portale passa da `portal`:
+  - dopo UPSTREAM_FAILURE_THRESHOLD errori di fila (timeout, errori di rete,
+    risposte 5xx) il circuito si apre per UPSTREAM_OPEN_SECONDS e le chiamate
+    falliscono subito con UpstreamUnavailable;
+  - scaduta l'attesa passa una sola chiamata di prova: se va bene il circuito
+    si richiude, altrimenti resta aperto per un altro giro;
+  - l'apertura viene scritta anche in Redis (UPSTREAM_OPEN_KEY), così gli altri
+    worker smettono di insistere senza dover accumulare errori a loro volta.
+Le sole richieste idempotenti (navigazioni GET, login) vengono ritentate con
+backoff esponenziale a jitter pieno; gli invii del webform mai.
+"""
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+from playwright.async_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+
+from app.metrics import UPSTREAM_CIRCUIT_OPEN, UPSTREAM_FAILURES, UPSTREAM_FAST_FAILS
+from app.redis_client import redis_client
+from app.settings import settings
+
+UPSTREAM_OPEN_KEY = "upstream:portal:open"
+
+T = TypeVar("T")
+
+
+class UpstreamUnavailable(Exception):
+    """Circuito aperto: il portale non viene nemmeno contattato."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Portale non disponibile, riprova tra {retry_after:.0f}s")
+        self.retry_after = max(1, round(retry_after))
+
+
+class UpstreamError(Exception):
+    """Il portale ha risposto con un errore lato server (5xx)."""
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Errori che dicono qualcosa sulla salute del portale (non sulle credenziali o sul form)."""
+    if isinstance(error, (UpstreamError, PlaywrightTimeoutError, httpx.TransportError)):
+        return True
+    return isinstance(error, PlaywrightError) and "net::" in str(error)
+
+
+def check_status(status: Optional[int], url: str):
+    if status is not None and status >= 500:
+        raise UpstreamError(f"{url} ha risposto {status}")
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, open_seconds: float, shared_key: Optional[str] = None):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.shared_key = shared_key
+        self.failures = 0
+        self._open_until = 0.0
+        self._tripped = False
+        self._probing = False
+
+        # Statistiche
+        self.trips = 0
+        self.fast_fails = 0
+
+    @property
+    def state(self) -> str:
+        if not self._tripped:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until else "half_open"
+
+    async def _shared_retry_after(self) -> float:
+        if not self.shared_key:
+            return 0.0
+        try:
+            ttl_ms = await redis_client.pttl(self.shared_key)
+        except Exception:
+            return 0.0
+        return ttl_ms / 1000 if ttl_ms > 0 else 0.0
+
+    def _fast_fail(self, retry_after: float):
+        self.fast_fails += 1
+        UPSTREAM_FAST_FAILS.inc()
+        raise UpstreamUnavailable(retry_after)
+
+    async def check(self):
+        """Fallisce subito se il circuito è aperto, qui o in un altro worker."""
+        remaining = self._open_until - time.monotonic()
+        if self._tripped and remaining > 0:
+            self._fast_fail(remaining)
+        if not self._tripped:
+            shared = await self._shared_retry_after()
+            if shared > 0:
+                self._fast_fail(shared)
+
+    async def before_call(self):
+        await self.check()
+        if self.state == "half_open":
+            # Una sola chiamata di prova alla volta
+            if self._probing:
+                self._fast_fail(1)
+            self._probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self._probing = False
+        if self._tripped:
+            self._tripped = False
+            UPSTREAM_CIRCUIT_OPEN.set(0)
+            print("Portale: circuito richiuso, il portale risponde di nuovo.")
+
+    async def record_failure(self, error: BaseException):
+        UPSTREAM_FAILURES.inc()
+        self.failures += 1
+        was_probe, self._probing = self._probing, False
+        if not was_probe and self.failures < self.failure_threshold:
+            return
+        if self._tripped and not was_probe and time.monotonic() < self._open_until:
+            return
+        self._tripped = True
+        self._open_until = time.monotonic() + self.open_seconds
+        self.trips += 1
+        UPSTREAM_CIRCUIT_OPEN.set(1)
+        print(f"Portale: circuito aperto per {self.open_seconds:.0f}s dopo {self.failures} errori ({error}).")
+        if self.shared_key:
+            try:
+                await redis_client.set(self.shared_key, 1, px=int(self.open_seconds * 1000))
+            except Exception as e:
+                print(f"Portale: stato del circuito non condiviso ({e}).")
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """Una chiamata al portale: fallisce subito a circuito aperto e registra l'esito."""
+        await self.before_call()
+        try:
+            yield
+        except BaseException as e:
+            if is_upstream_failure(e):
+                await self.record_failure(e)
+            else:
+                # Anche un errore "applicativo" vuol dire che il portale ha risposto
+                self._probing = False
+            raise
+        else:
+            self.record_success()
+
+    async def call(
+        self, fn: Callable[[], Awaitable[T]], retries: Optional[int] = None
+    ) -> T:
+        """Esegue fn() sotto il circuito ritentando gli errori del portale con backoff
+        esponenziale a jitter pieno. Solo per operazioni idempotenti."""
+        retries = settings.UPSTREAM_RETRIES if retries is None else retries
+        for attempt in range(retries + 1):
+            try:
+                async with self.guard():
+                    return await fn()
+            except UpstreamUnavailable:
+                raise
+            except Exception as e:
+                if not is_upstream_failure(e) or attempt == retries:
+                    raise
+                cap = min(settings.UPSTREAM_RETRY_MAX_SECONDS, settings.UPSTREAM_RETRY_BASE_SECONDS * 2 ** attempt)
+                delay = random.uniform(0, cap)
+                print(f"Portale: tentativo {attempt + 1} non riuscito ({e}), riprovo tra {delay:.1f}s.")
+                await asyncio.sleep(delay)
+
+    async def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "open_for_s": round(max(0.0, self._open_until - time.monotonic()), 1) if self._tripped else 0.0,
+            "shared_open_for_s": round(await self._shared_retry_after(), 1),
+            "trips": self.trips,
+            "fast_fails": self.fast_fails,
+        }
+
+
+portal = CircuitBreaker(
+    failure_threshold=settings.UPSTREAM_FAILURE_THRESHOLD,
+    open_seconds=settings.UPSTREAM_OPEN_SECONDS,
+    shared_key=UPSTREAM_OPEN_KEY,
+)
@@ -0,0 +1,68 @@
+"""Benchmark delle attese di book_meal: modalità "sleep" vs "events".
+
+Avvia il portale finto nello stesso processo, esegue N prenotazioni Playwright
+per modalità (un utente nuovo per ognuna, login escluso dalla misura) e
+confronta i tempi.
+
+    uv run python -m bench.booking_waits [--runs 10] [--port 8081]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+
+def _configure_env(port: int):
+    # Va fatto prima di importare app.*: gli URL del portale sono letti all'import
+    os.environ.setdefault("MENU_USERNAME", "bench")
+    os.environ.setdefault("MENU_PASSWORD", "password")
+    os.environ["PORTAL_BASE_URL"] = f"http://127.0.0.1:{port}"
+
+
+async def main(runs: int, port: int):
+    from playwright.async_api import async_playwright
+
+    from app.main import playwright_login
+    from app.scraper import BASE_URL, USER_AGENT, book_meal
+    from bench import fake_portal
+
+    meal_url = f"{BASE_URL}/node/101"
+    dish_ids = ["10101", "10104", "10107"]
+
+    async with fake_portal.running(port):
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=True)
+            results = {}
+            for mode in ("sleep", "events"):
+                samples = []
+                for i in range(runs):
+                    context = await browser.new_context(user_agent=USER_AGENT)
+                    page = await context.new_page()
+                    try:
+                        await playwright_login(page, f"bench-{mode}-{i}", fake_portal.PASSWORD)
+                        start = time.perf_counter()
+                        ok = await book_meal(page, meal_url, dish_ids, wait_mode=mode)
+                        samples.append(time.perf_counter() - start)
+                        assert ok, f"prenotazione fallita in modalità {mode}"
+                    finally:
+                        await context.close()
+                results[mode] = samples
+            await browser.close()
+
+    print()
+    for mode, samples in results.items():
+        samples.sort()
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        print(f"{mode:<7} p50 {statistics.median(samples) * 1000:8.0f} ms   p95 {p95 * 1000:8.0f} ms")
+    gain = statistics.median(results["sleep"]) - statistics.median(results["events"])
+    print(f"Risparmio mediano per prenotazione: {gain * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    _configure_env(args.port)
+    asyncio.run(main(args.runs, args.port))
@@ -0,0 +1,420 @@
+"""Portale finto che imita le pagine Drupal di intragenzia.adisu.umbria.it.
+
+Serve il form di login, le pagine elenco menu-odierni/menu-domani, le pagine
+dei pasti (fieldset con i piatti) e il webform di prenotazione (card JS +
+Anteprima + Invia), così scraper e motori di prenotazione si possono provare
+in locale senza toccare il portale vero.
+
+Latenza ed errori si possono iniettare con FAKE_PORTAL_LATENCY_MS,
+FAKE_PORTAL_JITTER_MS e FAKE_PORTAL_ERROR_RATE (o con configure_faults()).
+
+Avvio:
+    uv run uvicorn bench.fake_portal:app --port 8081
+    PORTAL_BASE_URL=http://127.0.0.1:8081 uv run fastapi dev app/main.py
+"""
+import asyncio
+import os
+import random
+import secrets
+from contextlib import asynccontextmanager
+from datetime import date, timedelta
+from html import escape
+from typing import AsyncIterator, Dict, Optional, Set
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
+
+PASSWORD = os.environ.get("FAKE_PORTAL_PASSWORD", "password")
+SESSION_COOKIE = "SSESSfake"
+
+# Guasti iniettati su ogni richiesta: ritardo (+ jitter uniforme) e quota di risposte 503
+FAULTS = {
+    "latency_ms": float(os.environ.get("FAKE_PORTAL_LATENCY_MS", "0")),
+    "jitter_ms": float(os.environ.get("FAKE_PORTAL_JITTER_MS", "0")),
+    "error_rate": float(os.environ.get("FAKE_PORTAL_ERROR_RATE", "0")),
+}
+
+CATEGORIES = {
+    "primi_piatti": "Primi piatti",
+    "secondi_piatti": "Secondi piatti",
+    "contorni": "Contorni",
+    "frutta": "Frutta",
+    "dessert": "Dessert",
+}
+
+DISHES = {
+    "primi_piatti": ["Pasta al pomodoro", "Risotto ai funghi", "Minestrone di verdure"],
+    "secondi_piatti": ["Pollo arrosto", "Frittata alle zucchine", "Merluzzo gratinato"],
+    "contorni": ["Patate al forno", "Insalata mista"],
+    "frutta": ["Mela", "Banana"],
+    "dessert": ["Budino al cioccolato"],
+}
+
+
+def _build_meals() -> Dict[int, dict]:
+    meals = {}
+    node_id = 100
+    for offset, day in enumerate((date.today(), date.today() + timedelta(days=1))):
+        for canteen in ("Mensa Pascoli", "Mensa Via del Giochetto"):
+            for tipo in ("Pranzo", "Cena"):
+                node_id += 1
+                dish_id = node_id * 100
+                piatti = {}
+                for cat, names in DISHES.items():
+                    piatti[cat] = []
+                    for name in names:
+                        dish_id += 1
+                        piatti[cat].append((str(dish_id), name))
+                meals[node_id] = {
+                    "id": node_id,
+                    "day": day,
+                    "offset": offset,
+                    "canteen": canteen,
+                    "tipo": tipo,
+                    "prenotabile": True,
+                    "piatti": piatti,
+                }
+    return meals
+
+
+MEALS = _build_meals()
+
+# Stato in memoria: sessioni, form_build_id emessi e prenotazioni fatte
+sessions: Dict[str, str] = {}
+form_builds: Dict[str, Set[str]] = {}
+flash: Dict[str, str] = {}
+bookings: Set[tuple[str, int]] = set()
+
+app = FastAPI(title="Fake ADISU portal")
+
+
+def configure_faults(latency_ms: Optional[float] = None, jitter_ms: Optional[float] = None,
+                     error_rate: Optional[float] = None):
+    for key, value in (("latency_ms", latency_ms), ("jitter_ms", jitter_ms), ("error_rate", error_rate)):
+        if value is not None:
+            FAULTS[key] = value
+
+
+def reset_state():
+    """Dimentica sessioni e prenotazioni (tra una fase e l'altra di un benchmark)."""
+    sessions.clear()
+    form_builds.clear()
+    flash.clear()
+    bookings.clear()
+
+
+@app.middleware("http")
+async def inject_faults(request: Request, call_next):
+    delay = FAULTS["latency_ms"] + random.uniform(0, FAULTS["jitter_ms"])
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if FAULTS["error_rate"] > 0 and random.random() < FAULTS["error_rate"]:
+        return _layout("Errore", "<p>Il sito ha riscontrato un errore imprevisto. Riprova più tardi.</p>", 503)
+    return await call_next(request)
+
+
+# --- UTILITY ---
+
+def _user(request: Request) -> Optional[str]:
+    return sessions.get(request.cookies.get(SESSION_COOKIE, ""))
+
+
+def _new_build_id(sid: str) -> str:
+    build_id = f"form-{secrets.token_urlsafe(16)}"
+    form_builds.setdefault(sid, set()).add(build_id)
+    return build_id
+
+
+def _messages(errors=(), status: Optional[str] = None) -> str:
+    html = "".join(f'<div class="messages error">{escape(e)}</div>' for e in errors)
+    if status:
+        html += f'<div class="messages status">{escape(status)}</div>'
+    return html
+
+
+def _layout(title: str, body: str, status_code: int = 200) -> HTMLResponse:
+    return HTMLResponse(status_code=status_code, content=f"""<!DOCTYPE html>
+<html lang="it"><head><meta charset="utf-8"><title>{escape(title)} | ADISU</title>
+<link rel="stylesheet" href="/themes/adisu/css/style.css">
+<script src="/modules/contrib/matomo/js/matomo.js"></script>
+</head><body><header><img src="/sites/default/files/logo.png" alt="ADISU"></header>
+<main>{body}</main></body></html>""")
+
+
+def _hidden_fields(sid: str, form_id: str) -> str:
+    return (
+        f'<input type="hidden" name="form_build_id" value="{_new_build_id(sid)}">'
+        f'<input type="hidden" name="form_token" value="{secrets.token_urlsafe(12)}">'
+        f'<input type="hidden" name="form_id" value="{form_id}">'
+    )
+
+
+def _login_redirect(path: str) -> RedirectResponse:
+    return RedirectResponse(f"/user/login?destination={path}", status_code=302)
+
+
+# --- LOGIN ---
+
+def _login_page(errors=()) -> HTMLResponse:
+    return _layout("Accedi", f"""{_messages(errors)}
+<form class="user-login-form" id="user-login-form" action="/user/login" method="post">
+  <input type="text" name="name" id="edit-name">
+  <input type="password" name="pass" id="edit-pass">
+  <input type="hidden" name="form_build_id" value="form-{secrets.token_urlsafe(16)}">
+  <input type="hidden" name="form_id" value="user_login_form">
+  <input type="submit" id="edit-submit" name="op" value="Log in">
+</form>""")
+
+
+@app.get("/user/login")
+async def login_form():
+    return _login_page()
+
+
+@app.post("/user/login")
+async def login_submit(request: Request):
+    form = await request.form()
+    username = form.get("name", "")
+    if not username or form.get("pass") != PASSWORD:
+        return _login_page(["Nome utente o password non riconosciuti."])
+
+    sid = secrets.token_urlsafe(24)
+    sessions[sid] = username
+    destination = request.query_params.get("destination") or "/user/1"
+    resp = RedirectResponse(destination, status_code=303)
+    resp.set_cookie(SESSION_COOKIE, sid, httponly=True)
+    return resp
+
+
+@app.get("/user/{uid}")
+async def user_page(uid: int, request: Request):
+    user = _user(request)
+    if not user:
+        return _login_redirect(f"/user/{uid}")
+    return _layout(user, f"<h1>{escape(user)}</h1>")
+
+
+# --- PAGINE ELENCO ---
+
+def _meal_title(meal: dict) -> str:
+    return f"{meal['canteen']} - {meal['tipo']} del {meal['day'].strftime('%d/%m/%Y')}"
+
+
+def _listing_page(title: str, offset: int) -> HTMLResponse:
+    rows = "".join(
+        f'<div class="views-row"><a href="/node/{meal["id"]}">{escape(_meal_title(meal))}</a></div>'
+        for meal in MEALS.values() if meal["offset"] == offset
+    )
+    return _layout(title, f"""<h1>{escape(title)}</h1>
+<div class="view view-menu view-id-menu view-display-id-page_{offset + 1}">
+  <div class="view-content">{rows}</div>
+</div>""")
+
+
+@app.get("/menu-odierni")
+async def menu_today(request: Request):
+    if not _user(request):
+        return _login_redirect("/menu-odierni")
+    return _listing_page("Menu odierni", 0)
+
+
+@app.get("/menu-domani")
+async def menu_tomorrow(request: Request):
+    if not _user(request):
+        return _login_redirect("/menu-domani")
+    return _listing_page("Menu di domani", 1)
+
+
+# --- PAGINE PASTO E WEBFORM ---
+
+
+def _meal_page(meal: dict, user: str, sid: str, errors=(), status=None) -> HTMLResponse:
+    booked = (user, meal["id"]) in bookings
+    hidden_cls = "" if meal["prenotabile"] and not booked else " js-webform-states-hidden"
+    warning = (
+        '<div class="alert alert-warning">Risulta già presente una prenotazione per questo pasto.</div>'
+        if booked else ""
+    )
+
+    fieldsets = []
+    for cat, dishes in meal["piatti"].items():
+        radios = "".join(
+            f'<div class="form-item js-form-type-radio">'
+            f'<input type="radio" id="edit-{cat}-{dish_id}" name="{cat}" value="{dish_id}" class="form-radio">'
+            f'<label for="edit-{cat}-{dish_id}" class="option">{escape(name)}</label></div>'
+            for dish_id, name in dishes
+        )
+        radios += (
+            f'<div class="form-item js-form-type-radio">'
+            f'<input type="radio" id="edit-{cat}-none" name="{cat}" value="_none" class="form-radio">'
+            f'<label for="edit-{cat}-none" class="option">Nessuno</label></div>'
+        )
+        fieldsets.append(
+            f'<fieldset class="js-webform-type-radios webform-type-radios">'
+            f'<legend><span class="fieldset-legend">{CATEGORIES[cat]}</span></legend>'
+            f'<div class="fieldset-wrapper">{radios}</div></fieldset>'
+        )
+
+    body = f"""{_messages(errors, status)}{warning}
+<h1>{escape(_meal_title(meal))}</h1>
+<ul class="nav nav-tabs">
+  <li><a href="#edit-group-menu">Menu</a></li>
+  <li><a href="#edit-group-prenotazione">Prenotazione</a></li>
+</ul>
+<form class="webform-submission-form" id="webform-submission-prenotazione-node-{meal['id']}-add-form"
+      action="/node/{meal['id']}" method="post">
+  <div id="edit-group-prenotazione" class="tab-pane" style="display:none">
+    <div class="webform-card" data-webform-key="inizio">
+      <div class="form-item js-form-item-vuoi-prenotare{hidden_cls}">
+        <input type="checkbox" id="edit-vuoi-prenotare" name="vuoi_prenotare" value="1" class="form-checkbox">
+        <label for="edit-vuoi-prenotare">Vuoi prenotare?</label>
+      </div>
+    </div>
+    <div class="webform-card" data-webform-key="tipologia" style="display:none">
+      <input type="radio" id="edit-tipologia-menu-standard" name="tipologia_menu" value="standard">
+      <label for="edit-tipologia-menu-standard">Menu Standard</label>
+      <input type="radio" id="edit-tipologia-menu-asporto" name="tipologia_menu" value="asporto">
+      <label for="edit-tipologia-menu-asporto">Menu Asporto</label>
+    </div>
+    <div class="webform-card" data-webform-key="piatti" style="display:none">
+      {"".join(fieldsets)}
+      <input type="submit" id="edit-actions-preview-next" name="op" value="Anteprima" class="webform-button--preview">
+    </div>
+    <button type="button" id="edit-cards-next" class="webform-cards-button">Procedi</button>
+  </div>
+  {_hidden_fields(sid, f"webform_submission_prenotazione_node_{meal['id']}_add_form")}
+</form>
+<script>
+  document.querySelector('a[href="#edit-group-prenotazione"]').addEventListener('click', function (e) {{
+    e.preventDefault();
+    document.getElementById('edit-group-prenotazione').style.display = 'block';
+  }});
+  document.getElementById('edit-cards-next').addEventListener('click', function () {{
+    var cards = document.querySelectorAll('.webform-card');
+    for (var i = 0; i < cards.length - 1; i++) {{
+      if (cards[i].style.display !== 'none') {{
+        cards[i].style.display = 'none';
+        cards[i + 1].style.display = 'block';
+        if (i + 1 === cards.length - 1) {{ this.style.display = 'none'; }}
+        return;
+      }}
+    }}
+  }});
+</script>
+<script src="/core/misc/drupal.js"></script>"""
+    return _layout(_meal_title(meal), body)
+
+
+def _preview_page(meal: dict, sid: str, values: Dict[str, str]) -> HTMLResponse:
+    names = {dish_id: name for dishes in meal["piatti"].values() for dish_id, name in dishes}
+    summary = "".join(
+        f"<li>{CATEGORIES[cat]}: {escape(names[values[cat]])}</li>"
+        for cat in CATEGORIES if values.get(cat) in names
+    )
+    hidden = "".join(
+        f'<input type="hidden" name="{escape(k)}" value="{escape(v)}">' for k, v in values.items()
+    )
+    body = f"""<h1>Anteprima - {escape(_meal_title(meal))}</h1>
+<ul class="webform-preview">{summary}</ul>
+<form class="webform-submission-form" action="/node/{meal['id']}" method="post">
+  {hidden}
+  {_hidden_fields(sid, f"webform_submission_prenotazione_node_{meal['id']}_add_form")}
+  <input type="submit" id="edit-actions-preview-prev" name="op" value="Indietro">
+  <input type="submit" id="edit-actions-submit" name="op" value="Invia" class="webform-button--submit">
+</form>"""
+    return _layout("Anteprima", body)
+
+
+@app.get("/node/{node_id}")
+async def meal_page(node_id: int, request: Request):
+    meal = MEALS.get(node_id)
+    if meal is None:
+        return HTMLResponse("Pagina non trovata", status_code=404)
+    user = _user(request)
+    if not user:
+        return _login_redirect(f"/node/{node_id}")
+    sid = request.cookies[SESSION_COOKIE]
+    return _meal_page(meal, user, sid, status=flash.pop(sid, None))
+
+
+@app.post("/node/{node_id}")
+async def meal_submit(node_id: int, request: Request):
+    meal = MEALS.get(node_id)
+    if meal is None:
+        return HTMLResponse("Pagina non trovata", status_code=404)
+    user = _user(request)
+    if not user:
+        return _login_redirect(f"/node/{node_id}")
+    sid = request.cookies[SESSION_COOKIE]
+    form = await request.form()
+
+    if form.get("form_build_id") not in form_builds.get(sid, set()):
+        return _meal_page(meal, user, sid, ["Il modulo è scaduto. Ricarica la pagina e riprova."])
+    if (user, node_id) in bookings or not meal["prenotabile"]:
+        return _meal_page(meal, user, sid, ["Prenotazione non disponibile per questo pasto."])
+
+    valid_ids = {cat: {d for d, _ in dishes} for cat, dishes in meal["piatti"].items()}
+    values = {k: form[k] for k in ("vuoi_prenotare", "tipologia_menu") if k in form}
+    values.update({cat: form[cat] for cat in CATEGORIES if form.get(cat) in valid_ids[cat]})
+
+    errors = []
+    if values.get("vuoi_prenotare") != "1":
+        errors.append("Il campo Vuoi prenotare? è obbligatorio.")
+    if values.get("tipologia_menu") not in ("standard", "asporto"):
+        errors.append("Il campo Tipologia menu è obbligatorio.")
+    if not any(cat in values for cat in CATEGORIES):
+        errors.append("Seleziona almeno un piatto.")
+    if errors:
+        return _meal_page(meal, user, sid, errors)
+
+    if form.get("op") == "Invia":
+        form_builds[sid].discard(form["form_build_id"])
+        bookings.add((user, node_id))
+        flash[sid] = "La prenotazione è stata registrata."
+        return RedirectResponse(f"/node/{node_id}", status_code=303)
+    return _preview_page(meal, sid, values)
+
+
+@app.get("/core/misc/drupal.js")
+async def drupal_js():
+    return HTMLResponse("window.Drupal = window.Drupal || {};", media_type="application/javascript")
+
+
+@app.get("/themes/adisu/css/style.css")
+async def style_css():
+    return HTMLResponse("body { font-family: sans-serif; }", media_type="text/css")
+
+
+# Risorse che il portale vero carica ma che alla prenotazione non servono
+# (bloccate dal profilo di intercettazione, vedi bench.verify_interception)
+@app.get("/modules/contrib/matomo/js/matomo.js")
+async def matomo_js():
+    return HTMLResponse("var _paq = window._paq = window._paq || [];" + " " * 20_000,
+                        media_type="application/javascript")
+
+
+@app.get("/sites/default/files/logo.png")
+async def logo_png():
+    return Response(content=b"\x89PNG\r\n\x1a\n" + bytes(40_000), media_type="image/png")
+
+
+@asynccontextmanager
+async def serve(asgi_app, port: int) -> AsyncIterator[str]:
+    """Avvia un'app ASGI con uvicorn nello stesso event loop (lifespan incluso)."""
+    server = uvicorn.Server(uvicorn.Config(asgi_app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        await task
+
+
+def running(port: int = 8081):
+    """Avvia il portale finto nello stesso event loop (per benchmark e script)."""
+    return serve(app, port)
@@ -0,0 +1,151 @@
+"""Benchmark dei codec dei menu in Redis: JSON (formato precedente) vs msgpack.
+
+Genera i pasti di una settimana per alcune mense (stessa forma dei dati dello
+scraper) e confronta per ogni codec:
+  - dimensione media di un pasto salvato e totale della settimana;
+  - tempo di codifica e di decodifica di un pasto.
+Con --redis misura anche la lettura della settimana da Redis (REDIS_URL):
+una get_meals per giorno (SMEMBERS + MGET per ogni giorno) contro
+get_meals_range (indici in pipeline + una sola MGET). I pasti vengono scritti
+su date del 2099 e cancellati alla fine.
+
+    uv run python -m bench.menu_codec [--days 7] [--canteens 6] [--runs 2000] [--redis]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import date, timedelta
+from typing import Callable, Dict, List
+
+CODECS = ("json", "msgpack")
+
+
+def _configure_env():
+    # Va fatto prima di importare app.*
+    os.environ.setdefault("MENU_USERNAME", "bench")
+    os.environ.setdefault("MENU_PASSWORD", "password")
+
+
+def build_meals(first_day: date, days: int, canteens: int) -> List[Dict]:
+    from bench.fake_portal import DISHES
+
+    meals = []
+    dish_id = 10_000
+    for offset in range(days):
+        day_str = (first_day + timedelta(days=offset)).isoformat()
+        for c in range(canteens):
+            for tipo in ("pranzo", "cena"):
+                piatti = {}
+                for cat, names in DISHES.items():
+                    piatti[cat] = []
+                    for name in names:
+                        dish_id += 1
+                        piatti[cat].append({"id": str(dish_id), "nome": name})
+                meals.append({
+                    "data": day_str,
+                    "mensa": f"Mensa {c}",
+                    "mensa_id": f"mensa-{c}",
+                    "tipo_pasto": tipo,
+                    "url": f"https://intragenzia.adisu.umbria.it/node/{dish_id // 100}",
+                    "prenotato": False,
+                    "prenotabile": True,
+                    "piatti": piatti,
+                })
+    return meals
+
+
+def _per_call_us(fn: Callable, items: List, runs: int) -> float:
+    rounds = max(1, runs // len(items))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            fn(item)
+    return (time.perf_counter() - start) / (rounds * len(items)) * 1e6
+
+
+def bench_codecs(meals: List[Dict], runs: int):
+    from app import menu_codec
+    from app.settings import settings
+
+    print(f"{len(meals)} pasti\n")
+    print(f"{'codec':<8} {'byte/pasto':>11} {'totale KB':>10} {'encode µs':>10} {'decode µs':>10}")
+    results = {}
+    for codec in CODECS:
+        settings.MENU_CODEC = codec
+        encoded = [menu_codec.encode(meal) for meal in meals]
+        assert [menu_codec.decode(raw) for raw in encoded] == meals, f"{codec}: round trip non fedele"
+        results[codec] = {
+            "size": statistics.mean(len(raw) for raw in encoded),
+            "total": sum(len(raw) for raw in encoded),
+            "encode": _per_call_us(menu_codec.encode, meals, runs),
+            "decode": _per_call_us(menu_codec.decode, encoded, runs),
+        }
+        r = results[codec]
+        print(f"{codec:<8} {r['size']:>11.0f} {r['total'] / 1024:>10.1f} {r['encode']:>10.1f} {r['decode']:>10.1f}")
+    old, new = results["json"], results["msgpack"]
+    print(
+        f"\nmsgpack: {100 * (1 - new['size'] / old['size']):.0f}% di byte in meno,"
+        f" decodifica {old['decode'] / new['decode']:.1f}x"
+    )
+
+
+async def bench_redis(meals: List[Dict], day_strs: List[str], runs: int):
+    from app import menu_store
+    from app.redis_client import redis_bytes, redis_client
+    from app.settings import settings
+
+    runs = max(1, runs // 100)
+    print(f"\nLettura di {len(day_strs)} giorni da Redis ({runs} ripetizioni, ms)")
+    print(f"{'codec':<8} {'per giorno':>11} {'range':>8} {'MB letti':>9}")
+    try:
+        for codec in CODECS:
+            settings.MENU_CODEC = codec
+            async with redis_client.pipeline(transaction=True) as pipe:
+                for meal in meals:
+                    menu_store.stage_meal(pipe, meal, "bench")
+                await pipe.execute()
+
+            async def per_day():
+                return {d: await menu_store.get_meals(d) for d in day_strs}
+
+            timings = {}
+            for name, read in (("per giorno", per_day), ("range", lambda: menu_store.get_meals_range(day_strs))):
+                samples = []
+                for _ in range(runs):
+                    start = time.perf_counter()
+                    result = await read()
+                    samples.append(time.perf_counter() - start)
+                assert sum(len(v) for v in result.values()) == len(meals)
+                timings[name] = statistics.median(samples) * 1000
+            keys = [menu_store.meal_key(m["data"], m["mensa_id"], m["tipo_pasto"]) for m in meals]
+            stored = sum(len(raw) for raw in await redis_bytes.mget(keys))
+            print(f"{codec:<8} {timings['per giorno']:>11.2f} {timings['range']:>8.2f} {stored / 1e6:>9.3f}")
+    finally:
+        for day_str in day_strs:
+            members = await menu_store.indexed_meals(day_str)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                menu_store.stage_removal(pipe, day_str, members)
+                pipe.delete(menu_store.index_key(day_str))
+                await pipe.execute()
+
+
+def main(args):
+    first_day = date(2099, 1, 1)
+    meals = build_meals(first_day, args.days, args.canteens)
+    bench_codecs(meals, args.runs)
+    if args.redis:
+        day_strs = [(first_day + timedelta(days=i)).isoformat() for i in range(args.days)]
+        asyncio.run(bench_redis(meals, day_strs, args.runs))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--canteens", type=int, default=6)
+    parser.add_argument("--runs", type=int, default=2000)
+    parser.add_argument("--redis", action="store_true", help="misura anche le letture da Redis (REDIS_URL)")
+    args = parser.parse_args()
+    _configure_env()
+    main(args)
@@ -0,0 +1,132 @@
+"""Microbenchmark: estrazione menu via locator Playwright vs HTML + BeautifulSoup.
+
+Carica le fixture salvate in una pagina Chromium (set_content, niente rete),
+verifica che i due percorsi diano lo stesso risultato e ne misura i tempi.
+
+    uv run python -m bench.parser_bench [--runs 20]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from pathlib import Path
+from typing import Dict
+
+from playwright.async_api import Page, async_playwright
+
+from app.menu_parser import CATEGORY_MAP, NUMERIC_ID, extract_menu_links, parse_menu_html
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+async def parse_with_locators(page: Page) -> tuple[Dict, bool, bool]:
+    """Vecchio percorso: una chiamata IPC per ogni nodo letto."""
+    prenotabile = False
+    checkbox_wrapper = page.locator(".js-form-item-vuoi-prenotare")
+    if await checkbox_wrapper.count() > 0:
+        classes = await checkbox_wrapper.first.get_attribute("class") or ""
+        prenotabile = "js-webform-states-hidden" not in classes
+
+    prenotato = False
+    warning_loc = page.locator(".alert.alert-warning")
+    if await warning_loc.count() > 0:
+        msg = await warning_loc.first.text_content()
+        if msg and "Risulta già presente una prenotazione" in msg:
+            prenotato = True
+            prenotabile = False
+
+    grouped = {v: [] for v in CATEGORY_MAP.values()}
+    fieldsets = page.locator("fieldset")
+    for i in range(await fieldsets.count()):
+        fs = fieldsets.nth(i)
+        legend_loc = fs.locator(".fieldset-legend")
+        if await legend_loc.count() == 0:
+            continue
+        cat_key = CATEGORY_MAP.get((await legend_loc.first.text_content()).strip())
+        if not cat_key:
+            continue
+
+        radios = fs.locator("input[type=radio]")
+        for j in range(await radios.count()):
+            radio = radios.nth(j)
+            val = await radio.get_attribute("value")
+            if not val or not NUMERIC_ID.match(val.strip()):
+                continue
+            radio_id = await radio.get_attribute("id")
+            label_loc = fs.locator(f"label[for='{radio_id}']")
+            if await label_loc.count() > 0:
+                name = (await label_loc.first.text_content()).strip()
+                grouped[cat_key].append({"id": val.strip(), "nome": name})
+
+    return grouped, prenotato, prenotabile
+
+
+async def links_with_locators(page: Page):
+    links = page.locator("div.view-menu a")
+    result = []
+    for i in range(await links.count()):
+        text = await links.nth(i).text_content()
+        href = await links.nth(i).get_attribute("href")
+        if text and href:
+            result.append((text, href))
+    return result
+
+
+async def _time(fn, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def _report(name: str, locator_ms: float, html_ms: float):
+    print(f"{name:<28} locator {locator_ms:8.2f} ms   html {html_ms:8.2f} ms   x{locator_ms / html_ms:5.1f}")
+
+
+async def main(runs: int):
+    menu_fixtures = ["menu_page.html", "menu_page_booked.html"]
+
+    # Solo parsing Python (senza browser)
+    for name in menu_fixtures:
+        html = (FIXTURES / name).read_text()
+        start = time.perf_counter()
+        for _ in range(runs):
+            parse_menu_html(html)
+        print(f"{name:<28} parse_menu_html {(time.perf_counter() - start) * 1000 / runs:8.2f} ms")
+
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        page = await browser.new_page()
+
+        for name in menu_fixtures:
+            await page.set_content((FIXTURES / name).read_text())
+            expected = await parse_with_locators(page)
+            got = parse_menu_html(await page.content())
+            assert got == expected, f"{name}: risultati diversi\n{expected}\n{got}"
+            _report(
+                name,
+                await _time(lambda: parse_with_locators(page), runs),
+                await _time(lambda: _content_then(page, parse_menu_html), runs),
+            )
+
+        await page.set_content((FIXTURES / "menu_listing.html").read_text())
+        assert await links_with_locators(page) == extract_menu_links(await page.content())
+        _report(
+            "menu_listing.html",
+            await _time(lambda: links_with_locators(page), runs),
+            await _time(lambda: _content_then(page, extract_menu_links), runs),
+        )
+
+        await browser.close()
+
+
+async def _content_then(page: Page, parse):
+    return parse(await page.content())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    asyncio.run(main(parser.parse_args().runs))
@@ -0,0 +1,285 @@
+"""Suite di benchmark end-to-end contro il portale finto.
+
+Misura, con portale e backend avviati nello stesso processo:
+  - scrape: tempo di scrape_and_cache_daily (browser già avviato, login incluso)
+  - book: latenza di /book vista dal client (POST + polling di GET /book/{id}
+    fino alla fine del job), p50/p95/p99 a diversi livelli di concorrenza
+  - throughput: prenotazioni/s completate per livello; il massimo è il ritmo
+    sostenibile con i worker e il controllo di ammissione configurati
+  - rss: picco di memoria del processo e dei suoi figli (Chromium)
+e scrive tutto in un file JSON, da confrontare tra un commit e l'altro.
+
+Richiede Redis su REDIS_URL (es. `docker compose up -d redis`). Meglio un
+database dedicato: la suite sovrascrive i menu salvati e crea job di prenotazione.
+
+    uv run python -m bench.suite [--bookings 40] [--levels 1,5,10] [--engine http]
+                                 [--latency-ms 30] [--error-rate 0.01] [--output bench-results.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import time
+import uuid
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional
+
+
+def _configure_env(args):
+    # Va fatto prima di importare app.*: URL del portale e settings sono letti all'import
+    os.environ.setdefault("MENU_USERNAME", "bench")
+    os.environ.setdefault("MENU_PASSWORD", os.environ.get("FAKE_PORTAL_PASSWORD", "password"))
+    os.environ["PORTAL_BASE_URL"] = f"http://127.0.0.1:{args.portal_port}"
+    os.environ["BOOKING_ENGINE"] = args.engine
+    # Niente scraping incrementale in background durante le misure
+    os.environ["REFRESH_ENABLED"] = "false"
+    # Ogni giro di bench_scrape deve fare uno scraping vero, non riusare l'esito del precedente
+    os.environ["SCRAPE_COALESCE_SECONDS"] = "0"
+    # Chiave per le password dei job in coda (gli utenti sono tutti diversi: la cache
+    # delle sessioni non salta nessun login)
+    if not os.environ.get("SESSION_ENCRYPTION_KEY"):
+        from cryptography.fernet import Fernet
+        os.environ["SESSION_ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+
+# --- MEMORIA ---
+
+def _tree_rss_kb(root_pid: int) -> int:
+    """RSS totale (kB) del processo e di tutti i discendenti."""
+    from app.metrics import process_tree
+
+    return sum(rss_kb for _, _, rss_kb in process_tree(root_pid))
+
+
+class RssSampler:
+    """Campiona in background il picco di RSS (processo + Chromium)."""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.peak_kb = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            self.peak_kb = max(self.peak_kb, await asyncio.to_thread(_tree_rss_kb, os.getpid()))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if Path("/proc/self/status").exists():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        # Senza /proc resta solo il picco del processo Python (ru_maxrss è in kB su Linux)
+        self_peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {
+            "peak_rss_mb": round(max(self.peak_kb, self_peak_kb) / 1024, 1),
+            "peak_rss_self_mb": round(self_peak_kb / 1024, 1),
+            "includes_children": self._task is not None,
+        }
+
+
+# --- STATISTICHE ---
+
+def _percentile(samples: List[float], pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def _latency_summary(samples: List[float]) -> Dict:
+    return {
+        "count": len(samples),
+        "p50_ms": _ms(statistics.median(samples)) if samples else None,
+        "p95_ms": _ms(_percentile(samples, 95)),
+        "p99_ms": _ms(_percentile(samples, 99)),
+        "max_ms": _ms(max(samples)) if samples else None,
+    }
+
+
+# --- FASI ---
+
+async def bench_scrape(runs: int) -> Dict:
+    from playwright.async_api import async_playwright
+
+    from app import browser_profile, menu_store
+    from app.redis_client import redis_client
+    from app.scraper import scrape_and_cache_daily
+
+    key = menu_store.index_key(date.today().isoformat())
+    samples = []
+    async with async_playwright() as p:
+        # Stesso profilo di avvio del browser globale, così l'RSS misurato è quello del server
+        browser = await p.chromium.launch(**browser_profile.launch_options())
+        try:
+            for _ in range(runs):
+                await redis_client.delete(key)
+                start = time.perf_counter()
+                await scrape_and_cache_daily(browser)
+                samples.append(time.perf_counter() - start)
+                # scrape_and_cache_daily non propaga gli errori: controlliamo il risultato
+                assert await redis_client.exists(key), "lo scraping non ha salvato il menu di oggi"
+        finally:
+            await browser.close()
+    return {
+        "runs": runs,
+        "median_s": round(statistics.median(samples), 3),
+        "min_s": round(min(samples), 3),
+        "max_s": round(max(samples), 3),
+    }
+
+
+async def _book_once(client, payload: Dict, poll_interval: float, timeout: float) -> tuple[float, str]:
+    start = time.perf_counter()
+    resp = await client.post("/book", json=payload)
+    if resp.status_code == 503:
+        # Rifiutata dal controllo di ammissione (Retry-After): conta come esito a sé
+        return time.perf_counter() - start, "rejected"
+    resp.raise_for_status()
+    job = resp.json()
+    while job["status"] in ("queued", "running"):
+        if time.perf_counter() - start > timeout:
+            return time.perf_counter() - start, "timeout"
+        await asyncio.sleep(poll_interval)
+        job = (await client.get(f"/book/{job['job_id']}")).json()
+    return time.perf_counter() - start, job["status"]
+
+
+async def bench_bookings(backend_url: str, total: int, concurrency: int, timeout: float) -> Dict:
+    import httpx
+
+    from app.scraper import BASE_URL
+    from bench import fake_portal
+
+    # Un utente nuovo per prenotazione (il portale accetta una sola prenotazione
+    # per utente e pasto); i pasti ruotano su tutti quelli del portale finto
+    run_id = uuid.uuid4().hex[:6]
+    meals = list(fake_portal.MEALS.values())
+    payloads = []
+    for i in range(total):
+        meal = meals[i % len(meals)]
+        payloads.append({
+            "username": f"bench-{run_id}-{i}",
+            "password": fake_portal.PASSWORD,
+            "meal_url": f"{BASE_URL}/node/{meal['id']}",
+            "dish_ids": [dishes[0][0] for dishes in list(meal["piatti"].values())[:3]],
+        })
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for payload in payloads:
+        queue.put_nowait(payload)
+    latencies, outcomes = [], {}
+
+    async def client_loop(client):
+        while not queue.empty():
+            payload = queue.get_nowait()
+            elapsed, status = await _book_once(client, payload, poll_interval=0.05, timeout=timeout)
+            outcomes[status] = outcomes.get(status, 0) + 1
+            if status == "succeeded":
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(base_url=backend_url, timeout=timeout) as client:
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(concurrency):
+                tg.create_task(client_loop(client))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "bookings": total,
+        "outcomes": outcomes,
+        "wall_s": round(elapsed, 3),
+        "throughput_per_s": round(outcomes.get("succeeded", 0) / elapsed, 2),
+        "latency": _latency_summary(latencies),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    from app import main as backend
+    from app.settings import settings
+    from bench import fake_portal
+
+    fake_portal.configure_faults(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    sampler = RssSampler()
+    sampler.start()
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            "engine": settings.BOOKING_ENGINE,
+            "booking_workers": settings.BOOKING_WORKERS,
+            "admission": backend.admission.stats(),
+            "browser_pool_size": settings.BROWSER_POOL_SIZE,
+            "scrape_concurrency": settings.SCRAPE_CONCURRENCY,
+            "faults": dict(fake_portal.FAULTS),
+        },
+    }
+
+    async with fake_portal.running(args.portal_port):
+        print("--- Scraping ---")
+        results["scrape"] = await bench_scrape(args.scrape_runs)
+
+        print("--- Prenotazioni ---")
+        async with fake_portal.serve(backend.app, args.backend_port) as backend_url:
+            levels = []
+            for concurrency in args.levels:
+                fake_portal.reset_state()
+                level = await bench_bookings(backend_url, args.bookings, concurrency, args.timeout)
+                print(f"  concorrenza {concurrency:>3}: {level['throughput_per_s']:6.2f} pren/s, "
+                      f"p95 {level['latency']['p95_ms']} ms, esiti {level['outcomes']}")
+                levels.append(level)
+        results["book"] = {
+            "levels": levels,
+            "max_throughput_per_s": max(level["throughput_per_s"] for level in levels),
+            "admission": backend.admission.stats(),
+        }
+
+    results["memory"] = await sampler.stop()
+
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f"\nScraping: mediana {results['scrape']['median_s']} s")
+    print(f"Prenotazioni: massimo {results['book']['max_throughput_per_s']} pren/s")
+    print(f"Memoria: picco {results['memory']['peak_rss_mb']} MB")
+    print(f"Risultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bookings", type=int, default=40, help="prenotazioni per livello di concorrenza")
+    parser.add_argument("--levels", type=lambda v: [int(x) for x in v.split(",")], default=[1, 5, 10])
+    parser.add_argument("--scrape-runs", type=int, default=3)
+    parser.add_argument("--engine", choices=("playwright", "http"), default=os.environ.get("BOOKING_ENGINE", "playwright"))
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="attesa massima per singola prenotazione (s)")
+    parser.add_argument("--portal-port", type=int, default=8081)
+    parser.add_argument("--backend-port", type=int, default=8082)
+    parser.add_argument("--output", default="bench-results.json")
+    args = parser.parse_args()
+    _configure_env(args)
+    asyncio.run(main(args))
@@ -0,0 +1,156 @@
+"""Verifica del profilo di intercettazione delle prenotazioni (app.interception).
+
+Registra una prenotazione completa (login + book_meal) in un file HAR senza
+alcun filtro, poi la ripete due volte dal HAR, senza rete: una senza profilo
+(riferimento) e una con il profilo attivo. Se la prenotazione con il profilo
+non riesce, il profilo blocca qualcosa che al webform serve e non va attivato.
+Alla fine confronta richieste e byte serviti nei due replay.
+
+Di default usa il portale finto; con --har si ripete invece un HAR già
+registrato (ad es. dal portale vero con --record-only, credenziali di prova e
+il pasto indicato in --meal-url/--dish-ids).
+
+    uv run python -m bench.verify_interception [--port 8081]
+    uv run python -m bench.verify_interception --record-only --har portale.har \\
+        --meal-url https://.../node/123 --dish-ids 1 2 3
+    uv run python -m bench.verify_interception --har portale.har --meal-url ... --dish-ids ...
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from collections import Counter
+from contextlib import AsyncExitStack
+from typing import Dict, List, Optional
+
+
+def _configure_env(port: Optional[int]):
+    # Va fatto prima di importare app.*: gli URL del portale sono letti all'import
+    os.environ.setdefault("MENU_USERNAME", "bench")
+    os.environ.setdefault("MENU_PASSWORD", "password")
+    if port is not None:
+        os.environ["PORTAL_BASE_URL"] = f"http://127.0.0.1:{port}"
+    # Il profilo va verificato anche se nel .env è disattivato
+    if os.environ.get("BOOKING_INTERCEPTION", "off") == "off":
+        os.environ["BOOKING_INTERCEPTION"] = "selective"
+
+
+async def _book(browser, har: str, mode: str, meal_url: str, dish_ids: List[str],
+                username: str, password: str) -> Dict:
+    """Una prenotazione: mode = "record" (rete, scrive il HAR), "baseline" o "profile" (replay)."""
+    from app import interception
+    from app.main import playwright_login
+    from app.scraper import USER_AGENT, book_meal
+
+    options = {"user_agent": USER_AGENT}
+    if mode == "record":
+        options.update(record_har_path=har, record_har_content="embed")
+    context = await browser.new_context(**options)
+    if mode != "record":
+        # not_found="abort": nessuna richiesta esce verso la rete durante il replay
+        await context.route_from_har(har, not_found="abort")
+    if mode == "profile":
+        # Senza cache: route.fetch() andrebbe in rete scavalcando il HAR.
+        # Registrato dopo il HAR, il profilo decide per primo e poi passa la mano.
+        await interception.booking_profile(static_cache=False).apply(context)
+
+    finished = []
+    failed: Counter = Counter()
+    context.on("requestfinished", finished.append)
+    context.on("requestfailed", lambda request: failed.update([request.resource_type]))
+
+    page = await context.new_page()
+    try:
+        await playwright_login(page, username, password)
+        ok = await book_meal(page, meal_url, dish_ids)
+    except Exception as e:
+        print(f"[{mode}] prenotazione interrotta: {e}")
+        ok = False
+    served: Counter = Counter()
+    served_bytes: Counter = Counter()
+    try:
+        for request, sizes in zip(finished, await asyncio.gather(*(r.sizes() for r in finished))):
+            served[request.resource_type] += 1
+            served_bytes[request.resource_type] += sizes["responseBodySize"]
+    finally:
+        # Chiudere il contesto scrive il HAR su disco
+        await context.close()
+    return {"ok": ok, "served": served, "bytes": served_bytes, "failed": failed}
+
+
+def _report(baseline: Dict, profiled: Dict):
+    types = sorted(set(baseline["served"]) | set(profiled["served"]) | set(profiled["failed"]))
+    print()
+    print(f"{'tipo':<12} {'rif. req':>9} {'rif. KB':>9} {'prof. req':>10} {'prof. KB':>9} {'bloccate':>9}")
+    for kind in types:
+        print(
+            f"{kind:<12} {baseline['served'][kind]:>9} {baseline['bytes'][kind] / 1024:>9.1f}"
+            f" {profiled['served'][kind]:>10} {profiled['bytes'][kind] / 1024:>9.1f} {profiled['failed'][kind]:>9}"
+        )
+    total = lambda run, key: sum(run[key].values())  # noqa: E731
+    saved = total(baseline, "bytes") - total(profiled, "bytes")
+    print(
+        f"\nRichieste: {total(baseline, 'served')} -> {total(profiled, 'served')}"
+        f"   Byte: {total(baseline, 'bytes') / 1024:.1f} KB -> {total(profiled, 'bytes') / 1024:.1f} KB"
+        f" (risparmio {saved / 1024:.1f} KB)"
+    )
+
+
+async def main(args):
+    from playwright.async_api import async_playwright
+
+    from app.scraper import BASE_URL
+    from bench import fake_portal
+
+    meal_url = args.meal_url or f"{BASE_URL}/node/101"
+    dish_ids = args.dish_ids or ["10101", "10104", "10107"]
+    username = args.username or os.environ["MENU_USERNAME"]
+    password = args.password or (fake_portal.PASSWORD if args.har is None else os.environ["MENU_PASSWORD"])
+
+    async with AsyncExitStack() as stack:
+        har = args.har
+        if har is None:
+            har = os.path.join(stack.enter_context(tempfile.TemporaryDirectory()), "booking.har")
+            await stack.enter_async_context(fake_portal.running(args.port))
+        p = await stack.enter_async_context(async_playwright())
+        browser = await p.chromium.launch(headless=True)
+        stack.push_async_callback(browser.close)
+
+        if args.har is None or args.record_only:
+            recorded = await _book(browser, har, "record", meal_url, dish_ids, username, password)
+            if not recorded["ok"]:
+                print("Registrazione non riuscita: la prenotazione fallisce anche senza profilo.")
+                return 1
+            print(f"Prenotazione registrata in {har}")
+            if args.record_only:
+                return 0
+
+        baseline = await _book(browser, har, "baseline", meal_url, dish_ids, username, password)
+        profiled = await _book(browser, har, "profile", meal_url, dish_ids, username, password)
+
+    _report(baseline, profiled)
+    if not baseline["ok"]:
+        print("\nIl replay di riferimento non riesce: il HAR non copre la prenotazione, registrarlo di nuovo.")
+        return 1
+    if not profiled["ok"]:
+        print("\nNON OK: con il profilo la prenotazione non riesce (vedi le richieste bloccate sopra).")
+        return 1
+    print("\nOK: la prenotazione riesce anche con il profilo di intercettazione.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--har", help="HAR da ripetere (o da scrivere con --record-only) al posto del portale finto")
+    parser.add_argument("--record-only", action="store_true", help="registra il HAR dal portale configurato ed esce")
+    parser.add_argument("--meal-url")
+    parser.add_argument("--dish-ids", nargs="+")
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    args = parser.parse_args()
+    if args.record_only and not args.har:
+        parser.error("--record-only richiede --har")
+    _configure_env(None if args.har else args.port)
+    sys.exit(asyncio.run(main(args)))
@@ -2,9 +2,8 @@ import asyncio
 import os
 from playwright.async_api import async_playwright
 from app.settings import settings
-
-# URL definiti nel vecchio scraper
-LOGIN_URL = "https://intragenzia.adisu.umbria.it/user/login"
+# Segue PORTAL_BASE_URL: con il portale finto (bench/fake_portal.py) gira in locale
+from app.scraper import LOGIN_URL
 
 async def test_login():
     async with async_playwright() as p:
@@ -0,0 +1,33 @@
+import os
+from pathlib import Path
+
+import fakeredis
+import pytest
+from cryptography.fernet import Fernet
+
+# app.settings legge le credenziali all'import: valori finti, i test non toccano il portale
+os.environ.setdefault("MENU_USERNAME", "test")
+os.environ.setdefault("MENU_PASSWORD", "test")
+os.environ.setdefault("SESSION_ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+from app import redis_client  # noqa: E402
+
+# Redis in memoria (con Lua), installato prima che i moduli dell'app registrino i loro script
+_redis_server = fakeredis.FakeServer()
+redis_client.redis_client = fakeredis.aioredis.FakeRedis(server=_redis_server, decode_responses=True)
+redis_client.redis_bytes = fakeredis.aioredis.FakeRedis(server=_redis_server)
+
+FIXTURES = Path(__file__).parent.parent / "bench" / "fixtures"
+
+
+@pytest.fixture
+def fixture_html():
+    """HTML di una pagina salvata in bench/fixtures."""
+    return lambda name: (FIXTURES / name).read_text()
+
+
+@pytest.fixture
+def redis():
+    """Client del Redis in memoria, svuotato prima di ogni test."""
+    fakeredis.FakeRedis(server=_redis_server).flushall()
+    return redis_client.redis_client
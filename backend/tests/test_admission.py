@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionController, AdmissionRejected
+
+
+def _controller(**overrides) -> AdmissionController:
+    options = dict(
+        initial=2, min_limit=1, max_limit=10, target_latency=10.0, max_error_rate=0.2,
+        min_free_memory_mb=0, per_user_limit=2, max_wait=60.0, shared_key="admission:limits",
+    )
+    return AdmissionController(**{**options, **overrides})
+
+
+def test_queue_wait_uses_the_limits_of_every_process(redis):
+    first, second = _controller(), _controller()
+
+    async def scenario():
+        # 10 job a 10s l'uno con 2 slot: 50s di attesa, entro i 60s
+        await first.check_queue(10)
+        # 14 job: 70s con i soli slot di questo processo, 35s con anche quelli dell'altro
+        with pytest.raises(AdmissionRejected):
+            await first.check_queue(14)
+        sharing = asyncio.create_task(second.share_limit())
+        await asyncio.sleep(0.01)
+        await first.check_queue(14)
+        limit = await first.cluster_limit()
+        sharing.cancel()
+        await asyncio.gather(sharing, return_exceptions=True)
+        return limit, await first.cluster_limit()
+
+    assert asyncio.run(scenario()) == (4, 2)
+
+
+def test_expired_limits_are_ignored(redis):
+    controller = _controller()
+
+    async def scenario():
+        await redis.hset("admission:limits", "morto", "8 0")
+        return await controller.cluster_limit()
+
+    assert asyncio.run(scenario()) == 2
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from app import booking_queue, events
+from app.admission import AdmissionRejected
+from app.booking_queue import FAILED, QUEUED, RUNNING, SUCCEEDED
+
+MEAL = "https://intragenzia.adisu.umbria.it/node/101"
+OTHER_MEAL = "https://intragenzia.adisu.umbria.it/node/102"
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """Eventi dei job raccolti in memoria invece che pubblicati su Redis."""
+    sent = []
+    monkeypatch.setattr(events, "emit_job_event", lambda job_id, event: sent.append(event))
+    return sent
+
+
+async def _pick(redis) -> str:
+    """Quello che fa un worker: sposta il primo job della coda in lavorazione."""
+    return await redis.blmove(booking_queue.QUEUE_KEY, booking_queue.PROCESSING_KEY, 1, "LEFT", "RIGHT")
+
+
+async def _booked(username, password, meal_url, dish_ids):
+    return "Prenotazione effettuata con successo"
+
+
+def test_same_meal_returns_the_active_job(redis, published):
+    async def scenario():
+        first = await booking_queue.enqueue_booking("alice", "pw", MEAL, ["10501"])
+        second = await booking_queue.enqueue_booking("alice", "pw", MEAL, ["10504"])
+        return first, second, await redis.llen(booking_queue.QUEUE_KEY)
+
+    first, second, depth = asyncio.run(scenario())
+
+    assert second["job_id"] == first["job_id"]
+    assert second["status"] == QUEUED
+    assert depth == 1
+
+
+def test_finished_job_releases_the_meal(redis, published):
+    async def scenario():
+        first = await booking_queue.enqueue_booking("alice", "pw", MEAL, ["10501"])
+        await booking_queue._run_job(await _pick(redis), _booked)
+        second = await booking_queue.enqueue_booking("alice", "pw", MEAL, ["10504"])
+        return await booking_queue.get_job(first["job_id"]), second
+
+    first, second = asyncio.run(scenario())
+
+    assert first["status"] == SUCCEEDED
+    assert second["job_id"] != first["job_id"]
+    assert second["dish_ids"] == ["10504"]
+
+
+def test_per_user_limit(redis, published):
+    async def scenario():
+        await booking_queue.enqueue_booking("alice", "pw", MEAL, [], max_active=1)
+        with pytest.raises(AdmissionRejected):
+            await booking_queue.enqueue_booking("alice", "pw", OTHER_MEAL, [], max_active=1)
+        # Un altro utente ha il suo limite
+        await booking_queue.enqueue_booking("bob", "pw", OTHER_MEAL, [], max_active=1)
+
+        await booking_queue._run_job(await _pick(redis), _booked)
+        # Il job concluso libera il posto, e il pasto rifiutato non era rimasto legato
+        retry = await booking_queue.enqueue_booking("alice", "pw", OTHER_MEAL, [], max_active=1)
+        return retry, await redis.get(booking_queue._active_key("alice"))
+
+    retry, active = asyncio.run(scenario())
+
+    assert retry["status"] == QUEUED
+    assert active == "1"
+
+
+def test_cancelled_job_fails_and_releases_the_meal(redis, published):
+    async def scenario():
+        job = await booking_queue.enqueue_booking("alice", "pw", MEAL, [], max_active=1)
+        started = asyncio.Event()
+
+        async def stuck(*args):
+            started.set()
+            await asyncio.Event().wait()
+
+        task = asyncio.create_task(booking_queue._run_job(await _pick(redis), stuck))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        retry = await booking_queue.enqueue_booking("alice", "pw", MEAL, [], max_active=1)
+        return await booking_queue.get_job(job["job_id"]), retry
+
+    job, retry = asyncio.run(scenario())
+
+    assert job["status"] == FAILED
+    assert "riavvio" in job["reason"]
+    assert retry["job_id"] != job["job_id"]
+
+
+def test_reclaimed_job_is_not_overwritten_by_the_slow_worker(redis, published):
+    async def scenario():
+        job = await booking_queue.enqueue_booking("alice", "pw", MEAL, [], max_active=2)
+        release = asyncio.Event()
+
+        async def slow(*args):
+            await release.wait()
+            return "Prenotazione effettuata con successo"
+
+        task = asyncio.create_task(booking_queue._run_job(await _pick(redis), slow))
+        await asyncio.sleep(0.01)
+        # Lease scaduto come se il worker fosse morto
+        await redis.zadd(booking_queue.RUNNING_KEY, {job["job_id"]: 0})
+        reclaimed = await booking_queue.reclaim_stale_jobs()
+        release.set()
+        await task
+        return (
+            reclaimed,
+            await booking_queue.get_job(job["job_id"]),
+            await redis.get(booking_queue._active_key("alice")),
+        )
+
+    reclaimed, job, active = asyncio.run(scenario())
+
+    assert reclaimed == 1
+    assert job["status"] == FAILED
+    assert active == "0"
+    assert [e["status"] for e in published] == [RUNNING, FAILED]
+
+
+def test_job_stuck_before_the_lease_goes_back_to_the_queue(redis, published):
+    async def scenario():
+        job = await booking_queue.enqueue_booking("alice", "pw", MEAL, [])
+        await _pick(redis)
+        # Il primo controllo lo nota, il secondo lo rimette in coda
+        first = await booking_queue.reclaim_stale_jobs()
+        second = await booking_queue.reclaim_stale_jobs()
+        await booking_queue._run_job(await _pick(redis), _booked)
+        return first, second, await booking_queue.get_job(job["job_id"])
+
+    first, second, job = asyncio.run(scenario())
+
+    assert (first, second) == (0, 1)
+    assert job["status"] == SUCCEEDED
+
+
+def test_batch_marks_meals_of_active_jobs_as_duplicates(redis, published):
+    async def scenario():
+        single = await booking_queue.enqueue_booking("alice", "pw", MEAL, [])
+        batch = await booking_queue.enqueue_batch("alice", "pw", [
+            {"meal_url": MEAL, "dish_ids": []},
+            {"meal_url": OTHER_MEAL, "dish_ids": []},
+        ])
+        return single, batch
+
+    single, batch = asyncio.run(scenario())
+
+    assert [item["status"] for item in batch["items"]] == ["duplicate", QUEUED]
+    assert batch["items"][0]["job_id"] == single["job_id"]
@@ -0,0 +1,147 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import browser_manager
+from app.browser_manager import BrowserManager
+
+
+class StubBrowser:
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.closed = False
+
+    def on(self, event, callback):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+class StubPool:
+    def __init__(self, browser, **options):
+        self.browser = browser
+        self.created = 0
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    @asynccontextmanager
+    async def checkout(self):
+        self.created += 1
+        yield self.browser, None
+
+
+class StubPlaywright:
+    def __init__(self):
+        self.browsers = []
+        self.chromium = self
+
+    async def start(self):
+        return self
+
+    async def launch(self, **options):
+        self.browsers.append(StubBrowser(len(self.browsers) + 1))
+        return self.browsers[-1]
+
+    async def stop(self):
+        pass
+
+
+@pytest.fixture
+def playwright(monkeypatch):
+    """Playwright finto: ogni launch() crea un browser nuovo, il pool conta i checkout."""
+    stub = StubPlaywright()
+    monkeypatch.setattr(browser_manager, "async_playwright", lambda: stub)
+    monkeypatch.setattr(browser_manager, "ContextPool", StubPool)
+    return stub
+
+
+async def _until(condition, timeout: float = 2.0):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.005)
+
+
+def test_recycles_after_k_contexts(playwright):
+    manager = BrowserManager({}, recycle_after_contexts=2, drain_timeout=1, check_seconds=0.01)
+
+    async def scenario():
+        for _ in range(2):
+            async with manager.checkout():
+                pass
+        await _until(lambda: manager.generation == 2)
+        async with manager.checkout() as (browser, _):
+            used = browser
+        stats = manager.stats()
+        await manager.close()
+        return used, stats
+
+    used, stats = asyncio.run(scenario())
+
+    first, second = playwright.browsers
+    assert first.closed
+    assert used is second
+    assert stats["restarts"] == {"contexts": 1}
+    assert stats["contexts_created"] == 1
+
+
+def test_recycle_waits_for_the_running_booking(playwright):
+    manager = BrowserManager({}, recycle_after_contexts=1, drain_timeout=5, check_seconds=0.01)
+    release = asyncio.Event()
+
+    async def scenario():
+        async def booking():
+            async with manager.checkout():
+                await release.wait()
+
+        task = asyncio.create_task(booking())
+        await _until(lambda: manager.stats()["recycle_pending"] == "contexts")
+        # Soglia superata ma prenotazione in corso: il browser resta quello vecchio
+        still_open = not playwright.browsers[0].closed
+        release.set()
+        await task
+        # Il primo momento di inattività fa partire il riciclo
+        await _until(lambda: manager.generation == 2)
+        await manager.close()
+        return still_open
+
+    assert asyncio.run(scenario())
+    assert playwright.browsers[0].closed
+
+
+def test_drain_stops_new_work_and_closes_after_the_timeout(playwright):
+    manager = BrowserManager({}, recycle_after_contexts=1, drain_timeout=0.05, check_seconds=0.01)
+    release = asyncio.Event()
+
+    async def scenario():
+        async def booking():
+            async with manager.checkout() as (browser, _):
+                await release.wait()
+                return browser
+
+        stuck = asyncio.create_task(booking())
+        await _until(lambda: manager.stats()["draining"])
+        # Durante il drenaggio le operazioni nuove aspettano il browser nuovo
+        late = asyncio.create_task(booking())
+        await asyncio.sleep(0.01)
+        waited = not late.done() and manager.stats()["in_use"] == 1
+        await _until(lambda: manager.generation == 2)
+        release.set()
+        results = await asyncio.gather(stuck, late)
+        await manager.close()
+        return waited, results
+
+    waited, [stuck_browser, late_browser] = asyncio.run(scenario())
+
+    # Con K = 1 anche il contesto della prenotazione tardiva fa ripartire un riciclo
+    first, second = playwright.browsers[:2]
+    assert waited
+    # Scaduto drain_timeout il browser vecchio viene chiuso anche con la prenotazione ancora aperta
+    assert first.closed
+    assert stuck_browser is first
+    assert late_browser is second
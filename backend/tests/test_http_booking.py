@@ -0,0 +1,88 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import http_booking, main
+from app.booking_queue import BookingJobError
+from app.scraper import BASE_URL
+from app.settings import settings
+from app.upstream import CircuitBreaker, UpstreamUnavailable
+from bench import fake_portal
+
+MEAL_ID = 101
+MEAL_URL = f"{BASE_URL}/node/{MEAL_ID}"
+
+
+def _lost_response(op: str):
+    """Transport verso il portale finto che perde la risposta al POST del bottone op
+    (il portale lo elabora, il client va in timeout)."""
+    class LostResponse(httpx.ASGITransport):
+        async def handle_async_request(self, request):
+            response = await super().handle_async_request(request)
+            if request.method == "POST" and f"op={op}".encode() in request.content:
+                raise httpx.ReadTimeout("risposta persa", request=request)
+            return response
+    return LostResponse
+
+
+@pytest.fixture
+def portal(monkeypatch, redis):
+    """Portale finto servito in memoria, con un circuit breaker tutto suo."""
+    fake_portal.reset_state()
+    monkeypatch.setattr(http_booking, "portal", CircuitBreaker(failure_threshold=5, open_seconds=30))
+    monkeypatch.setattr(settings, "UPSTREAM_RETRIES", 0)
+
+    def client(transport=httpx.ASGITransport):
+        return httpx.AsyncClient(transport=transport(app=fake_portal.app), follow_redirects=True)
+    return client
+
+
+def _dish_ids():
+    piatti = fake_portal.MEALS[MEAL_ID]["piatti"]
+    return [piatti["primi_piatti"][0][0], piatti["secondi_piatti"][1][0]]
+
+
+def test_books_through_the_whole_webform(portal):
+    async def scenario():
+        async with portal() as client:
+            await http_booking.http_login(client, "alice", fake_portal.PASSWORD)
+            return await http_booking.http_book_meal(client, MEAL_URL, _dish_ids())
+
+    assert asyncio.run(scenario()) is True
+    assert ("alice", MEAL_ID) in fake_portal.bookings
+
+
+def test_wrong_password_is_a_login_error(portal):
+    async def scenario():
+        async with portal() as client:
+            await http_booking.http_login(client, "alice", "sbagliata")
+
+    with pytest.raises(http_booking.LoginError):
+        asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("op", ["Anteprima", "Invia"])
+def test_network_error_is_not_a_form_error(portal, op):
+    async def scenario():
+        async with portal(_lost_response(op)) as client:
+            await http_booking.http_login(client, "alice", fake_portal.PASSWORD)
+            await http_booking.http_book_meal(client, MEAL_URL, _dish_ids())
+
+    with pytest.raises(UpstreamUnavailable):
+        asyncio.run(scenario())
+
+
+def test_lost_invia_does_not_fall_back_to_playwright(portal, monkeypatch):
+    async def playwright(request):
+        raise AssertionError("il fallback su Playwright non deve partire dopo Invia")
+
+    monkeypatch.setattr(settings, "BOOKING_ENGINE", "http")
+    monkeypatch.setattr(settings, "BOOKING_HTTP_FALLBACK", True)
+    monkeypatch.setattr(main, "new_http_client", lambda: portal(_lost_response("Invia")))
+    monkeypatch.setattr(main, "book_with_playwright", playwright)
+
+    with pytest.raises(BookingJobError, match="Portale non disponibile"):
+        asyncio.run(main.run_booking("alice", fake_portal.PASSWORD, MEAL_URL, _dish_ids()))
+    # La prenotazione è arrivata al portale: ripeterla altrove l'avrebbe duplicata
+    assert ("alice", MEAL_ID) in fake_portal.bookings
@@ -0,0 +1,92 @@
+import json
+
+import msgpack
+import pytest
+
+from app import menu_codec
+from app.settings import settings
+
+MEAL = {
+    "data": "2026-10-17",
+    "mensa": "Mensa Pascoli",
+    "mensa_id": "pascoli",
+    "tipo_pasto": "pranzo",
+    "url": "https://intragenzia.adisu.umbria.it/node/101",
+    "prenotato": False,
+    "prenotabile": True,
+    "piatti": {
+        "primi_piatti": [{"id": "10501", "nome": "Pasta al pomodoro"}],
+        "secondi_piatti": [{"id": "10504", "nome": "Pollo arrosto"}, {"id": "10505", "nome": "Frittata"}],
+        "contorni": [],
+    },
+}
+
+
+@pytest.fixture
+def codec(monkeypatch):
+    return lambda name: monkeypatch.setattr(settings, "MENU_CODEC", name)
+
+
+@pytest.mark.parametrize("name", ["json", "msgpack"])
+def test_round_trip(codec, name):
+    codec(name)
+
+    assert menu_codec.decode(menu_codec.encode(MEAL)) == MEAL
+
+
+def test_msgpack_is_versioned_and_smaller(codec):
+    codec("msgpack")
+    raw = menu_codec.encode(MEAL)
+
+    assert raw[:2] == bytes((menu_codec.MAGIC, menu_codec.SCHEMA_VERSION))
+    assert len(raw) < len(json.dumps(MEAL).encode())
+
+
+def test_msgpack_keeps_unknown_fields(codec):
+    codec("msgpack")
+    meal = {
+        **MEAL,
+        "note": "chiusa a cena",
+        "piatti": {"dessert": [{"id": "10511", "nome": "Budino", "allergeni": ["latte"]}]},
+    }
+
+    assert menu_codec.decode(menu_codec.encode(meal)) == meal
+
+
+@pytest.mark.parametrize("name", ["json", "msgpack"])
+def test_reads_meals_stored_as_json(codec, name):
+    # Formato precedente a menu_codec: JSON semplice, leggibile con qualunque codec attivo
+    codec(name)
+
+    assert menu_codec.decode(json.dumps(MEAL).encode()) == MEAL
+
+
+def test_unknown_schema_version_is_rejected(codec):
+    codec("msgpack")
+    raw = menu_codec.encode(MEAL)
+
+    with pytest.raises(menu_codec.CodecError):
+        menu_codec.decode(bytes((menu_codec.MAGIC, menu_codec.SCHEMA_VERSION + 1)) + raw[2:])
+
+
+@pytest.mark.parametrize("raw", [
+    b"",
+    b"{\"data\": ",
+    b"\xff\xfe",
+    b"[1, 2]",
+])
+def test_corrupt_json_is_a_codec_error(raw):
+    with pytest.raises(menu_codec.CodecError):
+        menu_codec.decode(raw)
+
+
+@pytest.mark.parametrize("payload", [
+    b"\x92\x01",  # lista troncata
+    msgpack.packb({"data": "2026-10-17"}),
+    msgpack.packb(["2026-10-17", "Mensa Pascoli", {}]),
+    msgpack.packb([None] * 7 + [["piatti non in un dict"], {}]),
+    msgpack.packb([None] * 7 + [{"primi_piatti": [[]]}, {}]),
+])
+def test_corrupt_msgpack_is_a_codec_error(payload):
+    with pytest.raises(menu_codec.CodecError):
+        menu_codec.decode(bytes((menu_codec.MAGIC, menu_codec.SCHEMA_VERSION)) + payload)
@@ -0,0 +1,80 @@
+import pytest
+
+from app.menu_parser import CATEGORY_MAP, canteen_id, extract_menu_links, parse_menu_html, parse_menu_link
+
+
+def test_extract_menu_links_keeps_page_order(fixture_html):
+    links = extract_menu_links(fixture_html("menu_listing.html"))
+
+    assert links == [
+        ("Mensa Pascoli - Pranzo del 17/10/2026", "/node/101"),
+        ("Mensa Pascoli - Cena del 17/10/2026", "/node/102"),
+        ("Mensa Via del Giochetto - Pranzo del 17/10/2026", "/node/103"),
+        ("Mensa Via del Giochetto - Cena del 17/10/2026", "/node/104"),
+    ]
+
+
+def test_extract_menu_links_ignores_links_outside_the_listing():
+    html = '<a href="/user/login">Login</a><div class="view-menu"><a href="/node/1">Mensa Pascoli - Pranzo</a></div>'
+
+    assert extract_menu_links(html) == [("Mensa Pascoli - Pranzo", "/node/1")]
+
+
+def test_parse_menu_html_bookable_page(fixture_html):
+    grouped, prenotato, prenotabile = parse_menu_html(fixture_html("menu_page.html"))
+
+    assert (prenotato, prenotabile) == (False, True)
+    assert list(grouped) == list(CATEGORY_MAP.values())
+    assert grouped["primi_piatti"] == [
+        {"id": "10501", "nome": "Pasta al pomodoro"},
+        {"id": "10502", "nome": "Risotto ai funghi"},
+        {"id": "10503", "nome": "Minestrone di verdure"},
+    ]
+    assert [d["id"] for d in grouped["dessert"]] == ["10511"]
+    # Le opzioni "Nessuno" (_none) e la tipologia menu non sono piatti
+    assert sum(len(dishes) for dishes in grouped.values()) == 11
+    assert all(d["id"].isdigit() for dishes in grouped.values() for d in dishes)
+
+
+def test_parse_menu_html_already_booked(fixture_html):
+    grouped, prenotato, prenotabile = parse_menu_html(fixture_html("menu_page_booked.html"))
+
+    assert (prenotato, prenotabile) == (True, False)
+    assert grouped["secondi_piatti"][0] == {"id": "10604", "nome": "Pollo arrosto"}
+
+
+def test_parse_menu_html_hidden_checkbox_is_not_bookable():
+    html = """
+    <div class="form-item js-form-item-vuoi-prenotare js-webform-states-hidden">
+      <input type="checkbox" id="edit-vuoi-prenotare">
+    </div>"""
+
+    grouped, prenotato, prenotabile = parse_menu_html(html)
+
+    assert (prenotato, prenotabile) == (False, False)
+    assert grouped == {v: [] for v in CATEGORY_MAP.values()}
+
+
+def test_listing_links_parse_to_canteen_and_meal(fixture_html):
+    parsed = [parse_menu_link(text) for text, _ in extract_menu_links(fixture_html("menu_listing.html"))]
+
+    assert parsed == [
+        ("Mensa Pascoli", "pranzo"),
+        ("Mensa Pascoli", "cena"),
+        ("Mensa Via del Giochetto", "pranzo"),
+        ("Mensa Via del Giochetto", "cena"),
+    ]
+    assert canteen_id("Mensa Via del Giochetto") == "via-del-giochetto"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Mensa Pascoli – Cena del 17/10/2026", ("Mensa Pascoli", "cena")),
+    ("Pranzo - Mensa Pascoli", ("Mensa Pascoli", "pranzo")),
+    ("Menu Pranzo Mensa Pascoli 17/10/2026", ("Mensa Pascoli", "pranzo")),
+    ("MENSA PASCOLI: CENA", ("MENSA PASCOLI", "cena")),
+    ("Mensa Pascoli (pranzo)", ("Mensa Pascoli", "pranzo")),
+    ("Mensa Pascoli", None),
+    ("Pranzo del giorno", None),
+])
+def test_parse_menu_link_accepts_other_layouts(text, expected):
+    assert parse_menu_link(text) == expected
@@ -0,0 +1,28 @@
+import asyncio
+
+from app.redis_client import listen_channels
+
+
+def test_listen_survives_handler_errors(redis):
+    received, gaps = [], []
+
+    async def handler(channel, data):
+        if data == "rotto":
+            raise ValueError(data)
+        received.append((channel, data))
+
+    async def scenario():
+        task = asyncio.create_task(listen_channels(["a", "b"], handler, "Test", on_gap=lambda: gaps.append(1)))
+        while not gaps:
+            await asyncio.sleep(0.01)
+        for channel, data in (("a", "uno"), ("b", "rotto"), ("b", "due")):
+            await redis.publish(channel, data)
+        while len(received) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(asyncio.wait_for(scenario(), 5))
+
+    assert received == [("a", "uno"), ("b", "due")]
+    assert gaps == [1]